@@ -0,0 +1,399 @@
+"""
+Benchmarks for `pail`.
+
+Times the helpers and full middleware round-trips with synthetic
+images of realistic sizes and writes the results as JSON::
+
+  $ python benchmarks/bench.py --output before.json
+  $ python benchmarks/bench.py --output after.json --compare before.json
+
+Images are generated deterministically, so results of different
+commits (on the same machine) can be compared. Use ``--quick`` for a
+fast run with small images only.
+
+Each benchmark runs in a fresh Python process, which reads only the
+image it needs. So the peak RSS reported for a benchmark is not
+raised by benchmarks run before it.
+"""
+from __future__ import print_function
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from io import BytesIO
+from PIL import Image, ImageDraw
+import PIL
+from webob import Request
+from pail.helpers import ResolutionTable, get_resolution, resize
+from pail.wsgi import ImageAdaptingMiddleware
+
+try:
+    import resource
+except ImportError:                     # pragma: no cover
+    resource = None                     # not available on Windows
+
+timer = getattr(time, 'perf_counter', time.time)
+
+#: Image sizes benchmarked, by name: 0.3, 2, 12 and 24 megapixels.
+SIZES = [
+    ('0.3mp', (640, 480)),
+    ('2mp', (1600, 1200)),
+    ('12mp', (4000, 3000)),
+    ('24mp', (6000, 4000)),
+    ]
+
+#: Sizes used with ``--quick``.
+QUICK_SIZES = SIZES[:2]
+
+#: Formats benchmarked. GIFs are limited to smaller sizes, as nobody
+#: serves 24 MP GIFs.
+FORMATS = ['JPEG', 'PNG', 'GIF']
+MAX_GIF_PIXELS = 2000000
+
+#: Resolutions configured for the middleware.
+RESOLUTIONS = '1382, 992, 768, 480'
+
+#: User-Agent strings, desktop and mobile.
+USER_AGENTS = [
+    'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 '
+    '(KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
+    'Mozilla/5.0 (Macintosh; Intel Mac OS X 14_1) AppleWebKit/605.1.15 '
+    '(KHTML, like Gecko) Version/17.1 Safari/605.1.15',
+    'Mozilla/5.0 (iPhone; CPU iPhone OS 17_1 like Mac OS X) '
+    'AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.1 '
+    'Mobile/15E148 Safari/604.1',
+    'Mozilla/5.0 (Linux; Android 14; Pixel 8) AppleWebKit/537.36 '
+    '(KHTML, like Gecko) Chrome/120.0.0.0 Mobile Safari/537.36',
+    ]
+
+
+def create_image(size, format='JPEG'):
+    """Create a photo-like image of `size` and return its data.
+
+    The result depends only on `size` and `format`.
+    """
+    width, height = size
+    im = Image.merge('RGB', [
+        Image.linear_gradient('L').resize(size),
+        Image.effect_mandelbrot(size, (-2.0, -1.2, 0.8, 1.2), 64),
+        Image.linear_gradient('L').rotate(90).resize(size)])
+    draw = ImageDraw.Draw(im)
+    step = max(width // 16, 1)
+    for num in range(0, width, step):
+        draw.ellipse(
+            (num, num * height // width // 2,
+             num + width // 8, num * height // width // 2 + height // 5),
+            fill=(num % 256, 255 - num % 256, (num * 7) % 256))
+    if format == 'GIF':
+        im = im.convert('P', palette=Image.ADAPTIVE)
+    data = BytesIO()
+    im.save(data, format)
+    return data.getvalue()
+
+
+def get_images(sizes, directory, create=True):
+    """Get a list of ``(<NAME>, <FORMAT>, <SIZE>, <PATH>)`` tuples.
+
+    The images are stored in `directory`. If `create` is false, they
+    are expected to exist already.
+    """
+    result = []
+    for name, size in sizes:
+        for format in FORMATS:
+            if format == 'GIF' and size[0] * size[1] > MAX_GIF_PIXELS:
+                continue
+            path = os.path.join(directory, '%s.%s' % (name, format.lower()))
+            if create:
+                with open(path, 'wb') as fd:
+                    fd.write(create_image(size, format))
+            result.append((name, format, size, path))
+    return result
+
+
+def read_file(path):
+    with open(path, 'rb') as fd:
+        return fd.read()
+
+
+def percentile(values, percent):
+    """Get the `percent` percentile of sorted `values`.
+    """
+    index = int(round(percent / 100.0 * (len(values) - 1)))
+    return values[index]
+
+
+def get_peak_rss():
+    """Get the peak resident set size of this process in KiB or ``None``.
+
+    On Linux `VmHWM` is used, as `ru_maxrss` of a new process starts
+    with the peak of its parent.
+    """
+    try:
+        with open('/proc/self/status') as fd:
+            for line in fd:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except (IOError, OSError, ValueError):
+        pass
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        peak //= 1024  # bytes on macOS
+    return peak
+
+
+def measure(func, repeat, min_time=0.0, items=1):
+    """Call `func` `repeat` times (or longer, until `min_time` passed).
+
+    `items` is the number of items (images, lookups) handled per
+    call. Returns a dict with latency percentiles in milliseconds,
+    items per second, the RSS before the first call (`base_rss_kb`)
+    and the peak RSS of the process (`peak_rss_kb`).
+    """
+    base_rss = get_peak_rss()
+    func()  # warm up
+    times = []
+    start = timer()
+    while len(times) < repeat or timer() - start < min_time:
+        call_start = timer()
+        func()
+        times.append(timer() - call_start)
+    total = sum(times)
+    times.sort()
+    return dict(
+        calls=len(times),
+        mean_ms=total / len(times) * 1000,
+        p50_ms=percentile(times, 50) * 1000,
+        p90_ms=percentile(times, 90) * 1000,
+        p99_ms=percentile(times, 99) * 1000,
+        min_ms=times[0] * 1000,
+        max_ms=times[-1] * 1000,
+        items_per_sec=len(times) * items / total,
+        base_rss_kb=base_rss,
+        peak_rss_kb=get_peak_rss(),
+        )
+
+
+def bench_resize(images, repeat):
+    # `helpers.resize` in normal and fast decoding mode.
+    def run(path, fast_decode):
+        data = read_file(path)
+        return measure(
+            lambda: resize(BytesIO(data), 480, fast_decode=fast_decode),
+            repeat)
+    benchmarks = []
+    for name, format, size, path in images:
+        for fast_decode in (False, True):
+            key = 'resize/%s/%s%s' % (
+                format.lower(), name, fast_decode and '/fast' or '')
+            benchmarks.append((key, run, (path, fast_decode)))
+    return benchmarks
+
+
+def bench_get_resolution(repeat):
+    # resolution lookups for many client widths.
+    resolutions = [1382, 992, 768, 480]
+    widths = [(width, dpr) for width in range(320, 2000, 7)
+              for dpr in (1, 2, 3)]
+
+    def helper():
+        for width, dpr in widths:
+            get_resolution(width, dpr, list(resolutions))
+
+    def run_table():
+        table = ResolutionTable(resolutions)
+
+        def lookup():
+            for width, dpr in widths:
+                table.lookup(width, dpr)
+        return measure(lookup, repeat, min_time=0.5, items=len(widths))
+    return [
+        ('get_resolution/function', measure,
+         (helper, repeat, 0.5, len(widths))),
+        ('get_resolution/table', run_table, ()),
+        ]
+
+
+def bench_is_mobile(repeat):
+    # mobile detection for known and new User-Agent strings.
+    requests = [Request.blank('/', headers={'User-Agent': ua})
+                for ua in USER_AGENTS]
+
+    def run_known():
+        middleware = ImageAdaptingMiddleware(None, {})
+
+        def known():
+            for request in requests:
+                middleware.is_mobile(request)
+        return measure(known, repeat, min_time=0.5, items=len(requests))
+
+    def unknown():
+        # a fresh middleware has not seen any User-Agent yet
+        app = ImageAdaptingMiddleware(None, {})
+        for request in requests:
+            app.is_mobile(request)
+    return [
+        ('is_mobile/known', run_known, ()),
+        ('is_mobile/unknown', measure,
+         (unknown, repeat, 0.5, len(requests))),
+        ]
+
+
+def get_image_app(data, content_type):
+    # a WSGI app serving `data`
+    def app(environ, start_response):
+        start_response('200 OK', [
+            ('Content-Type', content_type),
+            ('Content-Length', str(len(data))),
+            ('Last-Modified', 'Sat, 04 May 2013 03:26:35 GMT')])
+        return [data]
+    return app
+
+
+def bench_middleware(images, repeat):
+    # full round-trips through the middleware with a WSGI test client.
+    settings = [
+        ('default', dict()),
+        ('fast', dict(fast_decode='true')),
+        ('cached', dict(memory_cache_max_bytes='104857600')),
+        ]
+
+    def run(path, options, width):
+        middleware = ImageAdaptingMiddleware(
+            get_image_app(read_file(path), 'image/jpeg'), {},
+            resolutions=RESOLUTIONS, **options)
+
+        def round_trip():
+            request = Request.blank('/image.jpg')
+            request.headers['Cookie'] = 'resolution=%s; $Path=/' % width
+            request.headers['User-Agent'] = USER_AGENTS[0]
+            response = request.get_response(middleware)
+            assert response.status_int == 200
+        return measure(round_trip, repeat)
+    benchmarks = []
+    for name, format, size, path in images:
+        if format != 'JPEG':
+            continue
+        for setting, options in settings:
+            benchmarks.append(('middleware/%s/%s' % (setting, name), run,
+                               (path, options, 480)))
+        # images passed through unchanged
+        benchmarks.append(('middleware/unchanged/%s' % name, run,
+                           (path, dict(), size[0] + 1)))
+    return benchmarks
+
+
+def get_benchmarks(images, repeat):
+    """Get a list of ``(<KEY>, <FUNC>, <ARGS>)`` tuples.
+
+    Calling ``<FUNC>(*<ARGS>)`` runs the benchmark and returns its
+    results (see :func:`measure`).
+    """
+    return (bench_resize(images, repeat) + bench_get_resolution(repeat) +
+            bench_is_mobile(repeat) + bench_middleware(images, repeat))
+
+
+def run_isolated(key, args, directory):
+    """Run the benchmark `key` in a fresh process and get its results.
+    """
+    command = [sys.executable, os.path.abspath(__file__), '--run', key,
+               '--images', directory, '--repeat', str(args.repeat)]
+    if args.quick:
+        command.append('--quick')
+    output = subprocess.check_output(command)
+    return json.loads(output.decode('utf-8'))
+
+
+def get_metadata():
+    """Get information about the environment benchmarks ran in.
+    """
+    commit = None
+    try:
+        commit = subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.STDOUT).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        pass
+    return dict(
+        commit=commit,
+        time=time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        python=platform.python_version(),
+        implementation=platform.python_implementation(),
+        pillow=PIL.__version__,
+        platform=platform.platform(),
+        processor=platform.processor(),
+        )
+
+
+def compare(results, old_results):
+    """Print the change of p50 latencies and peak RSS against `old_results`.
+    """
+    print('%-40s %10s %10s %8s %10s %10s' % (
+        'benchmark', 'old p50', 'new p50', 'ratio', 'old peak', 'new peak'))
+    for key in sorted(results):
+        if key not in old_results:
+            continue
+        old, new = old_results[key], results[key]
+        print('%-40s %8.3fms %8.3fms %7.2fx %7.1fMiB %7.1fMiB' % (
+            key, old['p50_ms'], new['p50_ms'],
+            new['p50_ms'] / old['p50_ms'] if old['p50_ms'] else 0,
+            (old['peak_rss_kb'] or 0) / 1024.0,
+            (new['peak_rss_kb'] or 0) / 1024.0))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark pail.')
+    parser.add_argument('-o', '--output', help='write JSON results here')
+    parser.add_argument('-c', '--compare', metavar='JSON',
+                        help='compare with results of an earlier run')
+    parser.add_argument('-q', '--quick', action='store_true',
+                        help='small images and few repetitions only')
+    parser.add_argument('-r', '--repeat', type=int,
+                        help='minimum number of calls per benchmark')
+    parser.add_argument('-k', '--only', metavar='PREFIX',
+                        help='run only benchmarks starting with PREFIX')
+    # used internally to run a single benchmark in a fresh process
+    parser.add_argument('--run', help=argparse.SUPPRESS)
+    parser.add_argument('--images', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    args.repeat = args.repeat or (args.quick and 3 or 10)
+    sizes = args.quick and QUICK_SIZES or SIZES
+    if args.run:
+        images = get_images(sizes, args.images, create=False)
+        for key, func, func_args in get_benchmarks(images, args.repeat):
+            if key == args.run:
+                print(json.dumps(func(*func_args)))
+                return 0
+        return 1
+    directory = tempfile.mkdtemp()
+    try:
+        images = get_images(sizes, directory)
+        results = dict()
+        for key, func, func_args in get_benchmarks(images, args.repeat):
+            if not args.only or key.startswith(args.only):
+                results[key] = run_isolated(key, args, directory)
+    finally:
+        shutil.rmtree(directory)
+    for key in sorted(results):
+        print('%-40s p50 %9.3fms  p99 %9.3fms  %10.1f/s' % (
+            key, results[key]['p50_ms'], results[key]['p99_ms'],
+            results[key]['items_per_sec']))
+    report = dict(metadata=get_metadata(), results=results)
+    if args.output:
+        with open(args.output, 'w') as fd:
+            json.dump(report, fd, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as fd:
+            compare(results, json.load(fd)['results'])
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,342 @@
+"""
+Load tests for `pail`.
+
+Runs the middleware (`pail.wsgi.filter_app`) over a static file app
+in a local multi-threaded WSGI server and sends it a mix of requests
+from several client threads::
+
+  $ python benchmarks/loadtest.py --requests 2000 --concurrency 8 \\
+        -o resize_workers=4 -o memory_cache_max_bytes=104857600
+
+The mix of User-Agents, `resolution` cookies, pixel ratios, image
+sizes and non-image requests can be changed with ``--mix FILE``, a
+JSON file overriding keys of `DEFAULT_MIX`. Latency percentiles,
+throughput, CPU time and RSS over time are printed and can be written
+as JSON with ``--output``.
+
+Clients run in the same process as the server. CPU time therefore
+includes the clients; CPU time of resize worker processes is counted
+separately.
+"""
+from __future__ import print_function
+import argparse
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+from wsgiref.simple_server import WSGIRequestHandler, WSGIServer, make_server
+from webob.static import DirectoryApp
+from pail.wsgi import filter_app
+from bench import (
+    SIZES, USER_AGENTS, create_image, get_metadata, percentile, timer)
+try:
+    from http.client import HTTPConnection
+    from socketserver import ThreadingMixIn
+except ImportError:                                   # pragma: no cover
+    from httplib import HTTPConnection                # pragma: no cover
+    from SocketServer import ThreadingMixIn           # pragma: no cover
+
+try:
+    import resource
+except ImportError:                                   # pragma: no cover
+    resource = None
+
+#: The default request mix. Lists contain ``[<VALUE>, <WEIGHT>]``
+#: pairs; values are chosen randomly by weight.
+DEFAULT_MIX = {
+    # User-Agent headers sent.
+    'user_agents': [[USER_AGENTS[0], 3], [USER_AGENTS[1], 1],
+                    [USER_AGENTS[2], 3], [USER_AGENTS[3], 3]],
+    # CSS widths sent in the `resolution` cookie; `null` for no cookie.
+    'widths': [[None, 2], [360, 3], [414, 2], [768, 1], [1280, 1],
+               [1920, 1]],
+    # pixel ratios sent in the `resolution` cookie.
+    'dprs': [[1, 4], [2, 4], [3, 2]],
+    # images requested, by size name (see `bench.SIZES`) and format.
+    'images': [[['0.3mp', 'JPEG'], 4], [['2mp', 'JPEG'], 4],
+               [['2mp', 'PNG'], 1], [['12mp', 'JPEG'], 1]],
+    # number of different files per image kind, so that caches do
+    # not serve everything after the first requests.
+    'files_per_image': 5,
+    # share of requests for non-image files (HTML, CSS).
+    'non_image_ratio': 0.2,
+    }
+
+#: Non-image files served.
+OTHER_FILES = {
+    'index.html': b'<html><body>' + b'<p>Hello</p>' * 500 + b'</body></html>',
+    'style.css': b'body { margin: 0; }\n' * 200,
+    }
+
+
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    # a WSGI server handling each request in its own thread.
+    daemon_threads = True
+
+
+class QuietHandler(WSGIRequestHandler):
+    # a request handler that does not log requests.
+    def log_message(self, *args):
+        pass
+
+
+def choose(rand, choices):
+    """Choose a value from `choices`, a list of ``[<VALUE>, <WEIGHT>]``.
+    """
+    total = sum(weight for value, weight in choices)
+    point = rand.uniform(0, total)
+    for value, weight in choices:
+        point -= weight
+        if point <= 0:
+            return value
+    return choices[-1][0]
+
+
+def create_files(root, mix):
+    """Create the files served in `root`.
+
+    Returns a dict mapping image kinds ``(<SIZE NAME>, <FORMAT>)`` to
+    lists of URL paths.
+    """
+    sizes = dict(SIZES)
+    images = dict()
+    for (name, format), weight in mix['images']:
+        data = create_image(sizes[name], format)
+        ext = format == 'JPEG' and 'jpg' or format.lower()
+        paths = images[(name, format)] = []
+        for num in range(mix['files_per_image']):
+            filename = '%s-%s.%s' % (name, num, ext)
+            with open(os.path.join(root, filename), 'wb') as fd:
+                fd.write(data)
+            paths.append('/' + filename)
+    for filename, data in OTHER_FILES.items():
+        with open(os.path.join(root, filename), 'wb') as fd:
+            fd.write(data)
+    return images
+
+
+def get_rss():
+    """Get the current resident set size of this process in KiB.
+
+    Falls back to the peak RSS where `/proc` is not available.
+    """
+    try:
+        with open('/proc/self/statm') as fd:
+            pages = int(fd.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE') // 1024
+    except (IOError, OSError, ValueError, AttributeError):
+        if resource is None:
+            return None
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class LoadTest(object):
+    """A load test of `app`, served on a local port.
+
+    `images` maps image kinds to URL paths (see :func:`create_files`).
+    """
+
+    def __init__(self, app, images, mix, concurrency=4, requests=1000,
+                 duration=None, seed=0, sample_interval=1.0):
+        self.app = app
+        self.images = images
+        self.mix = mix
+        self.concurrency = concurrency
+        self.requests = requests
+        self.duration = duration
+        self.seed = seed
+        self.sample_interval = sample_interval
+        self.results = []
+        self.samples = []
+        self._sent = 0
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+
+    def get_request(self, rand):
+        """Get a random request from the mix.
+
+        Returns a tuple ``(<KIND>, <PATH>, <HEADERS>)``.
+        """
+        mix = self.mix
+        headers = {'User-Agent': choose(rand, mix['user_agents'])}
+        width = choose(rand, mix['widths'])
+        if width is not None:
+            headers['Cookie'] = 'resolution=%s.%s' % (
+                width, choose(rand, mix['dprs']))
+        if rand.random() < mix['non_image_ratio']:
+            return 'other', '/' + rand.choice(sorted(OTHER_FILES)), headers
+        kind = tuple(choose(rand, mix['images']))
+        return '%s/%s' % kind, rand.choice(self.images[kind]), headers
+
+    def should_stop(self, start):
+        # count another request unless we are done.
+        with self._lock:
+            if self.duration is not None:
+                return timer() - start >= self.duration
+            if self._sent >= self.requests:
+                return True
+            self._sent += 1
+            return False
+
+    def client(self, port, num, start):
+        # send requests until we are done.
+        rand = random.Random(self.seed * 1000 + num)
+        while not self.should_stop(start):
+            kind, path, headers = self.get_request(rand)
+            request_start = timer()
+            status, size = None, 0
+            try:
+                conn = HTTPConnection('127.0.0.1', port, timeout=60)
+                conn.request('GET', path, headers=headers)
+                response = conn.getresponse()
+                size = len(response.read())
+                status = response.status
+                conn.close()
+            except Exception as exc:
+                status = str(exc)
+            self.results.append(
+                (kind, status, timer() - request_start, size))
+
+    def sampler(self, start):
+        # record CPU time and RSS until done.
+        while True:
+            times = os.times()
+            self.samples.append(dict(
+                seconds=round(timer() - start, 3),
+                rss_kb=get_rss(),
+                cpu_seconds=round(times[0] + times[1], 3)))
+            if self._done.wait(self.sample_interval):
+                break
+
+    def run(self):
+        """Run the load test and get a report (a dict).
+        """
+        server = make_server(
+            '127.0.0.1', 0, self.app, server_class=ThreadingWSGIServer,
+            handler_class=QuietHandler)
+        server_thread = threading.Thread(target=server.serve_forever)
+        server_thread.daemon = True
+        server_thread.start()
+        port = server.server_address[1]
+        times_before = os.times()
+        start = timer()
+        sampler = threading.Thread(target=self.sampler, args=(start, ))
+        sampler.start()
+        clients = [threading.Thread(target=self.client, args=(port, num, start))
+                   for num in range(self.concurrency)]
+        for client in clients:
+            client.start()
+        for client in clients:
+            client.join()
+        seconds = timer() - start
+        self._done.set()
+        sampler.join()
+        server.shutdown()
+        server.server_close()
+        pool = getattr(self.app, 'pool', None)
+        if pool is not None:
+            pool.shutdown()  # so CPU time of workers is accounted
+        times_after = os.times()
+        return self.get_report(seconds, times_before, times_after)
+
+    def get_report(self, seconds, times_before, times_after):
+        """Get a dict describing the results.
+        """
+        latencies = dict()
+        errors = 0
+        for kind, status, latency, size in self.results:
+            if status != 200:
+                errors += 1
+            latencies.setdefault(kind, []).append(latency)
+            latencies.setdefault('all', []).append(latency)
+        report = dict(
+            requests=len(self.results),
+            errors=errors,
+            seconds=seconds,
+            requests_per_sec=len(self.results) / seconds,
+            bytes=sum(x[3] for x in self.results),
+            cpu_seconds=(times_after[0] + times_after[1] -
+                         times_before[0] - times_before[1]),
+            worker_cpu_seconds=(times_after[2] + times_after[3] -
+                                times_before[2] - times_before[3]),
+            peak_rss_kb=max([x['rss_kb'] or 0 for x in self.samples]),
+            samples=self.samples,
+            latency=dict(),
+            )
+        for kind, values in latencies.items():
+            values.sort()
+            report['latency'][kind] = dict(
+                requests=len(values),
+                p50_ms=percentile(values, 50) * 1000,
+                p95_ms=percentile(values, 95) * 1000,
+                p99_ms=percentile(values, 99) * 1000,
+                max_ms=values[-1] * 1000)
+        get_stats = getattr(self.app, 'get_stats', None)
+        if get_stats is not None:
+            report['stats'] = get_stats()
+        return report
+
+
+def print_report(report):
+    print('%d requests (%d errors) in %.1f s: %.1f requests/s' % (
+        report['requests'], report['errors'], report['seconds'],
+        report['requests_per_sec']))
+    print('CPU %.1f s (resize workers %.1f s), peak RSS %.1f MiB' % (
+        report['cpu_seconds'], report['worker_cpu_seconds'],
+        report['peak_rss_kb'] / 1024.0))
+    print('%-16s %8s %10s %10s %10s %10s' % (
+        'kind', 'requests', 'p50', 'p95', 'p99', 'max'))
+    for kind in sorted(report['latency']):
+        values = report['latency'][kind]
+        print('%-16s %8d %8.1fms %8.1fms %8.1fms %8.1fms' % (
+            kind, values['requests'], values['p50_ms'], values['p95_ms'],
+            values['p99_ms'], values['max_ms']))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Load test pail.')
+    parser.add_argument('-n', '--requests', type=int, default=1000,
+                        help='number of requests (default: %(default)s)')
+    parser.add_argument('-d', '--duration', type=float,
+                        help='run for this many seconds instead')
+    parser.add_argument('-c', '--concurrency', type=int, default=4,
+                        help='number of client threads '
+                        '(default: %(default)s)')
+    parser.add_argument('-m', '--mix', metavar='JSON',
+                        help='file with changes to the request mix')
+    parser.add_argument('-o', '--option', action='append', default=[],
+                        metavar='NAME=VALUE', help='middleware option')
+    parser.add_argument('-s', '--seed', type=int, default=0,
+                        help='seed of the random request mix')
+    parser.add_argument('-i', '--interval', type=float, default=1.0,
+                        help='seconds between RSS samples')
+    parser.add_argument('--output', help='write JSON report here')
+    args = parser.parse_args(argv)
+    mix = dict(DEFAULT_MIX)
+    if args.mix:
+        with open(args.mix) as fd:
+            mix.update(json.load(fd))
+    options = dict(x.split('=', 1) for x in args.option)
+    root = tempfile.mkdtemp()
+    try:
+        images = create_files(root, mix)
+        app = filter_app(DirectoryApp(root), {}, **options)
+        test = LoadTest(
+            app, images, mix, args.concurrency, args.requests,
+            args.duration, args.seed, args.interval)
+        report = test.run()
+    finally:
+        shutil.rmtree(root)
+    report.update(metadata=get_metadata(), options=options, mix=mix)
+    print_report(report)
+    if args.output:
+        with open(args.output, 'w') as fd:
+            json.dump(report, fd, indent=2, sort_keys=True)
+    return report['errors'] and 1 or 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
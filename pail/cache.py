@@ -0,0 +1,317 @@
+"""
+Caches
+------
+
+Storage for resized image variants, so that the same image has not to
+be decoded, resampled and encoded again on every request.
+"""
+import hashlib
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+#: `os.replace` is atomic on all platforms but exists in Python 3 only.
+_replace = getattr(os, 'replace', os.rename)
+
+
+def make_key(*parts):
+    """Turn `parts` into a key suitable for caches.
+
+    `parts` can be strings or numbers. The result is a hex digest
+    that can be used as filename.
+    """
+    key = u'\0'.join([u'%s' % (part,) for part in parts])
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+class LRUCache(object):
+    """A dict-like memo with at most `max_entries` entries.
+
+    If more entries are stored, the least recently used ones are
+    removed. Stored values must not be ``None``.
+    """
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        """Get the value stored for `key` or `default`.
+        """
+        with self._lock:
+            value = self._entries.pop(key, None)
+            if value is None:
+                return default
+            self._entries[key] = value  # mark as recently used
+            return value
+
+    def set(self, key, value):
+        """Store `value` under `key`.
+        """
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = value
+            if len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+class MemoryCache(object):
+    """An in-process cache for image variants.
+
+    Keeps the data of the most recently used entries in memory. The
+    total size of all entries is kept below `max_bytes` by removing
+    the least recently used entries first.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Get the data stored for `key` or ``None``.
+        """
+        with self._lock:
+            data = self._entries.pop(key, None)
+            if data is None:
+                self.misses += 1
+                return None
+            self._entries[key] = data  # mark as recently used
+            self.hits += 1
+            return data
+
+    def set(self, key, data):
+        """Store `data` (bytes) under `key`.
+
+        Data larger than the whole cache is not stored at all.
+        """
+        if len(data) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.total_bytes -= len(old)
+            self._entries[key] = data
+            self.total_bytes += len(data)
+            while self.total_bytes > self.max_bytes:
+                old_key, old = self._entries.popitem(last=False)
+                self.total_bytes -= len(old)
+                self.evictions += 1
+
+    def get_stats(self):
+        """Get a dict with usage counters of this cache.
+        """
+        return dict(
+            entries=len(self._entries), bytes=self.total_bytes,
+            hits=self.hits, misses=self.misses, evictions=self.evictions)
+
+
+class TieredCache(object):
+    """A cache that combines several other caches.
+
+    `caches` is a list of caches, fastest first. Entries are looked up
+    in one cache after the other. Entries found in slower caches are
+    copied into the faster ones. New entries are stored in all caches.
+    """
+
+    def __init__(self, caches):
+        self.caches = caches
+
+    def get(self, key):
+        """Get the data stored for `key` or ``None``.
+        """
+        for num, cache in enumerate(self.caches):
+            data = cache.get(key)
+            if data is not None:
+                for faster_cache in self.caches[:num]:
+                    faster_cache.set(key, data)
+                return data
+        return None
+
+    def set(self, key, data):
+        """Store `data` (bytes) under `key` in all caches.
+        """
+        for cache in self.caches:
+            cache.set(key, data)
+
+
+class DiskCache(object):
+    """A filesystem cache for image variants.
+
+    Entries are stored as single files below `cache_dir`. The total
+    size of all entries is kept below `max_bytes` by removing the
+    least recently used entries first.
+
+    Files are written to temporary files first and then renamed, so
+    readers never see half-written entries.
+
+    Several processes can share `cache_dir`. Each of them rescans the
+    directory after writing `rescan_bytes` (a tenth of `max_bytes` by
+    default), so that entries written by the others count as well.
+    Reading an entry updates its modification time, which orders
+    entries by use across processes.
+    """
+
+    def __init__(self, cache_dir, max_bytes, rescan_bytes=None):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        if rescan_bytes is None:
+            rescan_bytes = max_bytes // 10
+        self.rescan_bytes = rescan_bytes
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.rescans = 0
+        self._written = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        self._load(self._scan())
+
+    def _scan(self):
+        """Get the entries existing in cache dir.
+
+        Returns a list of tuples ``(<MTIME>, <KEY>, <SIZE>)``.
+        """
+        found = []
+        for dirpath, dirnames, filenames in os.walk(self.cache_dir):
+            for name in filenames:
+                if name.startswith('.'):
+                    continue  # unfinished write
+                try:
+                    stat = os.stat(os.path.join(dirpath, name))
+                except OSError:
+                    continue
+                found.append((stat.st_mtime, name, stat.st_size))
+        return found
+
+    def _load(self, found):
+        """Replace the index with entries `found` by :meth:`_scan`.
+
+        Older entries (by modification time) are considered less
+        recently used. Caller must hold the lock, if needed.
+        """
+        order = dict((key, num) for num, key in enumerate(self._entries))
+        found.sort(key=lambda x: (x[0], order.get(x[1], -1)))
+        self._entries = OrderedDict()
+        self.total_bytes = 0
+        for mtime, name, size in found:
+            self._entries[name] = size
+            self.total_bytes += size
+        self._evict()
+
+    def rescan(self):
+        """Update the index from the entries existing in cache dir.
+
+        Entries written or removed by other processes are taken into
+        account then and too many entries are evicted.
+        """
+        found = self._scan()
+        with self._lock:
+            self.rescans += 1
+            self._load(found)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def get_path(self, key):
+        """Get the path of the file storing entry `key`.
+        """
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def get(self, key):
+        """Get the data stored for `key` or ``None``.
+        """
+        path = self.get_path(key)
+        try:
+            with open(path, 'rb') as fd:
+                data = fd.read()
+        except (IOError, OSError):
+            with self._lock:
+                self._forget(key)
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+            if key in self._entries:
+                # mark as recently used
+                self._entries[key] = self._entries.pop(key)
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        return data
+
+    def set(self, key, data):
+        """Store `data` (bytes) under `key`.
+
+        Data larger than the whole cache is not stored at all.
+        """
+        if len(data) > self.max_bytes:
+            return
+        path = self.get_path(key)
+        dirname = os.path.dirname(path)
+        if not os.path.isdir(dirname):
+            try:
+                os.makedirs(dirname)
+            except OSError:
+                # maybe created by some other thread or process
+                if not os.path.isdir(dirname):
+                    raise
+        fd, tmp_path = tempfile.mkstemp(prefix='.', dir=dirname)
+        try:
+            with os.fdopen(fd, 'wb') as tmp_file:
+                tmp_file.write(data)
+            _replace(tmp_path, path)
+        except:
+            os.unlink(tmp_path)
+            raise
+        with self._lock:
+            self._forget(key)
+            self._entries[key] = len(data)
+            self.total_bytes += len(data)
+            self._evict()
+            self._written += len(data)
+            rescan = self._written >= self.rescan_bytes
+            if rescan:
+                self._written = 0
+        if rescan:
+            self.rescan()
+
+    def get_stats(self):
+        """Get a dict with usage counters of this cache.
+        """
+        return dict(
+            entries=len(self._entries), bytes=self.total_bytes,
+            hits=self.hits, misses=self.misses, evictions=self.evictions,
+            rescans=self.rescans)
+
+    def _forget(self, key):
+        # remove `key` from index. Caller must hold the lock.
+        size = self._entries.pop(key, None)
+        if size is not None:
+            self.total_bytes -= size
+
+    def _evict(self):
+        # remove least recently used entries until we are in budget.
+        # Caller must hold the lock.
+        while self.total_bytes > self.max_bytes and self._entries:
+            key, size = self._entries.popitem(last=False)
+            self.total_bytes -= size
+            self.evictions += 1
+            try:
+                os.unlink(self.get_path(key))
+            except OSError:
+                pass  # already removed, maybe by other process
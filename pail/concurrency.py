@@ -0,0 +1,347 @@
+"""
+Concurrency
+-----------
+
+Components to run resize jobs outside of request threads.
+"""
+import multiprocessing
+import threading
+from pail.helpers import get_image_size, resize_data
+try:
+    from concurrent import futures
+    from concurrent.futures import process as futures_process
+except ImportError:                     # pragma: no cover
+    futures = futures_process = None    # pragma: no cover
+
+#: Raised when a worker process died. The Python 2 backport of
+#: `concurrent.futures` has no such exception.
+BrokenProcessPool = getattr(
+    futures_process, 'BrokenProcessPool', RuntimeError)
+
+
+#: Returned by `ResizePool.run()` for jobs that were rejected, timed
+#: out or lost their worker process.
+NO_RESULT = object()
+
+
+def get_executor(workers, processes=True):
+    """Get an executor running jobs in `workers` processes.
+
+    If processes are not available on the running platform (or
+    `processes` is false), an executor using threads is returned.
+    """
+    if futures is None:                         # pragma: no cover
+        raise ValueError('worker pools require `concurrent.futures`')
+    if processes:
+        try:
+            return futures.ProcessPoolExecutor(workers)
+        except (ImportError, NotImplementedError, OSError):
+            pass  # no working multiprocessing here
+    return futures.ThreadPoolExecutor(workers)
+
+
+class ResizePool(object):
+    """A pool of workers to run resize jobs.
+
+    Jobs are run in `workers` separate processes, so they do not
+    compete for the GIL with request threads. If processes are not
+    available on the running platform (or `processes` is false),
+    threads are used instead.
+
+    At most `workers` plus `queue_size` jobs are accepted at the same
+    time. Further jobs are rejected. Callers wait at most `timeout`
+    seconds for results (forever, if `timeout` is ``None``).
+
+    If a worker process dies (killed when out of memory, crashed in
+    a codec), the workers are replaced by new ones.
+    """
+
+    def __init__(self, workers, queue_size=0, timeout=None, processes=True):
+        self.workers = workers
+        self.timeout = timeout
+        self.rejected = 0
+        self.timeouts = 0
+        self.failures = 0
+        self.executor = get_executor(workers, processes)
+        self._slots = threading.BoundedSemaphore(workers + queue_size)
+        self._lock = threading.Lock()
+
+    @property
+    def uses_processes(self):
+        return isinstance(self.executor, futures.ProcessPoolExecutor)
+
+    def submit(self, func, *args):
+        """Submit a job calling `func` with `args`.
+
+        Returns a future or ``None`` if the job was rejected because
+        the pool is busy.
+        """
+        if not self._slots.acquire(False):
+            self.rejected += 1
+            return None
+        try:
+            future = self.executor.submit(func, *args)
+        except:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda future: self._slots.release())
+        return future
+
+    def run(self, func, *args):
+        """Call `func` with `args` in the pool and wait for the result.
+
+        Returns the result of `func` or `NO_RESULT` if the job was
+        rejected, the result was not ready in time or a worker process
+        died. Exceptions raised by `func` are raised again.
+        """
+        executor = self.executor
+        try:
+            future = self.submit(func, *args)
+            if future is None:
+                return NO_RESULT
+            return future.result(self.timeout)
+        except futures.TimeoutError:
+            future.cancel()
+            self.timeouts += 1
+            return NO_RESULT
+        except BrokenProcessPool:
+            self.failures += 1
+            self.replace_executor(executor)
+            return NO_RESULT
+
+    def replace_executor(self, broken):
+        """Replace the executor `broken`, whose workers died.
+
+        If other threads replaced `broken` already, nothing is done.
+        """
+        with self._lock:
+            if self.executor is not broken:
+                return
+            self.executor = get_executor(self.workers, self.uses_processes)
+        broken.shutdown(wait=False)
+
+    def get_stats(self):
+        """Get a dict with usage counters of this pool.
+        """
+        return dict(rejected=self.rejected, timeouts=self.timeouts,
+                    failures=self.failures)
+
+    def shutdown(self):
+        """Stop all workers after running the pending jobs.
+        """
+        self.executor.shutdown(wait=True)
+
+
+class AdmissionControl(object):
+    """Limit the resize work done at the same time.
+
+    At most `max_jobs` jobs are admitted at the same time and the
+    sizes of the images processed by admitted jobs must not sum up to
+    more than `max_bytes`. A single job is always admitted if no other
+    job is running. Limits set to zero are not checked.
+
+    Jobs not admitted are counted as `shed`.
+    """
+
+    def __init__(self, max_jobs=0, max_bytes=0):
+        self.max_jobs = max_jobs
+        self.max_bytes = max_bytes
+        self.jobs = 0
+        self.bytes = 0
+        self.shed = 0
+        self._lock = threading.Lock()
+
+    def acquire(self, size):
+        """Try to admit a job processing `size` bytes.
+
+        Returns ``True`` if the job was admitted. Admitted jobs must
+        call :meth:`release` with the same `size` when done.
+        """
+        with self._lock:
+            if (self.max_jobs and self.jobs >= self.max_jobs) or (
+                    self.max_bytes and self.jobs and
+                    self.bytes + size > self.max_bytes):
+                self.shed += 1
+                return False
+            self.jobs += 1
+            self.bytes += size
+            return True
+
+    def release(self, size):
+        """Mark a job processing `size` bytes as done.
+        """
+        with self._lock:
+            self.jobs -= 1
+            self.bytes -= size
+
+
+class _Call(object):
+    # a function call in progress, maybe waited for by several threads
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """Coalesce concurrent calls of functions with the same key.
+
+    While a call for some key is running, other calls with the same
+    key do not run their function but wait for the running call and
+    get its result.
+    """
+
+    def __init__(self):
+        self.coalesced = 0
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func, *args):
+        """Call `func` with `args`, unless a call for `key` is running.
+
+        Returns the result of `func` or the result of the call already
+        running for `key`. Exceptions are passed on to all callers.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            running = call is not None
+            if running:
+                self.coalesced += 1
+            else:
+                call = self._calls[key] = _Call()
+        if running:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = func(*args)
+        except Exception as exc:
+            call.error = exc
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+        return call.result
+
+
+def resize_source(source, resolutions, fast_decode=False, output_format=None,
+                  profiles=None):
+    """Resize `source` to all `resolutions`.
+
+    `source` is the path of an image file or the image data (bytes).
+    Works like :func:`pail.helpers.resize_data`, but raises `IOError`
+    if `source` is no readable image.
+    """
+    data = source
+    if not isinstance(source, bytes):
+        with open(source, 'rb') as fd:
+            data = fd.read()
+    if get_image_size(data) is None:
+        raise IOError('cannot identify image')
+    return resize_data(data, resolutions, fast_decode, output_format, profiles)
+
+
+def map_unordered(func, args, workers, processes=True):
+    """Call `func` with each tuple of arguments from `args`.
+
+    `args` is consumed lazily: at most two calls per worker are in
+    work or waiting for it at the same time. The calls run in
+    `workers` processes (see :func:`get_executor` for `processes`).
+
+    Yields tuples ``(<ARGS>, <RESULT>, <EXCEPTION>)`` in the order the
+    calls are done. ``<EXCEPTION>`` is ``None`` for calls that
+    succeeded.
+
+    If a worker process dies, all calls in work fail with
+    `BrokenProcessPool`. The workers are replaced then and these calls
+    are run again, one after another, so that only the call killing
+    its worker is reported as failed.
+    """
+    executor = get_executor(workers, processes)
+    pending = dict()    # future -> (args, executor, alone)
+    suspects = []       # args of calls in work when a worker died
+    args = iter(args)
+
+    def submit(call_args, alone=False):
+        future = executor.submit(func, *call_args)
+        pending[future] = (call_args, executor, alone)
+
+    try:
+        while True:
+            if suspects:
+                if not pending:
+                    submit(suspects.pop(0), alone=True)
+            else:
+                for call_args in args:
+                    try:
+                        submit(call_args)
+                    except BrokenProcessPool:
+                        executor.shutdown(wait=False)
+                        executor = get_executor(workers, processes)
+                        submit(call_args)
+                    if len(pending) >= workers * 2:
+                        break
+            if not pending:
+                break
+            done, not_done = futures.wait(
+                pending, return_when=futures.FIRST_COMPLETED)
+            for future in done:
+                call_args, used, alone = pending.pop(future)
+                try:
+                    result = future.result()
+                except BrokenProcessPool as exc:
+                    if used is executor:
+                        executor.shutdown(wait=False)
+                        executor = get_executor(workers, processes)
+                    if alone:
+                        yield call_args, None, exc
+                    else:
+                        suspects.append(call_args)
+                    continue
+                except Exception as exc:
+                    yield call_args, None, exc
+                    continue
+                yield call_args, result, None
+    finally:
+        for future in pending:
+            future.cancel()
+        executor.shutdown()
+
+
+def resize_many(sources, resolutions, workers=None, fast_decode=False,
+                output_format=None, profiles=None, processes=True):
+    """Resize all images from `sources` to all `resolutions`.
+
+    `sources` is an iterable of image paths or image data (bytes). It
+    is consumed lazily: at most two images per worker are in work or
+    waiting for it at the same time. On Python 2 pass paths as
+    unicode strings.
+
+    The images are resized in `workers` processes (one per CPU by
+    default, see :func:`get_executor` for `processes`). For the other
+    arguments see :func:`pail.helpers.resize_all`.
+
+    Yields tuples
+
+      ``(<SOURCE>, <RESOLUTION>, <FORMAT>, <DATA>)``
+
+    in the order the images are done. Resolutions greater or equal to
+    the width of an image are skipped. If an image cannot be resized,
+    ``(<SOURCE>, None, None, <EXCEPTION>)`` is yielded and the other
+    images are processed as usual. This includes images killing their
+    worker process (see :func:`map_unordered`).
+    """
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    args = ((source, resolutions, fast_decode, output_format, profiles)
+            for source in sources)
+    for call_args, result, exc in map_unordered(
+            resize_source, args, workers, processes):
+        source = call_args[0]
+        if exc is not None:
+            yield source, None, None, exc
+            continue
+        for resolution, format, data in result:
+            yield source, resolution, format, data
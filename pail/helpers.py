@@ -5,23 +5,91 @@ Helper Functions
 Minor helper functions.
 
 """
-import tempfile
+import bisect
+import time
+from io import BytesIO
 from PIL import Image
+from pail.cache import LRUCache
+try:
+    # imported for its side effect: registers AVIF with older Pillows
+    __import__('pillow_avif')
+except ImportError:
+    pass
 
+#: Clock used to measure durations (see :class:`Timings`).
+timer = getattr(time, 'perf_counter', time.time)
 
-def resize(image, resolution=None, client_resolution=None, enlarge=False):
+#: Content types of image formats we deliver.
+MIME_TYPES = {
+    'AVIF': 'image/avif',
+    'GIF': 'image/gif',
+    'JPEG': 'image/jpeg',
+    'PNG': 'image/png',
+    'WEBP': 'image/webp',
+    }
+
+#: Encoder profiles available by name. A profile is a dict of encoder
+#: options, see :func:`get_save_options`. More profiles can be defined
+#: with :func:`to_profiles`.
+ENCODER_PROFILES = {
+    'default': {},
+    'compact': dict(quality=70, optimize=True, progressive=True,
+                    strip=True),
+    'high': dict(quality=90, optimize=True, progressive=True),
+    }
+
+#: Encoder options and functions to convert their values.
+PROFILE_OPTIONS = {
+    'quality': int,
+    'compress_level': int,
+    'optimize': 'bool',
+    'progressive': 'bool',
+    'strip': 'bool',
+    }
+
+#: Encoder options understood by the different formats.
+FORMAT_OPTIONS = {
+    'AVIF': ('quality', 'strip'),
+    'GIF': ('optimize', ),
+    'JPEG': ('quality', 'optimize', 'progressive', 'strip'),
+    'PNG': ('optimize', 'compress_level', 'strip'),
+    'WEBP': ('quality', 'strip'),
+    }
+
+#: Maximum number of lookups remembered by a `ResolutionTable`.
+MAX_RESOLUTION_LOOKUPS = 1024
+
+#: When shrinking images in fast mode, they are first reduced cheaply
+#: to at least this factor times the wanted size. The rest is done by
+#: high-quality resampling.
+REDUCING_GAP = 2
+
+
+def resize(image, resolution=None, client_resolution=None, enlarge=False,
+           fast_decode=False, output_format=None, profile=None):
     """Resize `image` to have width `resolution`.
 
     `image` can be a path or some open file descriptor.
 
     `resolution` gives the desired maximum width in pixels.
 
+    If `fast_decode` is set, large images are shrunk cheaply before
+    the final resampling (see :func:`reduce_image`). This is much
+    faster for large images and gives visually equivalent results.
+
+    If `output_format` is given (a format name like ``'WEBP'``), the
+    resized image is stored in this format, if that results in a
+    smaller file than the format of `image`.
+
+    `profile` is a dict of encoder options (see
+    :func:`get_save_options`). By default the Pillow defaults are used.
+
     Returns ``None`` or a tuple
 
       ``(<FORMAT>, <RESULT_FILE_FD>)``
 
     with ``<FORMAT>`` being an image type as determined by PIL and
-    ``<RESULT_FILE_FD>`` being an opened temporary file.
+    ``<RESULT_FILE_FD>`` being an open in-memory file.
 
     If the image is already narrower than `resolution`, `None`
     is returned.
@@ -31,25 +99,233 @@ def resize(image, resolution=None, client_resolution=None, enlarge=False):
     """
     if resolution is None:
         return None
+    result = resize_all(image, [resolution], fast_decode=fast_decode,
+                        output_format=output_format,
+                        profiles=[(None, profile or {})])
+    if not result:
+        return None
+    return result[0][1:]
+
+
+def resize_all(image, resolutions, fast_decode=False, output_format=None,
+               profiles=None, timings=None):
+    """Resize `image` to all widths given in `resolutions`.
+
+    The image is decoded only once. Then the resized versions are
+    created one after another, each one from the preceding, larger
+    one.
+
+    `image` can be a path or some open file descriptor.
+
+    `resolutions` is a list of widths in pixels. Widths greater or
+    equal to the image width are skipped. For `fast_decode` and
+    `output_format` see :func:`resize`. `profiles` selects encoder
+    options per resolution, see :func:`get_profile`.
+
+    If `timings` (a :class:`Timings` instance) is given, the time
+    spent on decoding, resampling and encoding is added to the
+    stages ``decode``, ``resample`` and ``encode``.
+
+    Returns a list of tuples
+
+      ``(<RESOLUTION>, <FORMAT>, <RESULT_FILE_FD>)``
+
+    sorted by resolution, largest first. The list is empty if the
+    image cannot be read.
+    """
+    start = timer()
     try:
         im = Image.open(image)
     except IOError:
-        return None
+        return []
     size_x, size_y = im.size
-    if size_x <= resolution:
-        return None
-    res_x = resolution
-    res_y = resolution * size_y / size_x
     format = im.format
+    resolutions = sorted(
+        set([x for x in resolutions if 0 < x < size_x]), reverse=True)
+    if fast_decode and resolutions:
+        im = reduce_image(
+            im, int(resolutions[0]), int(resolutions[0] * size_y / size_x))
+    if timings is not None and resolutions:
+        im.load()  # decode here, not in the first `resize()`
+        start = timings.since('decode', start)
+    result = []
+    for resolution in resolutions:
+        res_x = resolution
+        res_y = resolution * size_y / size_x
+
+        #  create the resized version.
+        im = im.resize((int(res_x), int(res_y)), Image.ANTIALIAS)
+        if timings is not None:
+            start = timings.since('resample', start)
+
+        #  save it to a temporary file.
+        profile = get_profile(profiles, resolution)
+        new_format, new_file = format, save_image(im, format, profile)
+        if output_format and output_format != format:
+            other_file = save_image(im, output_format, profile)
+            if get_file_length(other_file) < get_file_length(new_file):
+                new_format, new_file = output_format, other_file
+        if timings is not None:
+            start = timings.since('encode', start)
+        result.append((resolution, new_format, new_file))
+    return result
+
 
-    #  create the resized version.
-    new_im = im.resize((int(res_x), int(res_y)), Image.ANTIALIAS)
+def save_image(im, format, profile=None):
+    """Save `im` in `format` to an in-memory file.
 
-    #  save it to a temporary file.
-    new_file = tempfile.TemporaryFile()
-    new_im.save(new_file, format)
+    `profile` is a dict of encoder options, see
+    :func:`get_save_options`.
+
+    Returns the file, ready for reading.
+    """
+    # resized images are small; a disk file would cost only syscalls.
+    new_file = BytesIO()
+    im.save(new_file, format, **get_save_options(im, format, profile))
     new_file.seek(0)
-    return format, new_file
+    return new_file
+
+
+def get_save_options(im, format, profile):
+    """Get the keywords for saving `im` in `format` with `profile`.
+
+    `profile` is a dict that may contain
+
+    `quality`
+      the encoder quality (JPEG, WebP and AVIF).
+
+    `optimize`
+      compute optimal encoder tables (JPEG, PNG, GIF). Gives smaller
+      files but needs more time.
+
+    `progressive`
+      write progressive JPEGs.
+
+    `compress_level`
+      the zlib compression level for PNGs (0-9).
+
+    `strip`
+      if true, EXIF data and ICC profiles are removed. If false, they
+      are kept where the format supports it. If not set, the Pillow
+      defaults apply.
+
+    Options not supported by `format` are skipped.
+    """
+    options = dict()
+    for name in FORMAT_OPTIONS.get(format, ()):
+        if name not in (profile or {}):
+            continue
+        if name != 'strip':
+            options[name] = profile[name]
+        elif profile[name]:
+            options.update(exif=b'', icc_profile=None)
+        else:
+            for key in ('exif', 'icc_profile'):
+                if im.info.get(key):
+                    options[key] = im.info[key]
+    return options
+
+
+def get_profile(profiles, resolution):
+    """Get the encoder profile to use for `resolution`.
+
+    `profiles` is a list of tuples ``(<MAX_WIDTH>, <PROFILE>)``
+    sorted by ``<MAX_WIDTH>``. The first profile with ``<MAX_WIDTH>``
+    greater or equal to `resolution` is returned. ``<MAX_WIDTH>`` may
+    be ``None`` (at the end of the list) for a profile used for all
+    other resolutions.
+
+    Returns a profile dict, which is empty if no profile matches.
+    """
+    for max_width, profile in profiles or ():
+        if max_width is None or resolution <= max_width:
+            return profile
+    return {}
+
+
+def resize_data(data, resolutions, fast_decode=False, output_format=None,
+                profiles=None):
+    """Resize the image contained in `data` to all `resolutions`.
+
+    Works like :func:`resize_all` but takes the raw image bytes and
+    returns a list of tuples
+
+      ``(<RESOLUTION>, <FORMAT>, <RESULT_BYTES>)``
+
+    As arguments and results can be pickled, this function is
+    suitable to be run in other processes.
+    """
+    return [(resolution, format, new_file.read())
+            for resolution, format, new_file in resize_all(
+                BytesIO(data), resolutions, fast_decode=fast_decode,
+                output_format=output_format, profiles=profiles)]
+
+
+def reduce_image(im, width, height):
+    """Shrink `im` cheaply, keeping it larger than `width` x `height`.
+
+    JPEGs are decoded in draft mode, where the decoder itself scales
+    the image by 1/2, 1/4 or 1/8. Other images are reduced by an
+    integer factor using box filtering.
+
+    In both cases the result is kept at least `REDUCING_GAP` times as
+    large as the wanted size, so that the final resampling can still
+    produce a high quality image.
+
+    Returns the reduced image, which might be `im` itself.
+    """
+    min_size = (width * REDUCING_GAP, height * REDUCING_GAP)
+    if im.format == 'JPEG':
+        im.draft(im.mode, min_size)
+    factor = im.size[0] // min_size[0]
+    if factor > 1 and hasattr(im, 'reduce') and im.mode not in ('1', 'P'):
+        im = im.reduce(factor)
+    return im
+
+
+def get_image_size(data):
+    """Get the size of the image contained in `data`.
+
+    `data` are the raw bytes of an image file. It is sufficient to
+    pass only the first bytes of an image, containing its header.
+
+    Returns a tuple ``(<WIDTH>, <HEIGHT>)`` or ``None`` if the size
+    cannot be determined from `data`, for instance because the header
+    is incomplete.
+    """
+    try:
+        # `open()` reads only the header, the image is not decoded.
+        return Image.open(BytesIO(data)).size
+    except Exception:
+        # truncated headers result in various exception types.
+        return None
+
+
+def get_image_format(data):
+    """Get the format of the image contained in `data`.
+
+    Only the first bytes of `data` are examined, the image is not
+    parsed. Returns a format name like ``'JPEG'`` or ``None`` for
+    formats not listed in `MIME_TYPES`.
+    """
+    if data[:3] == b'\xff\xd8\xff':
+        return 'JPEG'
+    if data[:8] == b'\x89PNG\r\n\x1a\n':
+        return 'PNG'
+    if data[:4] == b'GIF8':
+        return 'GIF'
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'WEBP'
+    if data[4:12] in (b'ftypavif', b'ftypavis'):
+        return 'AVIF'
+    return None
+
+
+def can_save(format):
+    """Tell whether the installed Pillow can save images in `format`.
+    """
+    Image.init()
+    return format in Image.SAVE
 
 
 def get_file_length(fd):
@@ -69,6 +345,22 @@ def get_file_length(fd):
     return length
 
 
+def to_bool(string):
+    """Turn a string like `'true'` or `'off'` into a boolean.
+
+    Booleans are returned unchanged. Raises `ValueError` for
+    unrecognized values.
+    """
+    if isinstance(string, bool):
+        return string
+    value = string.strip().lower()
+    if value in ('true', 'yes', 'on', '1'):
+        return True
+    if value in ('false', 'no', 'off', '0', ''):
+        return False
+    raise ValueError('not a boolean value: %r' % string)
+
+
 def to_int_list(string):
     """Try to turn a string into a list of integers.
 
@@ -81,6 +373,36 @@ def to_int_list(string):
     return [int(x) for x in string.split(',')]
 
 
+def to_profiles(string):
+    """Turn a string into a dict of encoder profiles.
+
+    Each line of `string` defines a profile: its name followed by
+    options like ``quality=70``, separated by whitespace::
+
+      small quality=60 optimize=true strip=true
+      large quality=85 progressive=true
+
+    See :func:`get_save_options` for the options. Raises `ValueError`
+    for unknown options or invalid values.
+    """
+    result = dict()
+    for line in string.splitlines():
+        words = line.split()
+        if not words:
+            continue
+        profile = dict()
+        for word in words[1:]:
+            name, _, value = word.partition('=')
+            convert = PROFILE_OPTIONS.get(name)
+            if convert is None:
+                raise ValueError('unknown encoder option: %s' % name)
+            if convert == 'bool':
+                convert = to_bool
+            profile[name] = convert(value)
+        result[words[0]] = profile
+    return result
+
+
 def get_resolution(client_width, pixel_density, resolution_list,
                    is_mobile=True):
     """Get the desired resolution based on the input parameters.
@@ -101,13 +423,104 @@ def get_resolution(client_width, pixel_density, resolution_list,
        mobile device. If so and no `client_width` is given, then the
        lowest possible resolution (based on `resolution_list`) is
        returned.
+
+    `resolution_list` is not modified. If you need many lookups for
+    the same `resolution_list`, use a :class:`ResolutionTable`.
     """
-    if client_width is None:
-        return is_mobile and min(resolution_list) or max(resolution_list)
-    possible_values = resolution_list
-    possible_values.append(max( max(resolution_list), client_width))
-    total_width = client_width * pixel_density
-    result = [x * pixel_density for x in possible_values
-              if total_width <= x * pixel_density]
-    result = min(result + [max(possible_values) * pixel_density])
-    return result
+    return ResolutionTable(resolution_list, 0).lookup(
+        client_width, pixel_density, is_mobile)
+
+
+class ResolutionTable(object):
+    """Lookup of desired resolutions for a fixed list of resolutions.
+
+    `resolutions` is a list of supported screen widths. They are
+    sorted once, so that lookups need only a binary search. Results of
+    the latest `max_lookups` lookups are remembered.
+
+    If `max_dpr` is given, pixel densities are capped to this
+    value. If `snap` is true, results are always one of
+    `resolutions`: the smallest one not less than the computed width
+    or the largest one. This way only few different variants of an
+    image are requested.
+    """
+
+    def __init__(self, resolutions, max_lookups=MAX_RESOLUTION_LOOKUPS,
+                 max_dpr=None, snap=False):
+        self.resolutions = tuple(sorted(set(resolutions)))
+        self.max_dpr = max_dpr
+        self.snap = snap
+        self._memo = None
+        if max_lookups > 0:
+            self._memo = LRUCache(max_lookups)
+
+    def lookup(self, client_width, pixel_density=1, is_mobile=True):
+        """Get the desired resolution.
+
+        See :func:`get_resolution` for the parameters and the result.
+        """
+        if client_width is None:
+            return is_mobile and self.resolutions[0] or self.resolutions[-1]
+        if self._memo is None:
+            return self._lookup(client_width, pixel_density)
+        key = (client_width, pixel_density)
+        result = self._memo.get(key)
+        if result is None:
+            result = self._lookup(client_width, pixel_density)
+            self._memo.set(key, result)
+        return result
+
+    def _lookup(self, client_width, pixel_density):
+        # the smallest resolution not less than `client_width` or
+        # `client_width` itself, if all resolutions are smaller.
+        if self.max_dpr and pixel_density > self.max_dpr:
+            pixel_density = self.max_dpr
+        index = bisect.bisect_left(self.resolutions, client_width)
+        width = client_width
+        if index < len(self.resolutions):
+            width = self.resolutions[index]
+        width = width * pixel_density
+        if self.snap:
+            index = bisect.bisect_left(self.resolutions, width)
+            width = self.resolutions[min(index, len(self.resolutions) - 1)]
+        return width
+
+
+class Timings(object):
+    """Durations of processing stages, like ``decode`` or ``encode``.
+
+    Durations of a stage measured several times are added up. Stages
+    are kept in the order they were measured first.
+    """
+
+    def __init__(self):
+        self.names = []
+        self.durations = dict()
+
+    def add(self, name, seconds):
+        """Add `seconds` to the duration of stage `name`.
+        """
+        if name not in self.durations:
+            self.names.append(name)
+            self.durations[name] = 0.0
+        self.durations[name] += seconds
+
+    def since(self, name, start):
+        """Add the time passed since `start` to stage `name`.
+
+        `start` is a value of :func:`timer`. Returns the current
+        :func:`timer` value, which can serve as start of the next
+        stage.
+        """
+        now = timer()
+        self.add(name, now - start)
+        return now
+
+    def get_header(self):
+        """Get the durations as value of a `Server-Timing` header.
+
+        Durations are given in milliseconds, like
+        ``upstream;dur=1.2, decode;dur=10.5``.
+        """
+        return ', '.join('%s;dur=%.1f' % (name, self.durations[name] * 1000)
+                         for name in self.names)
@@ -0,0 +1,243 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from pail.cache import (
+    DiskCache, LRUCache, MemoryCache, TieredCache, make_key)
+
+
+class MakeKeyTests(unittest.TestCase):
+
+    def test_make_key(self):
+        # keys are hex digests usable as filenames
+        key = make_key('/foo.jpg', '"etag"', 480)
+        self.assertEqual(len(key), 40)
+        self.assertEqual(key, make_key('/foo.jpg', '"etag"', 480))
+        return
+
+    def test_make_key_differs(self):
+        # different parts result in different keys
+        self.assertNotEqual(
+            make_key('/foo.jpg', 480), make_key('/foo.jpg', 481))
+        self.assertNotEqual(
+            make_key('/a', 'bc'), make_key('/ab', 'c'))
+        return
+
+
+class LRUCacheTests(unittest.TestCase):
+
+    def test_get_set(self):
+        # we can store and retrieve values
+        memo = LRUCache(10)
+        self.assertEqual(memo.get('foo'), None)
+        self.assertEqual(memo.get('foo', 'default'), 'default')
+        memo.set('foo', 'bar')
+        self.assertEqual(memo.get('foo'), 'bar')
+        self.assertEqual(len(memo), 1)
+        return
+
+    def test_max_entries(self):
+        # least recently used entries are removed first
+        memo = LRUCache(2)
+        memo.set('a', 1)
+        memo.set('b', 2)
+        memo.get('a')
+        memo.set('c', 3)
+        self.assertEqual(len(memo), 2)
+        self.assertEqual(memo.get('b'), None)
+        self.assertEqual(memo.get('a'), 1)
+        return
+
+
+class MemoryCacheTests(unittest.TestCase):
+
+    def test_get_missing(self):
+        # unknown keys result in None
+        cache = MemoryCache(100)
+        self.assertEqual(cache.get('foo'), None)
+        self.assertEqual(cache.misses, 1)
+        return
+
+    def test_set_get(self):
+        # we can store and retrieve data
+        cache = MemoryCache(100)
+        cache.set('foo', b'1234567890')
+        self.assertEqual(cache.get('foo'), b'1234567890')
+        self.assertEqual(cache.hits, 1)
+        self.assertEqual(cache.total_bytes, 10)
+        return
+
+    def test_set_overwrite(self):
+        # overwriting an entry does not count twice
+        cache = MemoryCache(100)
+        cache.set('foo', b'1234567890')
+        cache.set('foo', b'12345')
+        self.assertEqual(cache.total_bytes, 5)
+        return
+
+    def test_set_too_large(self):
+        # entries larger than the whole cache are not stored
+        cache = MemoryCache(5)
+        cache.set('foo', b'1234567890')
+        self.assertEqual(cache.get('foo'), None)
+        self.assertEqual(cache.total_bytes, 0)
+        return
+
+    def test_evict_lru(self):
+        # least recently used entries are removed first
+        cache = MemoryCache(25)
+        cache.set('1', b'1' * 10)
+        cache.set('2', b'2' * 10)
+        cache.get('1')             # '2' is now least recently used
+        cache.set('3', b'3' * 10)
+        self.assertEqual(cache.get('2'), None)
+        self.assertEqual(cache.get('1'), b'1' * 10)
+        self.assertEqual(cache.evictions, 1)
+        self.assertEqual(cache.total_bytes, 20)
+        return
+
+    def test_get_stats(self):
+        # we can get all counters at once
+        cache = MemoryCache(100)
+        cache.set('foo', b'123')
+        cache.get('foo')
+        cache.get('bar')
+        self.assertEqual(
+            cache.get_stats(),
+            dict(entries=1, bytes=3, hits=1, misses=1, evictions=0))
+        return
+
+
+class TieredCacheTests(unittest.TestCase):
+
+    def test_set_stores_everywhere(self):
+        # new entries are stored in all caches
+        cache1, cache2 = MemoryCache(100), MemoryCache(100)
+        cache = TieredCache([cache1, cache2])
+        cache.set('foo', b'123')
+        self.assertEqual(cache1.get('foo'), b'123')
+        self.assertEqual(cache2.get('foo'), b'123')
+        return
+
+    def test_get_promotes(self):
+        # entries found in slower caches are copied to faster ones
+        cache1, cache2 = MemoryCache(100), MemoryCache(100)
+        cache = TieredCache([cache1, cache2])
+        cache2.set('foo', b'123')
+        self.assertEqual(cache.get('foo'), b'123')
+        self.assertEqual(cache1.get('foo'), b'123')
+        self.assertEqual(cache.get('bar'), None)
+        return
+
+
+class DiskCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.tempdir, 'cache')
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_create_cache_dir(self):
+        # the cache dir is created if it does not exist
+        DiskCache(self.cache_dir, 100)
+        self.assertTrue(os.path.isdir(self.cache_dir))
+        return
+
+    def test_get_missing(self):
+        # unknown keys result in None
+        cache = DiskCache(self.cache_dir, 100)
+        self.assertEqual(cache.get(make_key('foo')), None)
+        return
+
+    def test_set_get(self):
+        # we can store and retrieve data
+        cache = DiskCache(self.cache_dir, 100)
+        key = make_key('foo')
+        cache.set(key, b'1234567890')
+        self.assertEqual(cache.get(key), b'1234567890')
+        self.assertEqual(cache.total_bytes, 10)
+        self.assertTrue(os.path.isfile(cache.get_path(key)))
+        return
+
+    def test_set_overwrite(self):
+        # overwriting an entry does not count twice
+        cache = DiskCache(self.cache_dir, 100)
+        key = make_key('foo')
+        cache.set(key, b'1234567890')
+        cache.set(key, b'12345')
+        self.assertEqual(cache.get(key), b'12345')
+        self.assertEqual(cache.total_bytes, 5)
+        return
+
+    def test_set_too_large(self):
+        # entries larger than the whole cache are not stored
+        cache = DiskCache(self.cache_dir, 5)
+        key = make_key('foo')
+        cache.set(key, b'1234567890')
+        self.assertEqual(cache.get(key), None)
+        self.assertEqual(cache.total_bytes, 0)
+        return
+
+    def test_evict_lru(self):
+        # least recently used entries are removed first
+        cache = DiskCache(self.cache_dir, 25)
+        key1, key2, key3 = make_key(1), make_key(2), make_key(3)
+        cache.set(key1, b'1' * 10)
+        cache.set(key2, b'2' * 10)
+        cache.get(key1)             # key2 is now least recently used
+        cache.set(key3, b'3' * 10)
+        self.assertEqual(cache.get(key2), None)
+        self.assertEqual(cache.get(key1), b'1' * 10)
+        self.assertEqual(cache.get(key3), b'3' * 10)
+        self.assertFalse(os.path.exists(cache.get_path(key2)))
+        self.assertEqual(cache.total_bytes, 20)
+        return
+
+    def test_shared_cache_dir(self):
+        # entries written by other processes count after a rescan
+        cache1 = DiskCache(self.cache_dir, 25, rescan_bytes=20)
+        cache2 = DiskCache(self.cache_dir, 25, rescan_bytes=20)
+        key1, key2, key3 = make_key(1), make_key(2), make_key(3)
+        cache1.set(key1, b'1' * 10)
+        past = time.time() - 10
+        os.utime(cache1.get_path(key1), (past, past))
+        cache2.set(key2, b'2' * 10)
+        cache2.set(key3, b'3' * 10)     # cache2 rescans, finds key1
+        self.assertEqual(cache2.rescans, 1)
+        self.assertEqual(cache2.total_bytes, 20)
+        self.assertFalse(os.path.exists(cache1.get_path(key1)))
+        cache1.rescan()
+        self.assertEqual(cache1.total_bytes, 20)
+        self.assertEqual(cache1.get(key3), b'3' * 10)
+        return
+
+    def test_no_temp_files_left(self):
+        # after writing, only the final entry exists
+        cache = DiskCache(self.cache_dir, 100)
+        key = make_key('foo')
+        cache.set(key, b'1234567890')
+        self.assertEqual(
+            os.listdir(os.path.dirname(cache.get_path(key))), [key])
+        return
+
+    def test_load_existing(self):
+        # entries from former runs are found and counted
+        cache = DiskCache(self.cache_dir, 100)
+        key = make_key('foo')
+        cache.set(key, b'1234567890')
+        cache = DiskCache(self.cache_dir, 100)
+        self.assertEqual(cache.total_bytes, 10)
+        self.assertEqual(cache.get(key), b'1234567890')
+        return
+
+    def test_load_existing_over_budget(self):
+        # if the budget was lowered, old entries are removed on startup
+        cache = DiskCache(self.cache_dir, 100)
+        cache.set(make_key(1), b'1' * 10)
+        cache.set(make_key(2), b'2' * 10)
+        cache = DiskCache(self.cache_dir, 15)
+        self.assertEqual(cache.total_bytes, 10)
+        return
@@ -0,0 +1,284 @@
+import os
+import threading
+import time
+import unittest
+from PIL import Image
+from pail.concurrency import (
+    NO_RESULT, AdmissionControl, BrokenProcessPool, ResizePool, SingleFlight,
+    map_unordered, resize_many, resize_source)
+from pail.helpers import resize_data
+try:
+    from cStringIO import StringIO
+except ImportError:                     # pragma: no cover
+    from io import BytesIO as StringIO  # pragma: no cover
+
+SAMPLE_JPG = os.path.join(os.path.dirname(__file__), 'lena.jpg')
+
+DATA_JPEG = open(SAMPLE_JPG, 'rb').read()
+
+
+def add(a, b):
+    return a + b
+
+
+def die():
+    # a job killing its worker process
+    os._exit(1)
+
+
+def slow_or_die(num):
+    # a job killing its worker process for zero, slow otherwise
+    if num == 0:
+        die()
+    time.sleep(0.2)
+    return num
+
+
+class ResizePoolTests(unittest.TestCase):
+
+    def setUp(self):
+        self.pools = []
+        self.event = threading.Event()
+
+    def tearDown(self):
+        self.event.set()
+        for pool in self.pools:
+            pool.shutdown()
+
+    def get_pool(self, *args, **kw):
+        pool = ResizePool(*args, **kw)
+        self.pools.append(pool)
+        return pool
+
+    def wait(self):
+        # a job blocking until the test ends
+        self.event.wait(5)
+
+    def test_run_threads(self):
+        # we can run jobs in threads
+        pool = self.get_pool(1, processes=False)
+        self.assertEqual(pool.uses_processes, False)
+        self.assertEqual(pool.run(add, 1, 2), 3)
+        return
+
+    def test_run_processes(self):
+        # we can run resize jobs in other processes
+        pool = self.get_pool(1)
+        self.assertEqual(pool.uses_processes, True)
+        result = pool.run(resize_data, DATA_JPEG, [64])
+        self.assertEqual(result[0][:2], (64, 'JPEG'))
+        self.assertEqual(Image.open(StringIO(result[0][2])).size, (64, 64))
+        return
+
+    def test_run_exception(self):
+        # exceptions raised by jobs are passed on
+        pool = self.get_pool(1, processes=False)
+        self.assertRaises(TypeError, pool.run, add, 1, 'a')
+        return
+
+    def test_reject_when_busy(self):
+        # jobs are rejected if all workers and queue slots are taken
+        pool = self.get_pool(1, queue_size=1, processes=False)
+        self.assertTrue(pool.submit(self.wait) is not None)
+        self.assertTrue(pool.submit(self.wait) is not None)
+        self.assertEqual(pool.submit(self.wait), None)
+        self.assertTrue(pool.run(add, 1, 2) is NO_RESULT)
+        self.assertEqual(pool.get_stats()['rejected'], 2)
+        return
+
+    def test_slots_released(self):
+        # finished jobs free their slots
+        pool = self.get_pool(1, queue_size=0, processes=False)
+        for num in range(3):
+            self.assertEqual(pool.run(add, num, 1), num + 1)
+        self.assertEqual(pool.rejected, 0)
+        return
+
+    def test_timeout(self):
+        # if jobs take too long, we get no result
+        pool = self.get_pool(1, timeout=0.01, processes=False)
+        self.assertTrue(pool.run(self.wait) is NO_RESULT)
+        self.assertEqual(pool.get_stats()['timeouts'], 1)
+        return
+
+    def test_worker_died(self):
+        # if a worker process dies, we get no result and new workers
+        pool = self.get_pool(1)
+        self.assertTrue(pool.run(die) is NO_RESULT)
+        self.assertEqual(pool.get_stats()['failures'], 1)
+        self.assertEqual(pool.uses_processes, True)
+        self.assertEqual(pool.run(add, 1, 2), 3)
+        return
+
+
+class SingleFlightTests(unittest.TestCase):
+
+    def setUp(self):
+        self.flights = SingleFlight()
+        self.started = threading.Event()
+        self.proceed = threading.Event()
+        self.calls = 0
+
+    def slow_func(self, value):
+        self.calls += 1
+        self.started.set()
+        self.proceed.wait(5)
+        if value is None:
+            raise ValueError('no value')
+        return value
+
+    def run_concurrently(self, value, num=5):
+        # run `num` calls for the same key, return results
+        results = []
+
+        def call():
+            try:
+                results.append(self.flights.do('key', self.slow_func, value))
+            except ValueError as exc:
+                results.append(exc)
+        first = threading.Thread(target=call)
+        first.start()
+        self.started.wait(5)
+        others = [threading.Thread(target=call) for x in range(num - 1)]
+        for thread in others:
+            thread.start()
+        while self.flights.coalesced < num - 1:
+            time.sleep(0.001)
+        self.proceed.set()
+        for thread in [first] + others:
+            thread.join(5)
+        return results
+
+    def test_do(self):
+        # a single call simply runs the function
+        self.proceed.set()
+        self.assertEqual(self.flights.do('key', self.slow_func, 1), 1)
+        self.assertEqual(self.calls, 1)
+        return
+
+    def test_do_concurrently(self):
+        # concurrent calls with the same key run the function only once
+        results = self.run_concurrently('result')
+        self.assertEqual(results, ['result'] * 5)
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(self.flights.coalesced, 4)
+        return
+
+    def test_do_concurrently_exception(self):
+        # exceptions are passed to all waiting callers
+        results = self.run_concurrently(None, num=3)
+        self.assertEqual(len(results), 3)
+        self.assertTrue(all(isinstance(x, ValueError) for x in results))
+        self.assertEqual(self.calls, 1)
+        return
+
+    def test_do_sequentially(self):
+        # finished calls are not reused
+        self.proceed.set()
+        self.flights.do('key', self.slow_func, 1)
+        self.assertEqual(self.flights.do('key', self.slow_func, 2), 2)
+        self.assertEqual(self.calls, 2)
+        return
+
+
+class AdmissionControlTests(unittest.TestCase):
+
+    def test_no_limits(self):
+        # w/o limits everything is admitted
+        admission = AdmissionControl()
+        for num in range(10):
+            self.assertEqual(admission.acquire(1000), True)
+        self.assertEqual(admission.jobs, 10)
+        self.assertEqual(admission.bytes, 10000)
+        return
+
+    def test_max_jobs(self):
+        # we can limit the number of concurrent jobs
+        admission = AdmissionControl(max_jobs=2)
+        self.assertEqual(admission.acquire(1), True)
+        self.assertEqual(admission.acquire(1), True)
+        self.assertEqual(admission.acquire(1), False)
+        admission.release(1)
+        self.assertEqual(admission.acquire(1), True)
+        self.assertEqual(admission.shed, 1)
+        return
+
+    def test_max_bytes(self):
+        # we can limit the number of bytes processed concurrently
+        admission = AdmissionControl(max_bytes=100)
+        self.assertEqual(admission.acquire(60), True)
+        self.assertEqual(admission.acquire(60), False)
+        self.assertEqual(admission.acquire(40), True)
+        admission.release(60)
+        admission.release(40)
+        self.assertEqual(admission.bytes, 0)
+        self.assertEqual(admission.shed, 1)
+        return
+
+    def test_max_bytes_single_job(self):
+        # a single job is admitted, even if it exceeds the byte limit
+        admission = AdmissionControl(max_bytes=100)
+        self.assertEqual(admission.acquire(1000), True)
+        self.assertEqual(admission.acquire(1), False)
+        return
+
+
+class ResizeManyTests(unittest.TestCase):
+
+    def test_resize_source(self):
+        # we can resize paths and image data
+        for source in (SAMPLE_JPG, DATA_JPEG):
+            result = resize_source(source, [64, 32])
+            self.assertEqual([x[:2] for x in result],
+                             [(64, 'JPEG'), (32, 'JPEG')])
+        self.assertRaises(IOError, resize_source, b'no image', [64])
+        return
+
+    def test_resize_many(self):
+        # we get all variants of all images
+        result = list(resize_many(
+            [SAMPLE_JPG, DATA_JPEG], [64, 32, 256], workers=2))
+        self.assertEqual(len(result), 4)
+        self.assertEqual(
+            sorted([(x[0] == SAMPLE_JPG, x[1], x[2]) for x in result]),
+            [(False, 32, 'JPEG'), (False, 64, 'JPEG'),
+             (True, 32, 'JPEG'), (True, 64, 'JPEG')])
+        self.assertEqual(
+            Image.open(StringIO(result[0][3])).size[0], result[0][1])
+        return
+
+    def test_resize_many_errors(self):
+        # errors are reported per image
+        result = list(resize_many(
+            [b'no image', 'not-a-path', DATA_JPEG], [64], workers=1,
+            processes=False))
+        errors = [x for x in result if x[1] is None]
+        self.assertEqual(len(errors), 2)
+        self.assertTrue(isinstance(errors[0][3], (IOError, OSError)))
+        self.assertEqual([x[1] for x in result if x[1]], [64])
+        return
+
+    def test_map_unordered_worker_died(self):
+        # only the call killing its worker fails, the others are rerun
+        result = list(map_unordered(
+            slow_or_die, [(num, ) for num in [1, 2, 0, 3, 4, 5]], 2))
+        self.assertEqual(
+            sorted([(x[0][0], x[1]) for x in result]),
+            [(0, None), (1, 1), (2, 2), (3, 3), (4, 4), (5, 5)])
+        self.assertTrue(isinstance(
+            [x[2] for x in result if x[0] == (0, )][0], BrokenProcessPool))
+        return
+
+    def test_resize_many_lazy(self):
+        # sources are consumed only as needed
+        consumed = []
+
+        def sources():
+            for num in range(100):
+                consumed.append(num)
+                yield DATA_JPEG
+        results = resize_many(sources(), [64], workers=1, processes=False)
+        next(results)
+        self.assertTrue(len(consumed) <= 3)
+        results.close()
+        return
@@ -2,13 +2,34 @@ import os
 import shutil
 import tempfile
 import unittest
-from PIL import Image
-from pail.helpers import resize, get_file_length, to_int_list, get_resolution
+from PIL import Image, ImageChops, ImageDraw, ImageStat
+from pail.helpers import (
+    resize, resize_all, reduce_image, get_file_length, to_bool, to_int_list,
+    to_profiles, get_profile, get_resolution, get_image_format,
+    get_image_size, get_save_options, ResolutionTable, Timings)
 
 sample_jpg = os.path.join(os.path.dirname(__file__), 'lena.jpg')
 sample_png = os.path.join(os.path.dirname(__file__), 'lena.png')
 
 
+def create_image(path, size=(1600, 1200), format='JPEG', mode='RGB'):
+    # create a synthetic photo-like image
+    width, height = size
+    im = Image.linear_gradient('L').resize(size).convert(mode)
+    draw = ImageDraw.Draw(im)
+    for num in range(0, width, width // 8):
+        draw.ellipse((num, num // 2, num + width // 6, num // 2 + height // 4),
+                     fill=(num % 256, 128, 255 - num % 256)[:len(mode)])
+    im.save(path, format)
+    return path
+
+
+def mean_difference(im1, im2):
+    # get the average difference of pixel values in two images
+    diff = ImageChops.difference(im1.convert('RGB'), im2.convert('RGB'))
+    return sum(ImageStat.Stat(diff).mean) / 3.0
+
+
 class HelperTests(unittest.TestCase):
 
     def setUp(self):
@@ -53,6 +74,230 @@ class HelperTests(unittest.TestCase):
             resize(broken, 64), None)
         return
 
+    def test_resize_fast_decode(self):
+        # in fast mode we get images of the requested size
+        im_type, result = resize(sample_jpg, 64, fast_decode=True)
+        self.assertEqual(Image.open(result).size, (64, 64))
+        self.assertEqual(im_type, 'JPEG')
+        return
+
+    def test_resize_fast_decode_equivalent_jpeg(self):
+        # fast mode results look like normal results
+        path = create_image(os.path.join(self.tempdir, 'large.jpg'))
+        im_type1, result1 = resize(path, 200)
+        im_type2, result2 = resize(path, 200, fast_decode=True)
+        im1, im2 = Image.open(result1), Image.open(result2)
+        self.assertEqual(im1.size, (200, 150))
+        self.assertEqual(im2.size, (200, 150))
+        self.assertTrue(mean_difference(im1, im2) < 2.0)
+        return
+
+    def test_resize_fast_decode_equivalent_png(self):
+        # fast mode results look like normal results also for PNGs
+        path = create_image(
+            os.path.join(self.tempdir, 'large.png'), format='PNG')
+        im_type1, result1 = resize(path, 200)
+        im_type2, result2 = resize(path, 200, fast_decode=True)
+        im1, im2 = Image.open(result1), Image.open(result2)
+        self.assertEqual(im_type2, 'PNG')
+        self.assertEqual(im2.size, (200, 150))
+        self.assertTrue(mean_difference(im1, im2) < 2.0)
+        return
+
+    def test_resize_all(self):
+        # we can get several resized versions at once
+        result = resize_all(sample_jpg, [32, 64, 16])
+        self.assertEqual([x[0] for x in result], [64, 32, 16])
+        self.assertEqual([x[1] for x in result], ['JPEG'] * 3)
+        self.assertEqual(
+            [Image.open(x[2]).size for x in result],
+            [(64, 64), (32, 32), (16, 16)])
+        return
+
+    def test_resize_all_timings(self):
+        # we can measure the time spent in the different stages
+        timings = Timings()
+        resize_all(sample_jpg, [32, 64], timings=timings)
+        self.assertEqual(timings.names, ['decode', 'resample', 'encode'])
+        self.assertTrue(all(x >= 0 for x in timings.durations.values()))
+        return
+
+    def test_resize_all_too_small(self):
+        # resolutions >= image width are skipped
+        result = resize_all(sample_jpg, [256, 128, 64])
+        self.assertEqual([x[0] for x in result], [64])
+        self.assertEqual(resize_all(sample_jpg, [128, 0, -1]), [])
+        return
+
+    def test_resize_all_fast_decode(self):
+        # also in fast mode we get all resolutions
+        path = create_image(os.path.join(self.tempdir, 'large.jpg'))
+        result = resize_all(path, [800, 200, 400], fast_decode=True)
+        self.assertEqual(
+            [Image.open(x[2]).size for x in result],
+            [(800, 600), (400, 300), (200, 150)])
+        return
+
+    def test_resize_all_output_format(self):
+        # we can get resized images in other formats if they are smaller
+        result = resize_all(sample_png, [64, 32], output_format='WEBP')
+        self.assertEqual([x[1] for x in result], ['WEBP'] * 2)
+        self.assertEqual(Image.open(result[0][2]).format, 'WEBP')
+        result = resize_all(sample_png, [64], output_format='PNG')
+        self.assertEqual(result[0][1], 'PNG')
+        return
+
+    def test_resize_all_output_format_larger(self):
+        # the source format is kept if it results in smaller files
+        path = os.path.join(self.tempdir, 'bilevel.png')
+        Image.new('1', (200, 150)).save(path, 'PNG')
+        result = resize_all(path, [100], output_format='WEBP')
+        self.assertEqual(result[0][1], 'PNG')
+        self.assertEqual(Image.open(result[0][2]).format, 'PNG')
+        return
+
+    def test_resize_profile(self):
+        # we can pass encoder options
+        path = create_image(os.path.join(self.tempdir, 'large.jpg'))
+        im_type, result1 = resize(path, 400)
+        im_type, result2 = resize(
+            path, 400, profile=dict(quality=30, progressive=True))
+        self.assertTrue(
+            get_file_length(result2) < get_file_length(result1))
+        self.assertTrue(Image.open(result2).info.get('progressive'))
+        self.assertFalse(Image.open(result1).info.get('progressive'))
+        return
+
+    def test_resize_all_profiles(self):
+        # profiles are selected by resolution
+        path = create_image(os.path.join(self.tempdir, 'large.jpg'))
+        profiles = [(200, dict(progressive=True)), (None, dict())]
+        result = resize_all(path, [200, 400], profiles=profiles)
+        self.assertFalse(Image.open(result[0][2]).info.get('progressive'))
+        self.assertTrue(Image.open(result[1][2]).info.get('progressive'))
+        return
+
+    def test_resize_all_invalid_img_path(self):
+        # unreadable images result in an empty list
+        self.assertEqual(resize_all('not-a-path', [64]), [])
+        return
+
+    def test_reduce_image_jpeg(self):
+        # JPEGs are decoded in draft mode
+        path = create_image(os.path.join(self.tempdir, 'large.jpg'))
+        im = reduce_image(Image.open(path), 200, 150)
+        self.assertEqual(im.size, (400, 300))
+        return
+
+    def test_reduce_image_other(self):
+        # other images are reduced by integer factors
+        path = create_image(
+            os.path.join(self.tempdir, 'large.png'), format='PNG')
+        im = reduce_image(Image.open(path), 300, 225)
+        self.assertEqual(im.size, (800, 600))
+        return
+
+    def test_reduce_image_small(self):
+        # images not much larger than wanted are left alone
+        im = Image.open(sample_png)
+        self.assertTrue(reduce_image(im, 64, 64) is im)
+        return
+
+    def test_reduce_image_palette(self):
+        # palette images are left alone
+        im = Image.new('P', (1000, 1000))
+        self.assertTrue(reduce_image(im, 100, 100) is im)
+        return
+
+    def test_get_image_size(self):
+        # we can get the size of images from their raw data
+        for path in (sample_jpg, sample_png):
+            with open(path, 'rb') as fd:
+                self.assertEqual(get_image_size(fd.read()), (128, 128))
+        return
+
+    def test_get_image_size_header_only(self):
+        # the image header is sufficient to get the size
+        with open(sample_jpg, 'rb') as fd:
+            data = fd.read()
+        self.assertEqual(get_image_size(data[:1024]), (128, 128))
+        return
+
+    def test_get_image_size_incomplete(self):
+        # incomplete headers or non-images result in None
+        with open(sample_jpg, 'rb') as fd:
+            data = fd.read()
+        self.assertEqual(get_image_size(data[:20]), None)
+        self.assertEqual(get_image_size(b'blah blah'), None)
+        self.assertEqual(get_image_size(b''), None)
+        return
+
+    def test_get_image_format(self):
+        # we can detect image formats by their first bytes
+        for format in ('JPEG', 'PNG', 'GIF', 'WEBP'):
+            path = os.path.join(self.tempdir, 'image')
+            Image.new('RGB', (10, 10)).save(path, format)
+            with open(path, 'rb') as fd:
+                self.assertEqual(get_image_format(fd.read(16)), format)
+        self.assertEqual(
+            get_image_format(b'\x00\x00\x00\x1cftypavif\x00\x00'), 'AVIF')
+        self.assertEqual(get_image_format(b'blah blah'), None)
+        self.assertEqual(get_image_format(b''), None)
+        return
+
+    def test_get_save_options(self):
+        # profiles are turned into options supported by the format
+        im = Image.new('RGB', (10, 10))
+        profile = dict(quality=60, compress_level=9, optimize=True)
+        self.assertEqual(get_save_options(im, 'JPEG', profile),
+                         dict(quality=60, optimize=True))
+        self.assertEqual(get_save_options(im, 'PNG', profile),
+                         dict(compress_level=9, optimize=True))
+        self.assertEqual(get_save_options(im, 'JPEG', None), dict())
+        return
+
+    def test_get_save_options_strip(self):
+        # metadata can be removed or kept
+        im = Image.new('RGB', (10, 10))
+        im.info.update(exif=b'Exif\x00\x00', icc_profile=b'ICC')
+        self.assertEqual(get_save_options(im, 'JPEG', dict(strip=True)),
+                         dict(exif=b'', icc_profile=None))
+        self.assertEqual(get_save_options(im, 'JPEG', dict(strip=False)),
+                         dict(exif=b'Exif\x00\x00', icc_profile=b'ICC'))
+        self.assertEqual(get_save_options(im, 'GIF', dict(strip=True)),
+                         dict())
+        return
+
+    def test_strip_metadata(self):
+        # stripped images contain no ICC profile
+        path = os.path.join(self.tempdir, 'icc.png')
+        Image.new('RGB', (200, 150)).save(path, 'PNG', icc_profile=b'ICC')
+        im_type, result = resize(path, 100)
+        self.assertEqual(Image.open(result).info.get('icc_profile'), b'ICC')
+        im_type, result = resize(path, 100, profile=dict(strip=True))
+        self.assertEqual(Image.open(result).info.get('icc_profile'), None)
+        return
+
+    def test_get_profile(self):
+        # we get the profile for the smallest matching width
+        profiles = [(200, 'small'), (400, 'medium'), (None, 'large')]
+        self.assertEqual(get_profile(profiles, 100), 'small')
+        self.assertEqual(get_profile(profiles, 200), 'small')
+        self.assertEqual(get_profile(profiles, 201), 'medium')
+        self.assertEqual(get_profile(profiles, 1000), 'large')
+        self.assertEqual(get_profile(profiles[:1], 1000), {})
+        self.assertEqual(get_profile(None, 1000), {})
+        return
+
+    def test_to_profiles(self):
+        # we can parse profile definitions
+        self.assertEqual(
+            to_profiles('\n small quality=60 strip=yes\n\n large\n'),
+            dict(small=dict(quality=60, strip=True), large=dict()))
+        self.assertRaises(ValueError, to_profiles, 'small speed=3')
+        self.assertRaises(ValueError, to_profiles, 'small quality=high')
+        return
+
     def test_get_file_length(self):
         # make sure get_file_length works as expected
         path = os.path.join(self.tempdir, 'testfile1')
@@ -71,6 +316,15 @@ class HelperTests(unittest.TestCase):
             get_file_length(open(path, 'rb')), 0)
         return
 
+    def test_to_bool(self):
+        # we can turn strings into booleans
+        for value in ('true', 'True', 'yes', 'on', '1', True):
+            self.assertEqual(to_bool(value), True)
+        for value in ('false', 'no', 'OFF', '0', '', False):
+            self.assertEqual(to_bool(value), False)
+        self.assertRaises(ValueError, to_bool, 'maybe')
+        return
+
     def test_to_int_list(self):
         # we can turn strings into lists of integers
         self.assertEqual(to_int_list('1, 2, 3'), [1, 2, 3])
@@ -110,3 +364,84 @@ class HelperTests(unittest.TestCase):
         self.assertEqual(  # > 2 x 922
             get_resolution(2000, 2, [480, 768, 922]), 4000)
         return
+
+    def test_get_resolution_list_unchanged(self):
+        # the passed resolution list is not modified
+        resolutions = [480, 768, 922]
+        get_resolution(1000, 1, resolutions)
+        self.assertEqual(resolutions, [480, 768, 922])
+        # so former lookups do not change later ones
+        self.assertEqual(get_resolution(960, 1, resolutions), 960)
+        return
+
+
+class TimingsTests(unittest.TestCase):
+
+    def test_add(self):
+        # durations of stages are added up, stages keep their order
+        timings = Timings()
+        timings.add('upstream', 0.002)
+        timings.add('decode', 0.01)
+        timings.add('upstream', 0.001)
+        self.assertEqual(timings.names, ['upstream', 'decode'])
+        self.assertAlmostEqual(timings.durations['upstream'], 0.003)
+        return
+
+    def test_since(self):
+        # we can measure the time since some start
+        timings = Timings()
+        start = timings.since('decode', 0.0)
+        self.assertEqual(timings.durations['decode'], start)
+        return
+
+    def test_get_header(self):
+        # we can get durations as Server-Timing header value
+        timings = Timings()
+        self.assertEqual(timings.get_header(), '')
+        timings.add('upstream', 0.0012)
+        timings.add('encode', 0.25)
+        self.assertEqual(
+            timings.get_header(), 'upstream;dur=1.2, encode;dur=250.0')
+        return
+
+
+class ResolutionTableTests(unittest.TestCase):
+
+    def test_lookup(self):
+        # we get the same results as from get_resolution()
+        table = ResolutionTable([922, 480, 768, 480])
+        self.assertEqual(table.resolutions, (480, 768, 922))
+        for width in (None, 1, 480, 481, 922, 923, 2000):
+            for density in (1, 2, 1.5):
+                for is_mobile in (True, False):
+                    self.assertEqual(
+                        table.lookup(width, density, is_mobile),
+                        get_resolution(
+                            width, density, [480, 768, 922], is_mobile))
+        return
+
+    def test_lookup_memo(self):
+        # lookups are remembered, but only the latest ones
+        table = ResolutionTable([480, 768], max_lookups=2)
+        for width in range(100):
+            self.assertEqual(table.lookup(width, 2), 960)
+        self.assertEqual(len(table._memo), 2)
+        self.assertEqual(table.lookup(1000, 1), 1000)
+        return
+
+    def test_lookup_max_dpr(self):
+        # pixel densities can be capped
+        table = ResolutionTable([480, 768], max_dpr=2)
+        self.assertEqual(table.lookup(480, 3), 960)
+        self.assertEqual(table.lookup(480, 1.5), 720)
+        return
+
+    def test_lookup_snap(self):
+        # results can be snapped to the resolutions
+        table = ResolutionTable([480, 768, 1536], snap=True)
+        self.assertEqual(table.lookup(480, 1.5), 768)
+        self.assertEqual(table.lookup(768, 2), 1536)
+        self.assertEqual(table.lookup(768, 3), 1536)
+        self.assertEqual(table.lookup(2000, 1), 1536)
+        self.assertEqual(table.lookup(None, 1, True), 480)
+        return
@@ -0,0 +1,178 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from io import BytesIO
+from PIL import Image
+from webob import Request
+from webob.static import DirectoryApp
+from pail import warm
+from pail.warm import (
+    CacheWarmer, find_images, get_middleware_options, main, resize_file)
+from pail.wsgi import CACHED, ImageAdaptingMiddleware
+try:
+    from cStringIO import StringIO
+except ImportError:                     # pragma: no cover
+    from io import StringIO             # pragma: no cover
+
+SAMPLE_JPG = os.path.join(os.path.dirname(__file__), 'lena.jpg')
+SAMPLE_PNG = os.path.join(os.path.dirname(__file__), 'lena.png')
+
+
+def resize_or_die(path, *args):
+    # resize `path`, unless it is named like a crash
+    if os.path.basename(path) == 'crash.jpg':
+        os._exit(1)
+    return resize_file(path, *args)
+
+
+class WarmTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.root = os.path.join(self.tempdir, 'static')
+        self.cache_dir = os.path.join(self.tempdir, 'cache')
+        os.makedirs(os.path.join(self.root, 'sub dir'))
+        shutil.copy(SAMPLE_JPG, os.path.join(self.root, 'a.jpg'))
+        shutil.copy(SAMPLE_PNG, os.path.join(self.root, 'sub dir', 'b.png'))
+        with open(os.path.join(self.root, 'notes.txt'), 'w') as fd:
+            fd.write('not an image')
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def get_middleware(self, app=None, **kw):
+        return ImageAdaptingMiddleware(
+            app, {}, resolutions='64, 32', cache_dir=self.cache_dir,
+            cache_key='content', **kw)
+
+    def test_find_images(self):
+        # we find images in a stable order
+        self.assertEqual(
+            list(find_images(self.root, ['image/jpeg', 'image/png'])),
+            [os.path.join(self.root, 'a.jpg'),
+             os.path.join(self.root, 'sub dir', 'b.png')])
+        return
+
+    def test_resize_file(self):
+        # we get variants for the given keys
+        result = resize_file(
+            SAMPLE_JPG, [(None, {64: 'key64', 256: 'key256'}),
+                         ('WEBP', {32: 'key32'})])
+        self.assertEqual([x[0] for x in result], ['key64', 'key32'])
+        self.assertEqual(
+            Image.open(BytesIO(result[1][1])).format, 'WEBP')
+        return
+
+    def test_run(self):
+        # all variants are created
+        warmer = CacheWarmer(self.get_middleware(), self.root)
+        warmer.run(find_images(self.root, ['image/jpeg', 'image/png']))
+        self.assertEqual(
+            (warmer.images, warmer.created, warmer.skipped), (2, 4, 0))
+        self.assertTrue('2 images, 4 variants created' in
+                        warmer.get_report())
+        return
+
+    def test_run_served_from_cache(self):
+        # the middleware finds the created variants
+        warmer = CacheWarmer(
+            self.get_middleware(), self.root, url_prefix='/static/')
+        warmer.run(find_images(self.root, ['image/jpeg', 'image/png']))
+        app = self.get_middleware(app=DirectoryApp(self.root))
+        for path in ('/a.jpg', '/sub%20dir/b.png'):
+            request = Request.blank(path, script_name='/static')
+            request.headers['Cookie'] = 'resolution=32; $Path=/'
+            response, decision = app.adapt(request, 32)
+            self.assertEqual(decision, CACHED)
+        return
+
+    def test_run_output_formats(self):
+        # variants for output formats are created as well
+        warmer = CacheWarmer(
+            self.get_middleware(output_formats='webp'), self.root)
+        warmer.run([os.path.join(self.root, 'a.jpg')])
+        self.assertEqual(warmer.created, 4)
+        return
+
+    def test_run_again(self):
+        # existing variants are skipped
+        warmer = CacheWarmer(self.get_middleware(), self.root)
+        warmer.run([os.path.join(self.root, 'a.jpg')])
+        warmer = CacheWarmer(self.get_middleware(), self.root)
+        warmer.run(find_images(self.root, ['image/jpeg', 'image/png']))
+        self.assertEqual((warmer.created, warmer.skipped), (2, 2))
+        return
+
+    def test_run_failures(self):
+        # broken images are reported, other images are handled
+        path = os.path.join(self.root, 'broken.jpg')
+        with open(SAMPLE_JPG, 'rb') as fd:
+            data = fd.read()
+        with open(path, 'wb') as fd:
+            fd.write(data[:len(data) // 2])
+        warmer = CacheWarmer(self.get_middleware(), self.root)
+        log = StringIO()
+        warmer.run(
+            [path, os.path.join(self.root, 'a.jpg')], log=log)
+        self.assertEqual((warmer.created, warmer.failed), (2, 1))
+        self.assertTrue(log.getvalue().startswith(path))
+        return
+
+    def test_run_worker_died(self):
+        # images killing their worker are reported, others are handled
+        path = os.path.join(self.root, 'crash.jpg')
+        shutil.copy(SAMPLE_JPG, path)
+        paths = [path, os.path.join(self.root, 'a.jpg'),
+                 os.path.join(self.root, 'sub dir', 'b.png')]
+        warmer = CacheWarmer(self.get_middleware(), self.root, workers=2)
+        log = StringIO()
+        warm.resize_file = resize_or_die
+        try:
+            warmer.run(paths, log=log)
+        finally:
+            warm.resize_file = resize_file
+        self.assertEqual((warmer.created, warmer.failed), (4, 1))
+        self.assertTrue(log.getvalue().startswith(path))
+        return
+
+    def test_middleware_requirements(self):
+        # we need a disk cache with content keys
+        self.assertRaises(
+            ValueError, CacheWarmer, ImageAdaptingMiddleware(
+                None, {}, cache_dir=self.cache_dir), self.root)
+        self.assertRaises(
+            ValueError, CacheWarmer, ImageAdaptingMiddleware(
+                None, {}, cache_key='content'), self.root)
+        return
+
+    def test_get_middleware_options(self):
+        # we can read middleware options from paste configs
+        path = os.path.join(self.tempdir, 'paste.ini')
+        with open(path, 'w') as fd:
+            fd.write('[DEFAULT]\ndebug = true\n\n'
+                     '[filter-app:main]\nuse = egg:pail\nnext = static\n'
+                     'resolutions = 64, 32\ncache_dir = %(here)s/cache\n')
+        self.assertEqual(
+            get_middleware_options(path),
+            dict(resolutions='64, 32', cache_dir=self.cache_dir))
+        self.assertRaises(
+            ValueError, get_middleware_options, path, 'filter-app:other')
+        return
+
+    def test_main(self):
+        # we can warm caches from the commandline
+        stdout = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            result = main([
+                self.root, '-j', '1', '-o', 'resolutions=64',
+                '-o', 'cache_dir=%s' % self.cache_dir,
+                '-o', 'cache_key=content'])
+            output = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+        self.assertEqual(result, 0)
+        self.assertTrue(output.startswith('2 images, 2 variants created'))
+        return
@@ -1,4 +1,8 @@
 import os
+import shutil
+import tempfile
+import threading
+import time
 import unittest
 from pail.wsgi import ImageAdaptingMiddleware, filter_app
 try:
@@ -6,7 +10,7 @@ try:
 except ImportError:                     # pragma: no cover
     from io import BytesIO as StringIO  # pragma: no cover
 from PIL import Image
-from webob import Request
+from webob import Request, Response
 
 HTML = '''\
 <html>
@@ -29,6 +33,8 @@ DEFAULT_COOKIE = 'resolution=128; $PATH=/'
 
 TEST_RESOLUTIONS = '128, 64, 32'
 
+LAST_MODIFIED = 'Sat, 04 May 2013 03:26:35 GMT'
+
 
 def wsgi_app_plaintext(environ, start_response):
     start_response('200 OK', [('Content-Type', 'text/plain; charset=UTF-8')])
@@ -51,6 +57,15 @@ def wsgi_app_img_jpg(environ, start_response):
     return [DATA_JPEG]
 
 
+def wsgi_app_img_jpg_validators(environ, start_response):
+    start_response('200 OK', [('Content-Type', 'image/jpeg'),
+                              ('Content-Length', '%s' % len(DATA_JPEG)),
+                              ('ETag', '"orig"'),
+                              ('Last-Modified', LAST_MODIFIED),
+                              ('Cache-Control', 'max-age=60')])
+    return [DATA_JPEG]
+
+
 def wsgi_app_img_gif(environ, start_response):
     start_response('200 OK', [('Content-Type', 'image/gif'),
                               ('Content-Length', '%s' % len(DATA_GIF))])
@@ -63,6 +78,57 @@ def wsgi_app_img_png(environ, start_response):
     return [DATA_PNG]
 
 
+class ChunkedImageApp(object):
+    # a WSGI app delivering DATA_JPEG in small chunks
+    def __init__(self, chunk_size=256, content_length=True):
+        self.chunk_size = chunk_size
+        self.content_length = content_length
+        self.read = 0
+
+    def __call__(self, environ, start_response):
+        headers = [('Content-Type', 'image/jpeg')]
+        if self.content_length:
+            headers.append(('Content-Length', '%s' % len(DATA_JPEG)))
+        start_response('200 OK', headers)
+        return self.chunks()
+
+    def chunks(self):
+        for start in range(0, len(DATA_JPEG), self.chunk_size):
+            self.read += 1
+            yield DATA_JPEG[start:start + self.chunk_size]
+
+
+class LazyApp(object):
+    # a WSGI app calling start_response only when iterated
+    def __init__(self, content_type='video/mp4', chunks=100, use_write=False):
+        self.content_type = content_type
+        self.chunks = chunks
+        self.use_write = use_write
+        self.read = 0
+        self.closed = False
+
+    def __call__(self, environ, start_response):
+        return LazyAppIter(self, start_response)
+
+
+class LazyAppIter(object):
+    def __init__(self, app, start_response):
+        self.app = app
+        self.start_response = start_response
+
+    def __iter__(self):
+        write = self.start_response(
+            '200 OK', [('Content-Type', self.app.content_type)])
+        if self.app.use_write:
+            write(b'written')
+        for num in range(self.app.chunks):
+            self.app.read += 1
+            yield b'x' * 1024
+
+    def close(self):
+        self.app.closed = True
+
+
 class WSGITests(unittest.TestCase):
 
     def get_request(self, cookie=DEFAULT_COOKIE):
@@ -196,13 +262,116 @@ class WSGITests(unittest.TestCase):
         app = ImageAdaptingMiddleware(
             wsgi_app_img_jpg, {}, resolutions="64, 32")
         request = self.get_request(cookie=None)
-        request.headers['HTTP_USER_AGENT'] = 'amaya/9.51 libwww/5.4.0'
+        request.headers['User-Agent'] = 'amaya/9.51 libwww/5.4.0'
         response = request.get_response(app)
         img_data = response.body
         image = Image.open(StringIO(img_data))
         self.assertEqual(image.size, (64, 64))
         return
 
+    def test_stream_non_images(self):
+        # bodies of non-images are not read by the middleware
+        upstream = LazyApp()
+        app = ImageAdaptingMiddleware(upstream, {})
+        request = self.get_request()
+        status_headers = []
+        app_iter = app(request.environ,
+                       lambda status, headers: status_headers.append(status))
+        self.assertEqual(status_headers, ['200 OK'])
+        self.assertEqual(upstream.read, 1)
+        self.assertEqual(len(b''.join(app_iter)), 100 * 1024)
+        self.assertEqual(upstream.read, 100)
+        app_iter.close()
+        self.assertTrue(upstream.closed)
+        return
+
+    def test_stream_with_write(self):
+        # chunks passed to `write()` by the upstream app are kept
+        upstream = LazyApp(chunks=2, use_write=True)
+        app = ImageAdaptingMiddleware(upstream, {})
+        response = self.get_request().get_response(app)
+        self.assertEqual(response.body, b'written' + b'x' * 2048)
+        return
+
+    def test_stream_eager_app_iter(self):
+        # results of apps calling start_response early are passed on
+        app_iter = [b'Hi!']
+
+        def upstream(environ, start_response):
+            start_response('200 OK', [('Content-Type', 'text/plain')])
+            return app_iter
+        app = ImageAdaptingMiddleware(upstream, {})
+        result = app(self.get_request().environ, lambda *args: None)
+        self.assertTrue(result is app_iter)
+        return
+
+    def test_max_source_bytes(self):
+        # images larger than `max_source_bytes` are not touched
+        app = ImageAdaptingMiddleware(
+            wsgi_app_img_jpg, {}, resolutions=TEST_RESOLUTIONS,
+            max_source_bytes='%s' % (len(DATA_JPEG) - 1))
+        request = self.get_request(cookie='resolution=62; $Path=/')
+        response = request.get_response(app)
+        self.assertEqual(response.body, DATA_JPEG)
+        return
+
+    def test_probe_small_image(self):
+        # images already small enough are not buffered
+        upstream = ChunkedImageApp()
+        app = ImageAdaptingMiddleware(upstream, {}, resolutions='512')
+        app.create_resized_image = None  # must not be called
+        request = self.get_request(cookie='resolution=512; $Path=/')
+        app_iter = app(request.environ, lambda *args: None)
+        self.assertTrue(upstream.read < 5)
+        self.assertEqual(b''.join(app_iter), DATA_JPEG)
+        return
+
+    def test_probe_large_image(self):
+        # images larger than the resolution are still resized
+        app = ImageAdaptingMiddleware(
+            ChunkedImageApp(), {}, resolutions=TEST_RESOLUTIONS)
+        request = self.get_request(cookie='resolution=62; $Path=/')
+        response = request.get_response(app)
+        image = Image.open(StringIO(response.body))
+        self.assertEqual(image.size, (64, 64))
+        return
+
+    def test_probe_disabled(self):
+        # with `probe_bytes` set to zero, images are buffered at once
+        upstream = ChunkedImageApp()
+        app = ImageAdaptingMiddleware(
+            upstream, {}, resolutions='512', probe_bytes='0')
+        request = self.get_request(cookie='resolution=512; $Path=/')
+        response = request.get_response(app)
+        self.assertEqual(response.body, DATA_JPEG)
+        self.assertEqual(upstream.read, len(DATA_JPEG) // 256 + 1)
+        return
+
+    def test_shed_original(self):
+        # if too busy and w/o cache, we get the original image
+        app = ImageAdaptingMiddleware(
+            wsgi_app_img_jpg, {}, resolutions=TEST_RESOLUTIONS,
+            max_concurrent_resizes='1')
+        app.admission.acquire(1)  # some other resize is running
+        request = self.get_request(cookie='resolution=62; $Path=/')
+        response = request.get_response(app)
+        self.assertEqual(response.body, DATA_JPEG)
+        self.assertEqual(app.get_stats()['shed'], 1)
+        return
+
+    def test_shed_by_bytes(self):
+        # we can limit the bytes of images resized at the same time
+        app = ImageAdaptingMiddleware(
+            wsgi_app_img_jpg, {}, resolutions=TEST_RESOLUTIONS,
+            max_resize_bytes='%s' % len(DATA_JPEG))
+        request = self.get_request(cookie='resolution=62; $Path=/')
+        response = request.get_response(app)
+        self.assertEqual(Image.open(StringIO(response.body)).size, (64, 64))
+        app.admission.acquire(1)  # some other resize is running
+        response = request.get_response(app)
+        self.assertEqual(response.body, DATA_JPEG)
+        return
+
     def test_mobile_client(self):
         # mobile clients get the smallest resolution in resolution
         # list.
@@ -210,7 +379,7 @@ class WSGITests(unittest.TestCase):
             wsgi_app_img_jpg, {}, resolutions="64, 32")
         request = self.get_request(cookie=None)
         request.headers[
-            'HTTP_USER_AGENT'] = 'BlackBerry7730/3.7.1 UP.Link/5.1.2.5'
+            'User-Agent'] = 'BlackBerry7730/3.7.1 UP.Link/5.1.2.5'
         response = request.get_response(app)
         img_data = response.body
         image = Image.open(StringIO(img_data))
@@ -218,6 +387,1103 @@ class WSGITests(unittest.TestCase):
         return
 
 
+class BufferingTests(unittest.TestCase):
+    # tests for buffering image bodies before resizing
+
+    def get_response(self, wsgi_app, **kw):
+        app = ImageAdaptingMiddleware(
+            wsgi_app, {}, resolutions=TEST_RESOLUTIONS, **kw)
+        request = Request.blank('http://localhost/test.jpg')
+        request.headers['Cookie'] = 'resolution=62; $Path=/'
+        return app, request.get_response(app)
+
+    def test_small_in_memory(self):
+        # small bodies are buffered in memory, as a single bytes object
+        app = ImageAdaptingMiddleware(None, {})
+        response = Response(body=DATA_JPEG)
+        body_file = app.get_body_file(response)
+        self.assertEqual(body_file.read(), DATA_JPEG)
+        self.assertEqual(response.app_iter, [DATA_JPEG])
+        return
+
+    def test_large_spooled(self):
+        # larger bodies are read once into a file serving as body then
+        upstream = ChunkedImageApp()
+        app = ImageAdaptingMiddleware(None, {}, spool_threshold='1000')
+        response = Response(
+            app_iter=upstream({}, lambda *args: None),
+            content_type='image/jpeg', content_length=len(DATA_JPEG))
+        body_file = app.get_body_file(response)
+        reads = upstream.read
+        self.assertEqual(body_file.read(), DATA_JPEG)
+        self.assertEqual(b''.join(response.app_iter), DATA_JPEG)
+        self.assertEqual(response.content_length, len(DATA_JPEG))
+        self.assertEqual(upstream.read, reads)
+        return
+
+    def test_resize_spooled(self):
+        # spooled images are resized
+        app, response = self.get_response(
+            ChunkedImageApp(), spool_threshold='1000')
+        self.assertEqual(Image.open(StringIO(response.body)).size, (64, 64))
+        self.assertEqual(response.app_iter, [response.body])
+        return
+
+    def test_spooled_without_headers(self):
+        # bodies w/o validator and Content-Length are spooled, too
+        for upstream, options in (
+                (ChunkedImageApp(content_length=False), {}),
+                (ChunkedImageApp(), dict(cache_key='content'))):
+            app = ImageAdaptingMiddleware(
+                upstream, {}, resolutions=TEST_RESOLUTIONS,
+                spool_threshold='1000', **options)
+            files = []
+            get_body_file = app.get_body_file
+
+            def recording_get_body_file(response):
+                files.append(get_body_file(response))
+                return files[-1]
+            app.get_body_file = recording_get_body_file
+            request = Request.blank('http://localhost/test.jpg')
+            request.headers['Cookie'] = 'resolution=62; $Path=/'
+            response = request.get_response(app)
+            self.assertEqual(
+                Image.open(StringIO(response.body)).size, (64, 64))
+            self.assertTrue(files)
+            for body_file in files:
+                self.assertTrue(
+                    isinstance(body_file, tempfile.SpooledTemporaryFile))
+        return
+
+    def test_spooled_unchanged(self):
+        # if resizing fails, the spooled original is delivered
+        def wsgi_app(environ, start_response):
+            start_response('200 OK', [('Content-Type', 'image/jpeg'),
+                                      ('Content-Length', '5000')])
+            return [b'x' * 1000] * 5
+        app, response = self.get_response(
+            wsgi_app, spool_threshold='1000', probe_bytes='0')
+        self.assertEqual(response.body, b'x' * 5000)
+        return
+
+    def test_invalid(self):
+        # the threshold must be an integer
+        self.assertRaises(
+            ValueError, ImageAdaptingMiddleware, None, {},
+            spool_threshold='much')
+        return
+
+
+class CacheTests(unittest.TestCase):
+    # tests for the variant cache of ImageAdaptingMiddleware
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def get_app(self, wsgi_app=wsgi_app_img_jpg, **kw):
+        # get a middleware that counts created images
+        app = ImageAdaptingMiddleware(
+            wsgi_app, {}, resolutions=TEST_RESOLUTIONS,
+            cache_dir=self.cache_dir, **kw)
+        app.resized = 0
+        create_resized_images = app.create_resized_images
+
+        def counting_create(*args, **kw):
+            app.resized += 1
+            return create_resized_images(*args, **kw)
+        app.create_resized_images = counting_create
+        return app
+
+    def get_request(self, cookie='resolution=62; $Path=/'):
+        request = Request.blank('http://localhost/test.jpg')
+        request.headers['Cookie'] = cookie
+        return request
+
+    def test_cache_miss_and_hit(self):
+        # the second request is served from cache
+        app = self.get_app()
+        response1 = self.get_request().get_response(app)
+        response2 = self.get_request().get_response(app)
+        self.assertEqual(app.resized, 1)
+        self.assertEqual(response1.body, response2.body)
+        self.assertEqual(response2.content_length, len(response2.body))
+        self.assertEqual(
+            Image.open(StringIO(response2.body)).size, (64, 64))
+        return
+
+    def test_cache_hit_closes_upstream(self):
+        # the unread upstream body is closed when serving from cache
+        closed = []
+
+        class ClosingIter(object):
+            def __iter__(self):
+                yield DATA_JPEG
+
+            def close(self):
+                closed.append(True)
+
+        def upstream(environ, start_response):
+            start_response('200 OK', [('Content-Type', 'image/jpeg'),
+                                      ('Last-Modified', LAST_MODIFIED)])
+            return ClosingIter()
+        app = self.get_app(upstream)
+        self.get_request().get_response(app)
+        del closed[:]
+        response = self.get_request().get_response(app)
+        self.assertEqual(app.resized, 1)
+        self.assertEqual(
+            Image.open(StringIO(response.body)).size, (64, 64))
+        self.assertEqual(closed, [True])
+        return
+
+    def test_cache_write_error(self):
+        # errors writing the cache do not fail requests
+        app = self.get_app()
+
+        def failing_set(key, data):
+            raise IOError(28, 'No space left on device')
+        app.cache.set = failing_set
+        response = self.get_request().get_response(app)
+        self.assertEqual(response.status_int, 200)
+        self.assertEqual(
+            Image.open(StringIO(response.body)).size, (64, 64))
+        self.assertEqual(app.get_stats()['cache_errors'], 1)
+        return
+
+    def test_cache_persistent(self):
+        # cached variants survive restarts
+        self.get_request().get_response(self.get_app())
+        app = self.get_app()
+        self.get_request().get_response(app)
+        self.assertEqual(app.resized, 0)
+        return
+
+    def test_cache_per_resolution(self):
+        # different resolutions are cached separately
+        app = self.get_app()
+        self.get_request().get_response(app)
+        response = self.get_request(
+            cookie='resolution=32; $Path=/').get_response(app)
+        self.assertEqual(app.resized, 2)
+        self.assertEqual(
+            Image.open(StringIO(response.body)).size, (32, 32))
+        return
+
+    def test_cache_key_validator(self):
+        # upstream validators are part of the key
+        app = ImageAdaptingMiddleware(None, {})
+        request = self.get_request()
+        response = request.get_response(wsgi_app_img_jpg)
+        key1 = app.get_cache_key(request, response, 64)
+        response.headers['ETag'] = '"1"'
+        key2 = app.get_cache_key(request, response, 64)
+        response.headers['ETag'] = '"2"'
+        key3 = app.get_cache_key(request, response, 64)
+        self.assertEqual(len(set([key1, key2, key3])), 3)
+        return
+
+    def test_cache_key_content(self):
+        # w/o validator the image content is part of the key
+        app = ImageAdaptingMiddleware(None, {})
+        request = self.get_request()
+        key1 = app.get_cache_key(
+            request, request.get_response(wsgi_app_img_jpg), 64)
+        key2 = app.get_cache_key(
+            request, request.get_response(wsgi_app_img_png), 64)
+        self.assertNotEqual(key1, key2)
+        return
+
+    def test_cache_key_content_only(self):
+        # with content keys upstream validators are not part of the key
+        app = ImageAdaptingMiddleware(None, {}, cache_key='content')
+        request = self.get_request()
+        response = request.get_response(wsgi_app_img_jpg)
+        key1 = app.get_cache_key(request, response, 64)
+        response.headers['ETag'] = '"1"'
+        key2 = app.get_cache_key(request, response, 64)
+        self.assertEqual(key1, key2)
+        self.assertRaises(
+            ValueError, ImageAdaptingMiddleware, None, {}, cache_key='etag')
+        return
+
+    def test_memory_cache(self):
+        # we can cache variants in memory only
+        app = ImageAdaptingMiddleware(
+            wsgi_app_img_jpg, {}, resolutions=TEST_RESOLUTIONS,
+            memory_cache_max_bytes='100000')
+        response1 = self.get_request().get_response(app)
+        response2 = self.get_request().get_response(app)
+        self.assertEqual(response1.body, response2.body)
+        self.assertEqual(app.disk_cache, None)
+        stats = app.get_stats()['memory_cache']
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['bytes'], len(response1.body))
+        return
+
+    def test_memory_and_disk_cache(self):
+        # with both caches, variants from disk are kept in memory
+        self.get_request().get_response(self.get_app())
+        app = self.get_app(memory_cache_max_bytes='100000')
+        self.get_request().get_response(app)
+        self.get_request().get_response(app)
+        self.assertEqual(app.resized, 0)
+        stats = app.get_stats()
+        self.assertEqual(stats['disk_cache']['hits'], 1)
+        self.assertEqual(stats['memory_cache']['hits'], 1)
+        return
+
+    def test_generate_all(self):
+        # with `generate_all` all resolutions are cached at once
+        app = self.get_app(generate_all='true')
+        response1 = self.get_request().get_response(app)
+        response2 = self.get_request(
+            cookie='resolution=32; $Path=/').get_response(app)
+        self.assertEqual(app.resized, 1)
+        self.assertEqual(
+            Image.open(StringIO(response1.body)).size, (64, 64))
+        self.assertEqual(
+            Image.open(StringIO(response2.body)).size, (32, 32))
+        self.assertEqual(app.disk_cache.get_stats()['entries'], 2)
+        return
+
+    def test_generate_all_unlisted_resolution(self):
+        # requested resolutions not in list are generated as well
+        app = self.get_app(generate_all='true')
+        request = self.get_request(cookie='resolution=20.3; $Path=/')
+        response = request.get_response(app)
+        self.assertEqual(
+            Image.open(StringIO(response.body)).size, (96, 96))
+        request = self.get_request(cookie='resolution=30; $Path=/')
+        response = request.get_response(app)
+        self.assertEqual(
+            Image.open(StringIO(response.body)).size, (32, 32))
+        self.assertEqual(app.resized, 1)
+        return
+
+    def test_shed_nearest_cached(self):
+        # if too busy, we get the nearest cached variant
+        app = self.get_app(max_concurrent_resizes='1')
+        self.get_request(cookie='resolution=32; $Path=/').get_response(app)
+        app.admission.acquire(1)  # some other resize is running
+        response = self.get_request().get_response(app)
+        self.assertEqual(
+            Image.open(StringIO(response.body)).size, (32, 32))
+        self.assertEqual(response.content_length, len(response.body))
+        self.assertEqual(app.get_stats()['shed'], 1)
+        return
+
+    def test_unresizable_not_cached(self):
+        # images smaller than the resolution are not stored
+        app = self.get_app()
+        self.get_request(
+            cookie='resolution=512; $Path=/').get_response(app)
+        self.assertEqual(app.cache.total_bytes, 0)
+        return
+
+
+class ConditionalRequestTests(unittest.TestCase):
+    # tests for ETag/If-None-Match/If-Modified-Since handling
+
+    def get_app(self, wsgi_app=wsgi_app_img_jpg_validators):
+        app = ImageAdaptingMiddleware(
+            wsgi_app, {}, resolutions=TEST_RESOLUTIONS)
+        app.resized = 0
+        create_resized_images = app.create_resized_images
+
+        def counting_create(*args, **kw):
+            app.resized += 1
+            return create_resized_images(*args, **kw)
+        app.create_resized_images = counting_create
+        return app
+
+    def get_request(self, cookie='resolution=62; $Path=/', **headers):
+        request = Request.blank('http://localhost/test.jpg')
+        request.headers['Cookie'] = cookie
+        request.headers.update(headers)
+        return request
+
+    def test_variant_etag(self):
+        # resized images get their own ETag
+        response = self.get_request().get_response(self.get_app())
+        self.assertTrue(response.etag not in (None, 'orig'))
+        self.assertEqual(response.headers['ETag'], '"%s"' % response.etag)
+        other = self.get_request(
+            cookie='resolution=32; $Path=/').get_response(self.get_app())
+        self.assertNotEqual(response.etag, other.etag)
+        return
+
+    def test_unchanged_keeps_etag(self):
+        # images not resized keep the upstream ETag
+        request = self.get_request(cookie='resolution=512; $Path=/')
+        response = request.get_response(self.get_app())
+        self.assertEqual(response.etag, 'orig')
+        return
+
+    def test_if_none_match(self):
+        # clients with current variant get a 304 w/o resizing
+        app = self.get_app()
+        etag = self.get_request().get_response(app).headers['ETag']
+        response = self.get_request(
+            **{'If-None-Match': etag}).get_response(app)
+        self.assertEqual(response.status_int, 304)
+        self.assertEqual(response.body, b'')
+        self.assertEqual(response.headers['ETag'], etag)
+        self.assertEqual(response.headers['Cache-Control'], 'max-age=60')
+        self.assertEqual(app.resized, 1)
+        return
+
+    def test_if_none_match_no_upstream_validator(self):
+        # also w/o upstream validators we can detect current variants
+        app = self.get_app(wsgi_app=wsgi_app_img_jpg)
+        etag = self.get_request().get_response(app).headers['ETag']
+        response = self.get_request(
+            **{'If-None-Match': etag}).get_response(app)
+        self.assertEqual(response.status_int, 304)
+        self.assertEqual(app.resized, 1)
+        return
+
+    def test_if_none_match_other_variant(self):
+        # clients with other variants get the wanted one
+        app = self.get_app()
+        response = self.get_request(
+            **{'If-None-Match': '"other"'}).get_response(app)
+        self.assertEqual(response.status_int, 200)
+        self.assertEqual(Image.open(StringIO(response.body)).size, (64, 64))
+        return
+
+    def test_if_modified_since(self):
+        # unmodified originals result in 304
+        app = self.get_app()
+        response = self.get_request(
+            **{'If-Modified-Since': LAST_MODIFIED}).get_response(app)
+        self.assertEqual(response.status_int, 304)
+        self.assertEqual(app.resized, 0)
+        return
+
+    def test_if_modified_since_modified(self):
+        # modified originals are delivered
+        app = self.get_app()
+        response = self.get_request(**{
+            'If-Modified-Since': 'Fri, 03 May 2013 03:26:35 GMT'}
+            ).get_response(app)
+        self.assertEqual(response.status_int, 200)
+        self.assertEqual(app.resized, 1)
+        return
+
+
+class ConditionalApp(object):
+    # a WSGI app delivering DATA_JPEG and supporting conditional requests
+    def __init__(self):
+        self.etag = 'orig'
+        self.full_responses = 0
+
+    def __call__(self, environ, start_response):
+        response = Response(
+            body=DATA_JPEG, content_type='image/jpeg',
+            conditional_response=True)
+        response.etag = self.etag
+        response.last_modified = LAST_MODIFIED
+        response.cache_control = 'max-age=60'
+        if self.etag not in Request(environ).if_none_match:
+            self.full_responses += 1
+        return response(environ, start_response)
+
+
+class RevalidationTests(unittest.TestCase):
+    # tests for revalidation of cached variants with the wrapped app
+
+    def setUp(self):
+        self.upstream = ConditionalApp()
+        self.app = ImageAdaptingMiddleware(
+            self.upstream, {}, resolutions=TEST_RESOLUTIONS,
+            memory_cache_max_bytes='100000')
+
+    def get_response(self, **headers):
+        request = Request.blank('http://localhost/test.jpg')
+        request.headers['Cookie'] = 'resolution=62; $Path=/'
+        request.headers.update(headers)
+        return request.get_response(self.app)
+
+    def test_revalidate(self):
+        # unchanged originals are not transferred again
+        response1 = self.get_response()
+        response2 = self.get_response()
+        self.assertEqual(self.upstream.full_responses, 1)
+        self.assertEqual(self.app.get_stats()['revalidated'], 1)
+        self.assertEqual(response2.status_int, 200)
+        self.assertEqual(response2.body, response1.body)
+        self.assertEqual(response2.etag, response1.etag)
+        self.assertEqual(response2.content_type, 'image/jpeg')
+        self.assertEqual(response2.content_length, len(response1.body))
+        self.assertEqual(response2.headers['Cache-Control'], 'max-age=60')
+        return
+
+    def test_revalidate_changed(self):
+        # changed originals are resized again
+        response1 = self.get_response()
+        self.upstream.etag = 'changed'
+        response2 = self.get_response()
+        self.assertEqual(self.upstream.full_responses, 2)
+        self.assertEqual(self.app.get_stats()['revalidated'], 0)
+        self.assertNotEqual(response2.etag, response1.etag)
+        self.assertEqual(Image.open(StringIO(response2.body)).size, (64, 64))
+        return
+
+    def test_revalidate_client_not_modified(self):
+        # clients with the current variant get a 304
+        etag = self.get_response().headers['ETag']
+        response = self.get_response(**{'If-None-Match': etag})
+        self.assertEqual(response.status_int, 304)
+        self.assertEqual(self.app.get_stats()['revalidated'], 1)
+        return
+
+    def test_revalidate_variant_not_cached(self):
+        # w/o cached variant the original is requested unconditionally
+        self.get_response()
+        request = Request.blank('http://localhost/test.jpg')
+        request.headers['Cookie'] = 'resolution=30; $Path=/'
+        response = request.get_response(self.app)
+        self.assertEqual(Image.open(StringIO(response.body)).size, (32, 32))
+        self.assertEqual(self.upstream.full_responses, 2)
+        return
+
+
+class UpstreamStatusTests(unittest.TestCase):
+    # tests for upstream responses other than 200 OK
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.upstream = ConditionalApp()
+        # a variant is cached already, e.g. before a restart
+        self.get_response()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def get_response(self, **headers):
+        # a fresh middleware knows no originals yet
+        app = ImageAdaptingMiddleware(
+            self.upstream, {}, resolutions=TEST_RESOLUTIONS,
+            cache_dir=self.cache_dir, debug_headers='true')
+        request = Request.blank('http://localhost/test.jpg')
+        request.headers['Cookie'] = 'resolution=62; $Path=/'
+        request.headers.update(headers)
+        return request.get_response(app)
+
+    def test_partial_content(self):
+        # range responses are passed on, not replaced by variants
+        response = self.get_response(Range='bytes=0-99')
+        self.assertEqual(response.status_int, 206)
+        self.assertEqual(response.body, DATA_JPEG[:100])
+        self.assertEqual(response.headers['X-Pail-Decision'], 'passed')
+        return
+
+    def test_not_modified(self):
+        # 304 responses of the wrapped app are passed on unchanged
+        def not_modified(environ, start_response):
+            # some apps keep the content type in 304 responses
+            start_response('304 Not Modified', [
+                ('Content-Type', 'image/jpeg'), ('ETag', '"orig"')])
+            return []
+        self.upstream = not_modified
+        response = self.get_response(**{'If-None-Match': '"orig"'})
+        self.assertEqual(response.status_int, 304)
+        self.assertEqual(response.body, b'')
+        self.assertEqual(response.headers['X-Pail-Decision'], 'passed')
+        return
+
+
+class SharedCacheHeadersTests(unittest.TestCase):
+    # tests for headers supporting CDNs and other shared caches
+
+    def get_response(self, wsgi_app=wsgi_app_img_jpg,
+                     cookie='resolution=62; $Path=/', **kw):
+        app = ImageAdaptingMiddleware(
+            wsgi_app, {}, resolutions=TEST_RESOLUTIONS, **kw)
+        request = Request.blank('http://localhost/test.jpg')
+        request.headers['Cookie'] = cookie
+        return request.get_response(app)
+
+    def test_vary_default(self):
+        # images vary by cookie and user agent
+        response = self.get_response()
+        self.assertEqual(response.vary, ('Cookie', 'User-Agent'))
+        response = self.get_response(cookie='resolution=512; $Path=/')
+        self.assertEqual(response.vary, ('Cookie', 'User-Agent'))
+        return
+
+    def test_vary_non_images(self):
+        # non-images are left alone
+        response = self.get_response(wsgi_app=wsgi_app_html)
+        self.assertEqual(response.vary, None)
+        return
+
+    def test_vary_configured(self):
+        # we can set the headers to vary on
+        response = self.get_response(vary='Cookie')
+        self.assertEqual(response.vary, ('Cookie',))
+        response = self.get_response(vary='')
+        self.assertEqual(response.vary, None)
+        return
+
+    def test_vary_merged(self):
+        # Vary headers of the wrapped app are kept
+        def wsgi_app(environ, start_response):
+            start_response('200 OK', [('Content-Type', 'image/jpeg'),
+                                      ('Vary', 'Accept-Encoding, cookie')])
+            return [DATA_JPEG]
+        response = self.get_response(wsgi_app=wsgi_app)
+        self.assertEqual(
+            response.vary, ('Accept-Encoding', 'cookie', 'User-Agent'))
+        return
+
+    def test_cache_control(self):
+        # we can set Cache-Control for resized images
+        response = self.get_response(cache_control='public, max-age=3600')
+        self.assertEqual(
+            response.headers['Cache-Control'], 'public, max-age=3600')
+        return
+
+    def test_cache_control_default(self):
+        # by default Cache-Control of the wrapped app is kept
+        response = self.get_response(wsgi_app=wsgi_app_img_jpg_validators)
+        self.assertEqual(response.headers['Cache-Control'], 'max-age=60')
+        return
+
+    def test_cache_control_shed(self):
+        # if we deliver other variants, caches must not store them
+        app = ImageAdaptingMiddleware(
+            wsgi_app_img_jpg_validators, {}, resolutions=TEST_RESOLUTIONS,
+            cache_control='max-age=3600', max_concurrent_resizes='1')
+        app.admission.acquire(1)
+        request = Request.blank('http://localhost/test.jpg')
+        request.headers['Cookie'] = 'resolution=62; $Path=/'
+        response = request.get_response(app)
+        self.assertEqual(response.headers['Cache-Control'], 'no-store')
+        return
+
+    def test_variant_header(self):
+        # we can describe the delivered variant in a header
+        response = self.get_response(variant_header='X-Pail-Variant')
+        self.assertEqual(response.headers['X-Pail-Variant'], 'width=64')
+        response = self.get_response()
+        self.assertTrue('X-Pail-Variant' not in response.headers)
+        return
+
+
+class EncoderProfileTests(unittest.TestCase):
+    # tests for encoding resized images with profiles
+
+    def get_response(self, app):
+        request = Request.blank('http://localhost/test.jpg')
+        request.headers['Cookie'] = 'resolution=62; $Path=/'
+        return request.get_response(app)
+
+    def test_profile_used(self):
+        # resized images are encoded with the configured profile
+        response1 = self.get_response(ImageAdaptingMiddleware(
+            wsgi_app_img_jpg_validators, {}, resolutions=TEST_RESOLUTIONS))
+        response2 = self.get_response(ImageAdaptingMiddleware(
+            wsgi_app_img_jpg_validators, {}, resolutions=TEST_RESOLUTIONS,
+            encoder_profiles='tiny quality=10',
+            resolution_profiles='64=tiny'))
+        self.assertTrue(len(response2.body) < len(response1.body))
+        # variants of different profiles have different ETags
+        self.assertNotEqual(response1.etag, response2.etag)
+        return
+
+    def test_other_resolutions(self):
+        # profiles apply only to their resolutions
+        response1 = self.get_response(ImageAdaptingMiddleware(
+            wsgi_app_img_jpg_validators, {}, resolutions=TEST_RESOLUTIONS))
+        response2 = self.get_response(ImageAdaptingMiddleware(
+            wsgi_app_img_jpg_validators, {}, resolutions=TEST_RESOLUTIONS,
+            resolution_profiles='32=compact'))
+        self.assertEqual(response1.body, response2.body)
+        self.assertEqual(response1.etag, response2.etag)
+        return
+
+
+class OutputFormatTests(unittest.TestCase):
+    # tests for delivering resized images in other formats
+
+    def get_response(self, wsgi_app=wsgi_app_img_png, accept='image/webp,*/*',
+                     app=None, **kw):
+        if app is None:
+            app = ImageAdaptingMiddleware(
+                wsgi_app, {}, resolutions=TEST_RESOLUTIONS,
+                output_formats='webp', **kw)
+        request = Request.blank('http://localhost/test.png')
+        request.headers['Cookie'] = 'resolution=62; $Path=/'
+        if accept is not None:
+            request.headers['Accept'] = accept
+        return request.get_response(app)
+
+    def test_webp(self):
+        # clients accepting WebP get WebP images
+        response = self.get_response()
+        self.assertEqual(response.content_type, 'image/webp')
+        self.assertEqual(Image.open(StringIO(response.body)).format, 'WEBP')
+        self.assertEqual(response.content_length, len(response.body))
+        return
+
+    def test_not_accepted(self):
+        # other clients get the original format
+        for accept in (None, '*/*', 'image/*', 'image/webp;q=0, image/png'):
+            response = self.get_response(accept=accept)
+            self.assertEqual(response.content_type, 'image/png')
+            self.assertEqual(Image.open(StringIO(response.body)).format, 'PNG')
+        return
+
+    def test_disabled(self):
+        # by default images are not transcoded
+        app = ImageAdaptingMiddleware(
+            wsgi_app_img_png, {}, resolutions=TEST_RESOLUTIONS)
+        response = self.get_response(app=app)
+        self.assertEqual(response.content_type, 'image/png')
+        self.assertEqual(app.output_formats, [])
+        return
+
+    def test_unchanged_not_transcoded(self):
+        # images that are not resized are delivered unchanged
+        request = Request.blank('http://localhost/test.png')
+        request.headers['Cookie'] = 'resolution=512; $Path=/'
+        request.headers['Accept'] = 'image/webp'
+        app = ImageAdaptingMiddleware(
+            wsgi_app_img_png, {}, resolutions=TEST_RESOLUTIONS,
+            output_formats='webp')
+        response = request.get_response(app)
+        self.assertEqual(response.body, DATA_PNG)
+        return
+
+    def test_preference(self):
+        # the first configured format accepted by the client is used
+        app = ImageAdaptingMiddleware(
+            wsgi_app_img_png, {}, output_formats='avif, webp')
+        request = Request.blank('/', headers={
+            'Accept': 'image/avif,image/webp'})
+        self.assertEqual(app.negotiate_format(request), app.output_formats[0])
+        request.headers['Accept'] = 'image/webp'
+        self.assertEqual(app.negotiate_format(request), 'WEBP')
+        return
+
+    def test_unknown_format(self):
+        # unknown formats are rejected
+        self.assertRaises(
+            ValueError, ImageAdaptingMiddleware, wsgi_app_img_png, {},
+            output_formats='webp, tiff')
+        return
+
+    def test_vary(self):
+        # images vary also by Accept
+        response = self.get_response()
+        self.assertEqual(response.vary, ('Cookie', 'User-Agent', 'Accept'))
+        return
+
+    def test_variant_header(self):
+        # the variant header names the format
+        response = self.get_response(variant_header='X-Variant')
+        self.assertEqual(
+            response.headers['X-Variant'], 'width=64; format=webp')
+        response = self.get_response(
+            variant_header='X-Variant', accept='image/png')
+        self.assertEqual(response.headers['X-Variant'], 'width=64')
+        return
+
+    def test_cache_key(self):
+        # variants for different formats are cached separately
+        tempdir = tempfile.mkdtemp()
+        try:
+            app = ImageAdaptingMiddleware(
+                wsgi_app_img_png, {}, resolutions=TEST_RESOLUTIONS,
+                cache_dir=tempdir, output_formats='webp')
+            response1 = self.get_response(app=app)
+            response2 = self.get_response(app=app, accept='image/png')
+            response3 = self.get_response(app=app)
+        finally:
+            shutil.rmtree(tempdir)
+        self.assertNotEqual(response1.etag, response2.etag)
+        self.assertEqual(response3.content_type, 'image/webp')
+        self.assertEqual(response3.body, response1.body)
+        self.assertEqual(response2.content_type, 'image/png')
+        return
+
+    def test_pool(self):
+        # transcoding works also in the worker pool
+        app = ImageAdaptingMiddleware(
+            wsgi_app_img_png, {}, resolutions=TEST_RESOLUTIONS,
+            output_formats='webp', resize_workers='1',
+            resize_processes='false')
+        try:
+            response = self.get_response(app=app)
+        finally:
+            app.pool.shutdown()
+        self.assertEqual(response.content_type, 'image/webp')
+        return
+
+
+class CoalesceTests(unittest.TestCase):
+    # tests for coalescing of concurrent identical requests
+
+    def get_app(self, **kw):
+        # get a middleware with slow resizing
+        app = ImageAdaptingMiddleware(
+            wsgi_app_img_jpg, {}, resolutions=TEST_RESOLUTIONS, **kw)
+        app.resized = 0
+        create_resized_images = app.create_resized_images
+
+        def slow_create(*args, **kw):
+            app.resized += 1
+            time.sleep(0.2)
+            return create_resized_images(*args, **kw)
+        app.create_resized_images = slow_create
+        return app
+
+    def get_responses(self, app, num=4):
+        # send `num` concurrent requests
+        responses = []
+
+        def send():
+            request = Request.blank('http://localhost/test.jpg')
+            request.headers['Cookie'] = 'resolution=62; $Path=/'
+            responses.append(request.get_response(app))
+        threads = [threading.Thread(target=send) for x in range(num)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+        return responses
+
+    def test_coalesce(self):
+        # concurrent requests for the same variant resize only once
+        app = self.get_app()
+        responses = self.get_responses(app)
+        self.assertEqual(app.resized, 1)
+        self.assertEqual(app.get_stats()['coalesced'], 3)
+        for response in responses:
+            image = Image.open(StringIO(response.body))
+            self.assertEqual(image.size, (64, 64))
+        return
+
+    def test_coalesce_disabled(self):
+        # we can switch off coalescing
+        app = self.get_app(coalesce='false')
+        self.get_responses(app)
+        self.assertEqual(app.resized, 4)
+        self.assertTrue('coalesced' not in app.get_stats())
+        return
+
+
+class ResizePoolTests(unittest.TestCase):
+    # tests for ImageAdaptingMiddleware with worker pool
+
+    def get_app(self, **kw):
+        app = ImageAdaptingMiddleware(
+            wsgi_app_img_jpg, {}, resolutions=TEST_RESOLUTIONS,
+            resize_workers='1', **kw)
+        self.addCleanup(app.pool.shutdown)
+        return app
+
+    def get_response(self, app):
+        request = Request.blank('http://localhost/test.jpg')
+        request.headers['Cookie'] = 'resolution=62; $Path=/'
+        return request.get_response(app)
+
+    def test_resize_in_pool(self):
+        # images are resized in worker processes
+        app = self.get_app()
+        response = self.get_response(app)
+        image = Image.open(StringIO(response.body))
+        self.assertEqual(image.size, (64, 64))
+        self.assertEqual(response.content_length, len(response.body))
+        return
+
+    def test_resize_in_threads(self):
+        # we can use threads instead of processes
+        app = self.get_app(resize_processes='false')
+        self.assertEqual(app.pool.uses_processes, False)
+        image = Image.open(StringIO(self.get_response(app).body))
+        self.assertEqual(image.size, (64, 64))
+        return
+
+    def test_worker_died(self):
+        # if a worker process died, new workers resize images
+        app = self.get_app()
+        app.pool.run(os._exit, 1)
+        image = Image.open(StringIO(self.get_response(app).body))
+        self.assertEqual(image.size, (64, 64))
+        self.assertEqual(app.get_stats()['pool']['failures'], 1)
+        return
+
+    def test_pool_busy(self):
+        # if the pool is busy, we get the original image
+        app = self.get_app(resize_queue_size='0')
+        app.pool.submit(time.sleep, 0.5)
+        response = self.get_response(app)
+        self.assertEqual(response.body, DATA_JPEG)
+        self.assertEqual(app.get_stats()['pool']['rejected'], 1)
+        self.assertEqual(app.get_stats()['shed'], 1)
+        return
+
+    def test_pool_timeout_shed(self):
+        # originals delivered after timeouts are not labelled as variants
+        app = self.get_app(
+            resize_timeout='0.0001', cache_control='public, max-age=86400',
+            variant_header='X-Variant', debug_headers='true')
+        app.pool.submit(time.sleep, 0.2)
+        response = self.get_response(app)
+        self.assertEqual(response.body, DATA_JPEG)
+        self.assertEqual(response.headers['X-Pail-Decision'], 'shed')
+        self.assertFalse('X-Variant' in response.headers)
+        self.assertEqual(response.headers['Cache-Control'], 'no-store')
+        self.assertEqual(app.get_stats()['shed'], 1)
+        return
+
+    def test_invalid_settings(self):
+        # pool settings are checked
+        self.assertRaises(
+            ValueError, ImageAdaptingMiddleware, None, {},
+            resize_workers='many')
+        return
+
+
+class DebugHeadersTests(unittest.TestCase):
+    # tests for Server-Timing and decision headers
+
+    def get_response(self, app, cookie='resolution=62; $Path=/', **kw):
+        request = Request.blank('http://localhost/test.jpg', **kw)
+        if cookie:
+            request.headers['Cookie'] = cookie
+        return request.get_response(app)
+
+    def get_stages(self, response):
+        # get the stage names from the Server-Timing header
+        return [x.split(';')[0].strip()
+                for x in response.headers['Server-Timing'].split(',')]
+
+    def test_disabled(self):
+        # by default no debug headers are sent
+        app = ImageAdaptingMiddleware(
+            wsgi_app_img_jpg, {}, resolutions=TEST_RESOLUTIONS)
+        response = self.get_response(app)
+        self.assertFalse('Server-Timing' in response.headers)
+        self.assertFalse('X-Pail-Decision' in response.headers)
+        return
+
+    def test_resized(self):
+        # stages of resizing are timed
+        app = ImageAdaptingMiddleware(
+            wsgi_app_img_jpg, {}, resolutions=TEST_RESOLUTIONS,
+            debug_headers='true')
+        response = self.get_response(app)
+        self.assertEqual(response.headers['X-Pail-Decision'], 'resized')
+        self.assertEqual(
+            self.get_stages(response),
+            ['upstream', 'buffer', 'decode', 'resample', 'encode', 'total'])
+        return
+
+    def test_cached(self):
+        # cache lookups are timed as well
+        app = ImageAdaptingMiddleware(
+            wsgi_app_img_jpg, {}, resolutions=TEST_RESOLUTIONS,
+            memory_cache_max_bytes='100000', debug_headers='true')
+        self.get_response(app)
+        response = self.get_response(app)
+        self.assertEqual(response.headers['X-Pail-Decision'], 'cached')
+        self.assertEqual(
+            self.get_stages(response), ['upstream', 'cache', 'total'])
+        return
+
+    def test_pool(self):
+        # with a worker pool the whole resize job is timed
+        app = ImageAdaptingMiddleware(
+            wsgi_app_img_jpg, {}, resolutions=TEST_RESOLUTIONS,
+            resize_workers='1', resize_processes='false',
+            debug_headers='true')
+        self.addCleanup(app.pool.shutdown)
+        response = self.get_response(app)
+        self.assertEqual(
+            self.get_stages(response),
+            ['upstream', 'buffer', 'resize', 'total'])
+        return
+
+    def test_other_decisions(self):
+        # passed, unchanged and ignored requests are marked
+        app = ImageAdaptingMiddleware(
+            wsgi_app_html, {}, resolutions=TEST_RESOLUTIONS,
+            debug_headers='true')
+        response = self.get_response(app)
+        self.assertEqual(response.headers['X-Pail-Decision'], 'passed')
+        self.assertEqual(self.get_stages(response), ['upstream', 'total'])
+        app.app = wsgi_app_img_jpg
+        response = self.get_response(app, cookie='resolution=2000; $Path=/')
+        self.assertEqual(response.headers['X-Pail-Decision'], 'unchanged')
+        app.should_ignore = lambda request, resolution: True
+        response = self.get_response(app)
+        self.assertEqual(response.headers['X-Pail-Decision'], 'ignored')
+        self.assertFalse('Server-Timing' in response.headers)
+        self.assertEqual(response.body, DATA_JPEG)
+        return
+
+    def test_upstream_server_timing(self):
+        # a Server-Timing header of the wrapped app is extended
+        def app(environ, start_response):
+            start_response('200 OK', [
+                ('Content-Type', 'image/jpeg'),
+                ('Server-Timing', 'db;dur=53')])
+            return [DATA_JPEG]
+        middleware = ImageAdaptingMiddleware(
+            app, {}, resolutions=TEST_RESOLUTIONS, debug_headers='true')
+        response = self.get_response(middleware)
+        self.assertEqual(
+            self.get_stages(response)[:2], ['db', 'upstream'])
+        return
+
+    def test_invalid(self):
+        # debug_headers must be a boolean
+        self.assertRaises(
+            ValueError, ImageAdaptingMiddleware, None, {},
+            debug_headers='loud')
+        return
+
+
+class VariantLimitTests(unittest.TestCase):
+    # tests for limiting the number of different variants
+
+    def get_resolution(self, cookie, **kw):
+        app = ImageAdaptingMiddleware(
+            None, {}, resolutions='480, 768, 1536', **kw)
+        request = Request.blank('http://localhost/test.jpg')
+        request.headers['Cookie'] = 'resolution=%s; $Path=/' % cookie
+        return app.get_resolution(request)
+
+    def test_default(self):
+        # by default any width and pixel ratio results in a variant
+        self.assertEqual(self.get_resolution('480.4'), 1920)
+        self.assertEqual(self.get_resolution('2000'), 2000)
+        return
+
+    def test_max_dpr(self):
+        # we can cap the pixel ratio
+        self.assertEqual(self.get_resolution('480.4', max_dpr='2'), 960)
+        self.assertEqual(self.get_resolution('480.1', max_dpr='2'), 480)
+        return
+
+    def test_snap(self):
+        # we can snap resolutions to the configured ones
+        kw = dict(snap_resolutions='true')
+        self.assertEqual(self.get_resolution('480.2', **kw), 1536)
+        self.assertEqual(self.get_resolution('480.4', **kw), 1536)
+        self.assertEqual(self.get_resolution('2000', **kw), 1536)
+        self.assertEqual(self.get_resolution('300', **kw), 480)
+        return
+
+    def test_invalid(self):
+        # invalid values are rejected
+        self.assertRaises(
+            ValueError, ImageAdaptingMiddleware, None, {}, max_dpr='high')
+        self.assertRaises(
+            ValueError, ImageAdaptingMiddleware, None, {},
+            snap_resolutions='maybe')
+        return
+
+    def test_variants_stats(self):
+        # we count the distinct variants created
+        app = ImageAdaptingMiddleware(
+            wsgi_app_img_jpg, {}, resolutions=TEST_RESOLUTIONS)
+        for cookie in ('62', '62', '20', '100'):
+            request = Request.blank('http://localhost/test.jpg')
+            request.headers['Cookie'] = 'resolution=%s; $Path=/' % cookie
+            request.get_response(app)
+        self.assertEqual(app.get_stats()['variants'], 2)
+        self.assertEqual(app.variants, set([(64, 'JPEG'), (32, 'JPEG')]))
+        return
+
+
+class ExplicitWidthTests(unittest.TestCase):
+    # tests for widths given in URLs
+
+    def setUp(self):
+        self.environs = []
+
+    def wsgi_app(self, environ, start_response):
+        self.environs.append(dict(environ))
+        return wsgi_app_img_jpg(environ, start_response)
+
+    def get_response(self, url, cookie='resolution=128; $Path=/', **kw):
+        app = ImageAdaptingMiddleware(
+            self.wsgi_app, {}, resolutions=TEST_RESOLUTIONS,
+            width_param='pail_w', width_prefix='_w', **kw)
+        request = Request.blank(url)
+        if cookie:
+            request.headers['Cookie'] = cookie
+        return request.get_response(app)
+
+    def get_width(self, response):
+        return Image.open(StringIO(response.body)).size[0]
+
+    def test_query_param(self):
+        # we can request widths by query parameter
+        response = self.get_response('/test.jpg?pail_w=32')
+        self.assertEqual(self.get_width(response), 32)
+        self.assertEqual(self.environs[0]['QUERY_STRING'], '')
+        return
+
+    def test_query_param_other_params(self):
+        # other parameters are passed on unchanged
+        response = self.get_response('/test.jpg?a=1&pail_w=32&b=%C3%A4')
+        self.assertEqual(self.get_width(response), 32)
+        self.assertEqual(self.environs[0]['QUERY_STRING'], 'a=1&b=%C3%A4')
+        return
+
+    def test_path_prefix(self):
+        # we can request widths by path prefix
+        response = self.get_response('/_w64/images/test.jpg')
+        self.assertEqual(self.get_width(response), 64)
+        self.assertEqual(self.environs[0]['PATH_INFO'], '/images/test.jpg')
+        return
+
+    def test_path_prefix_no_segment(self):
+        # only whole path segments are considered
+        self.get_response('/_w64.jpg')
+        self.assertEqual(self.environs[0]['PATH_INFO'], '/_w64.jpg')
+        return
+
+    def test_unlisted_width(self):
+        # widths not in resolutions are ignored; the cookie counts then
+        response = self.get_response('/_w100/test.jpg?pail_w=33')
+        self.assertEqual(self.get_width(response), 128)
+        self.assertEqual(self.environs[0]['PATH_INFO'], '/test.jpg')
+        self.assertEqual(self.environs[0]['QUERY_STRING'], '')
+        self.assertEqual(response.vary, ('Cookie', 'User-Agent'))
+        return
+
+    def test_no_vary(self):
+        # responses for explicit widths do not vary by cookie
+        response = self.get_response('/test.jpg?pail_w=32', cookie=None)
+        self.assertEqual(response.vary, None)
+        response = self.get_response(
+            '/test.jpg?pail_w=32', output_formats='webp')
+        self.assertEqual(response.vary, ('Accept',))
+        return
+
+    def test_disabled(self):
+        # by default URLs are passed on unchanged
+        app = ImageAdaptingMiddleware(
+            self.wsgi_app, {}, resolutions=TEST_RESOLUTIONS)
+        request = Request.blank('/_w32/test.jpg?pail_w=32')
+        request.headers['Cookie'] = 'resolution=64; $Path=/'
+        response = request.get_response(app)
+        self.assertEqual(self.get_width(response), 64)
+        self.assertEqual(self.environs[0]['PATH_INFO'], '/_w32/test.jpg')
+        self.assertEqual(self.environs[0]['QUERY_STRING'], 'pail_w=32')
+        return
+
+
 class GetClientResolutionTests(unittest.TestCase):
     # tests for ImageAdaptingMiddleware.get_client_resolution
 
@@ -268,6 +1534,153 @@ class GetClientResolutionTests(unittest.TestCase):
         return
 
 
+class ClientHintsTests(unittest.TestCase):
+    # tests for Client Hints support
+
+    def setUp(self):
+        self.request = Request.blank('http://localhost/test.jpg')
+        self.middleware = ImageAdaptingMiddleware(
+            None, {}, resolutions='1382, 992, 768, 480', client_hints='true')
+
+    def test_no_hints(self):
+        # w/o hints we get no width
+        self.assertEqual(
+            self.middleware.get_client_hints(self.request), (None, 1))
+        return
+
+    def test_viewport_width(self):
+        # we can get the viewport width
+        self.request.headers['Sec-CH-Viewport-Width'] = '640'
+        self.assertEqual(
+            self.middleware.get_client_hints(self.request), (640, 1))
+        return
+
+    def test_width_and_dpr(self):
+        # Sec-CH-Width is given in physical pixels
+        self.request.headers['Sec-CH-Width'] = '960'
+        self.request.headers['Sec-CH-DPR'] = '3'
+        self.request.headers['Sec-CH-Viewport-Width'] = '640'
+        self.assertEqual(
+            self.middleware.get_client_hints(self.request), (320, 3))
+        return
+
+    def test_float_dpr(self):
+        # device pixel ratios can be floats
+        self.request.headers['Viewport-Width'] = '412'
+        self.request.headers['DPR'] = '2.625'
+        self.assertEqual(
+            self.middleware.get_client_hints(self.request), (412, 2.625))
+        return
+
+    def test_invalid_values(self):
+        # invalid hints are ignored
+        self.request.headers['Sec-CH-Width'] = 'wide'
+        self.request.headers['Sec-CH-DPR'] = '-1'
+        self.request.headers['Viewport-Width'] = '500'
+        self.assertEqual(
+            self.middleware.get_client_hints(self.request), (500, 1))
+        # also infinite and NaN values are ignored
+        for dpr, width in (('inf', '1e400'), ('nan', 'nan'),
+                           ('-inf', 'inf')):
+            self.request.headers['Sec-CH-DPR'] = dpr
+            self.request.headers['Sec-CH-Width'] = width
+            self.assertEqual(
+                self.middleware.get_client_hints(self.request), (500, 1))
+        self.request.headers['Sec-CH-DPR'] = '1e-320'
+        self.request.headers['Sec-CH-Width'] = '640'
+        self.assertEqual(
+            self.middleware.get_client_hints(self.request)[0], 500)
+        self.request.headers['Viewport-Width'] = 'nan'
+        self.assertEqual(
+            self.middleware.get_client_hints(self.request), (None, 1))
+        # requests with such hints do not fail
+        app = ImageAdaptingMiddleware(
+            wsgi_app_html, {}, resolutions=TEST_RESOLUTIONS)
+        self.assertEqual(self.request.get_response(app).status_int, 200)
+        return
+
+    def test_hints_preferred(self):
+        # hints are preferred over the resolution cookie
+        self.request.headers['Cookie'] = 'resolution=1024; $Path=/'
+        self.request.headers['Sec-CH-Viewport-Width'] = '400'
+        self.request.headers['Sec-CH-DPR'] = '2.625'
+        self.assertEqual(
+            self.middleware.get_resolution(self.request), 1260)
+        return
+
+    def test_cookie_fallback(self):
+        # w/o hints the resolution cookie is used
+        self.request.headers['Cookie'] = 'resolution=1024; $Path=/'
+        self.assertEqual(
+            self.middleware.get_resolution(self.request), 1382)
+        return
+
+    def test_resize_with_hints(self):
+        # images are resized according to Client Hints
+        app = ImageAdaptingMiddleware(
+            wsgi_app_img_jpg, {}, resolutions=TEST_RESOLUTIONS,
+            client_hints='true')
+        self.request.headers['Sec-CH-Width'] = '64'
+        self.request.headers['Sec-CH-DPR'] = '2'
+        response = self.request.get_response(app)
+        self.assertEqual(Image.open(StringIO(response.body)).size, (64, 64))
+        self.assertTrue('Sec-CH-Width' in response.vary)
+        return
+
+    def test_hints_disabled(self):
+        # w/o `client_hints` hints are ignored, as they are not in Vary
+        app = ImageAdaptingMiddleware(
+            wsgi_app_img_jpg, {}, resolutions=TEST_RESOLUTIONS)
+        self.request.headers['Cookie'] = 'resolution=62; $Path=/'
+        self.request.headers['Sec-CH-Width'] = '50'
+        response = self.request.get_response(app)
+        self.assertEqual(Image.open(StringIO(response.body)).size, (64, 64))
+        self.assertEqual(response.vary, ('Cookie', 'User-Agent'))
+        return
+
+    def test_accept_ch(self):
+        # with `client_hints` HTML pages request Client Hints
+        app = ImageAdaptingMiddleware(
+            wsgi_app_html, {}, client_hints='true')
+        response = self.request.get_response(app)
+        self.assertEqual(
+            response.headers['Accept-CH'],
+            'Sec-CH-Width, Width, Sec-CH-Viewport-Width, Viewport-Width, '
+            'Sec-CH-DPR, DPR')
+        self.assertTrue('Critical-CH' not in response.headers)
+        return
+
+    def test_critical_ch(self):
+        # we can also send Critical-CH
+        app = ImageAdaptingMiddleware(
+            wsgi_app_html, {}, client_hints='true', critical_ch='true')
+        response = self.request.get_response(app)
+        self.assertEqual(
+            response.headers['Critical-CH'], response.headers['Accept-CH'])
+        return
+
+    def test_accept_ch_disabled(self):
+        # by default no Client Hints are requested
+        app = ImageAdaptingMiddleware(wsgi_app_html, {})
+        response = self.request.get_response(app)
+        self.assertTrue('Accept-CH' not in response.headers)
+        response = self.request.get_response(ImageAdaptingMiddleware(
+            wsgi_app_plaintext, {}, client_hints='true'))
+        self.assertTrue('Accept-CH' not in response.headers)
+        return
+
+    def test_vary_client_hints(self):
+        # with `client_hints` images vary by Client Hints
+        app = ImageAdaptingMiddleware(
+            wsgi_app_img_jpg, {}, client_hints='true')
+        response = self.request.get_response(app)
+        self.assertEqual(
+            response.vary,
+            ('Cookie', 'User-Agent', 'Sec-CH-Width', 'Width',
+             'Sec-CH-Viewport-Width', 'Viewport-Width', 'Sec-CH-DPR', 'DPR'))
+        return
+
+
 class ShouldIgnoreTests(unittest.TestCase):
     # tests for ImageAdaptingMiddleware.should_ignore
 
@@ -321,6 +1734,16 @@ class ShouldAdaptTests(unittest.TestCase):
             self.middleware.should_adapt(response), True)
         return
 
+    def test_too_large(self):
+        # images larger than `max_source_bytes` are not adapted
+        middleware = ImageAdaptingMiddleware(
+            None, {}, max_source_bytes='1000')
+        request = Request.blank('http://localhost/test.html')
+        response = request.get_response(wsgi_app_img_jpg)
+        self.assertEqual(
+            middleware.should_adapt(response), False)
+        return
+
     def test_png_content_type(self):
         # image/png docs are adapted
         request = Request.blank('http://localhost/test.html')
@@ -345,7 +1768,7 @@ class IsMobileTests(unittest.TestCase):
 
     def test_non_mobile(self):
         # we can detect non-mobiles clients
-        self.request.headers['HTTP_USER_AGENT'] = 'amaya/9.51 libwww/5.4.0'
+        self.request.headers['User-Agent'] = 'amaya/9.51 libwww/5.4.0'
         self.assertEqual(
             False, self.middleware.is_mobile(self.request))
         return
@@ -353,7 +1776,36 @@ class IsMobileTests(unittest.TestCase):
     def test_is_mobile(self):
         # we can detect mobile devices
         self.request.headers[
-            'HTTP_USER_AGENT'] = 'BlackBerry7730/3.7.1 UP.Link/5.1.2.5'
+            'User-Agent'] = 'BlackBerry7730/3.7.1 UP.Link/5.1.2.5'
+        self.assertEqual(
+            True, self.middleware.is_mobile(self.request))
+        return
+
+    def test_real_user_agents(self):
+        # we can classify current browsers
+        for user_agent, expected in (
+                ('Mozilla/5.0 (Windows NT 10.0; Win64; x64) '
+                 'AppleWebKit/537.36 (KHTML, like Gecko) '
+                 'Chrome/120.0.0.0 Safari/537.36', False),
+                ('Mozilla/5.0 (iPhone; CPU iPhone OS 17_1 like Mac OS X) '
+                 'AppleWebKit/605.1.15 (KHTML, like Gecko) '
+                 'Version/17.1 Mobile/15E148 Safari/604.1', True),
+                ('Mozilla/5.0 (Linux; Android 14; Pixel 8) '
+                 'AppleWebKit/537.36 (KHTML, like Gecko) '
+                 'Chrome/120.0.0.0 Mobile Safari/537.36', True),
+                ('Mozilla/5.0 (BB10; Touch) AppleWebKit/537.35+ '
+                 '(KHTML, like Gecko) Version/10.3.3.2205 Mobile '
+                 'Safari/537.35+', True)):
+            request = Request.blank('/', headers={'User-Agent': user_agent})
+            self.assertEqual(
+                expected, self.middleware.is_mobile(request))
+        return
+
+    def test_remembered(self):
+        # the classification of User-Agent strings is remembered
+        self.request.headers['User-Agent'] = 'amaya/9.51 libwww/5.4.0'
+        self.middleware.is_mobile(self.request)
+        self.middleware.user_agents.set('amaya/9.51 libwww/5.4.0', True)
         self.assertEqual(
             True, self.middleware.is_mobile(self.request))
         return
@@ -380,6 +1832,75 @@ class InitParamsTests(unittest.TestCase):
         self.assertEqual(app.resolutions, [666])
         return
 
+    def test_cache_default(self):
+        # by default no cache is used
+        app = ImageAdaptingMiddleware(None, {})
+        self.assertEqual(app.cache, None)
+        return
+
+    def test_cache_max_bytes_invalid(self):
+        # the cache size must be an integer
+        cache_dir = tempfile.mkdtemp()
+        try:
+            self.assertRaises(
+                ValueError,
+                ImageAdaptingMiddleware,
+                None, {}, cache_dir=cache_dir, cache_max_bytes='lots')
+        finally:
+            shutil.rmtree(cache_dir)
+        return
+
+    def test_memory_cache_max_bytes_invalid(self):
+        # the memory cache size must be an integer
+        self.assertRaises(
+            ValueError,
+            ImageAdaptingMiddleware,
+            None, {}, memory_cache_max_bytes='lots')
+        return
+
+    def test_fast_decode(self):
+        # we can enable fast decoding
+        self.assertEqual(
+            ImageAdaptingMiddleware(None, {}).fast_decode, False)
+        self.assertEqual(
+            ImageAdaptingMiddleware(
+                None, {}, fast_decode='true').fast_decode, True)
+        self.assertRaises(
+            ValueError, ImageAdaptingMiddleware, None, {},
+            fast_decode='maybe')
+        return
+
+    def test_resolution_profiles(self):
+        # we can select encoder profiles by resolution
+        app = ImageAdaptingMiddleware(
+            None, {}, encoder_profiles='tiny quality=20',
+            resolution_profiles='*=high, 480=compact, 128=tiny')
+        self.assertEqual(
+            [x[0] for x in app.profiles], [128, 480, None])
+        self.assertEqual(app.profiles[0][1], dict(quality=20))
+        self.assertEqual(ImageAdaptingMiddleware(None, {}).profiles, [])
+        return
+
+    def test_resolution_profiles_invalid(self):
+        # unknown profiles and invalid definitions are rejected
+        for kw in (dict(resolution_profiles='480=unknown'),
+                   dict(resolution_profiles='small=compact'),
+                   dict(encoder_profiles='tiny speed=fast')):
+            self.assertRaises(
+                ValueError, ImageAdaptingMiddleware, None, {}, **kw)
+        return
+
+    def test_resolutions_not_growing(self):
+        # lookups do not change the configured resolutions
+        app = ImageAdaptingMiddleware(None, {}, resolutions='1, 2, 3')
+        request = Request.blank('/')
+        request.headers['Cookie'] = 'resolution=640; $Path=/'
+        self.assertEqual(app.get_resolution(request), 640)
+        request.headers['Cookie'] = 'resolution=320; $Path=/'
+        self.assertEqual(app.get_resolution(request), 320)
+        self.assertEqual(app.resolutions, [1, 2, 3])
+        return
+
     def test_resolutions_invalid(self):
         # invalid lists result in a value error
         self.assertRaises(
@@ -0,0 +1,242 @@
+"""
+Cache Warming
+-------------
+
+Create cached variants of images before they are requested.
+
+The ``pail-warm`` script walks a directory of images, like the
+document root of a static file app, and stores variants for all
+configured resolutions in the disk cache of the middleware. The
+middleware must use content based cache keys (``cache_key =
+content``), so that variants created offline are found for requests.
+"""
+import argparse
+import mimetypes
+import multiprocessing
+import os
+import sys
+import time
+from webob import Request, Response
+from pail.concurrency import map_unordered
+from pail.helpers import MIME_TYPES, get_image_size, resize_data
+from pail.wsgi import ImageAdaptingMiddleware
+try:
+    from configparser import ConfigParser
+except ImportError:                          # pragma: no cover
+    from ConfigParser import ConfigParser    # pragma: no cover
+try:
+    from urllib.parse import quote
+except ImportError:                          # pragma: no cover
+    from urllib import quote                 # pragma: no cover
+
+#: Section of paste config files configuring the middleware by default.
+DEFAULT_SECTION = 'filter-app:main'
+
+
+def get_middleware_options(path, section=DEFAULT_SECTION):
+    """Get the middleware options from the paste config file at `path`.
+
+    Options of `section` are returned as a dict, except `use` and
+    `next`. ``%(here)s`` is replaced by the directory of `path` as in
+    paste configs. Raises `ValueError` if `section` does not exist.
+    """
+    here = os.path.dirname(os.path.abspath(path))
+    parser = ConfigParser(dict(here=here, __file__=os.path.abspath(path)))
+    parser.read(path)
+    if not parser.has_section(section):
+        raise ValueError('no section [%s] in %s' % (section, path))
+    defaults = parser.defaults()
+    return dict((name, parser.get(section, name))
+                for name in parser.options(section)
+                if name not in defaults and name not in ('use', 'next'))
+
+
+def find_images(root, content_types):
+    """Get the paths of images below `root`.
+
+    Only files whose name suggests one of `content_types` are
+    found. Paths are yielded in a stable order, directory by
+    directory.
+    """
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for name in sorted(filenames):
+            if mimetypes.guess_type(name)[0] in content_types:
+                yield os.path.join(dirpath, name)
+
+
+def resize_file(path, jobs, fast_decode=False, profiles=None):
+    """Resize the image at `path` as described by `jobs`.
+
+    `jobs` is a list of tuples ``(<FORMAT>, <KEYS>)`` with
+    ``<FORMAT>`` being an output format (or ``None``) and ``<KEYS>``
+    a dict mapping resolutions to cache keys.
+
+    Returns a list of tuples ``(<KEY>, <DATA>)``. As arguments and
+    results can be pickled, this function can run in other processes.
+    """
+    with open(path, 'rb') as fd:
+        data = fd.read()
+    result = []
+    for output_format, keys in jobs:
+        for res, im_type, new_data in resize_data(
+                data, list(keys), fast_decode, output_format, profiles):
+            result.append((keys[res], new_data))
+    return result
+
+
+class CacheWarmer(object):
+    """Create variants of images below `root` in a middleware cache.
+
+    `middleware` is an :class:`pail.wsgi.ImageAdaptingMiddleware`
+    with `cache_dir` set and `cache_key` set to ``content``. Images
+    are assumed to be served with their path below `root`, prefixed
+    by `url_prefix`. The work is done by `workers` processes.
+
+    Variants already cached are skipped, so interrupted runs can
+    simply be started again.
+    """
+
+    def __init__(self, middleware, root, url_prefix='', workers=1):
+        if middleware.disk_cache is None:
+            raise ValueError('the middleware needs a `cache_dir`')
+        if not middleware.content_keys:
+            raise ValueError('the middleware needs `cache_key = content`')
+        self.middleware = middleware
+        self.root = root
+        self.url_prefix = url_prefix.rstrip('/')
+        self.workers = workers
+        self.images = 0
+        self.created = 0
+        self.skipped = 0
+        self.failed = 0
+        self.bytes = 0
+        self.seconds = 0.0
+
+    def get_url(self, path):
+        """Get the URL path `path` is served under.
+        """
+        rel_path = os.path.relpath(path, self.root).replace(os.sep, '/')
+        return self.url_prefix + '/' + quote(rel_path)
+
+    def get_jobs(self, path):
+        """Get the variants of image `path` not cached yet.
+
+        Returns a list of jobs as expected by :func:`resize_file`.
+        Variants already cached are counted as `skipped`.
+        """
+        with open(path, 'rb') as fd:
+            data = fd.read()
+        size = get_image_size(data)
+        if size is None:
+            return []
+        middleware = self.middleware
+        request = Request.blank(self.get_url(path))
+        response = Response(body=data)
+        resolutions = [x for x in middleware.resolutions if x < size[0]]
+        jobs = []
+        for output_format in [None] + middleware.output_formats:
+            if output_format is not None:
+                request.headers['Accept'] = MIME_TYPES[output_format]
+            keys = dict()
+            for res in resolutions:
+                key = middleware.get_cache_key(request, response, res)
+                if key in middleware.disk_cache:
+                    self.skipped += 1
+                else:
+                    keys[res] = key
+            if keys:
+                jobs.append((output_format, keys))
+        return jobs
+
+    def run(self, paths, log=None):
+        """Create the missing variants of images at `paths`.
+
+        Failures are written to `log`, a file, if given.
+        """
+        start = time.time()
+        middleware = self.middleware
+
+        def args():
+            for path in paths:
+                self.images += 1
+                jobs = self.get_jobs(path)
+                if jobs:
+                    yield (path, jobs, middleware.fast_decode,
+                           middleware.profiles)
+        try:
+            for call_args, result, exc in map_unordered(
+                    resize_file, args(), self.workers):
+                self.store(call_args[0], result, exc, log)
+        finally:
+            self.seconds = time.time() - start
+
+    def store(self, path, result, exc=None, log=None):
+        """Store the `result` of :func:`resize_file` for `path`.
+
+        If the resize job raised `exc`, it is counted as failed
+        instead.
+        """
+        if exc is not None:
+            self.failed += 1
+            if log is not None:
+                log.write('%s: %s\n' % (path, exc))
+            return
+        for key, data in result:
+            self.middleware.disk_cache.set(key, data)
+            self.created += 1
+            self.bytes += len(data)
+
+    def get_report(self):
+        """Get a line describing the work done and the throughput.
+        """
+        seconds = max(self.seconds, 0.001)
+        return (
+            '%d images, %d variants created (%.1f MiB), %d up to date, '
+            '%d failed in %.1f s: %.1f images/s, %.1f variants/s' % (
+                self.images, self.created, self.bytes / 1048576.0,
+                self.skipped, self.failed, self.seconds,
+                self.images / seconds, self.created / seconds))
+
+
+def main(argv=None):
+    """The ``pail-warm`` script.
+    """
+    parser = argparse.ArgumentParser(
+        description='Create cached variants of all images below ROOT.')
+    parser.add_argument('root', metavar='ROOT',
+                        help='directory containing images')
+    parser.add_argument('-c', '--config', metavar='INI',
+                        help='paste config file with middleware options')
+    parser.add_argument('-s', '--section', default=DEFAULT_SECTION,
+                        help='config section of the middleware '
+                        '(default: %(default)s)')
+    parser.add_argument('-o', '--option', action='append', default=[],
+                        metavar='NAME=VALUE',
+                        help='set or override a middleware option')
+    parser.add_argument('-p', '--url-prefix', default='',
+                        help='URL path ROOT is served under')
+    parser.add_argument('-j', '--workers', type=int,
+                        default=multiprocessing.cpu_count(),
+                        help='number of worker processes '
+                        '(default: %(default)s)')
+    args = parser.parse_args(argv)
+    options = dict()
+    try:
+        if args.config:
+            options = get_middleware_options(args.config, args.section)
+        for option in args.option:
+            name, sep, value = option.partition('=')
+            if not sep:
+                raise ValueError('options must look like NAME=VALUE')
+            options[name.strip()] = value.strip()
+        options['resize_workers'] = '0'  # we have our own processes
+        middleware = ImageAdaptingMiddleware(None, {}, **options)
+        warmer = CacheWarmer(
+            middleware, args.root, args.url_prefix, args.workers)
+    except (TypeError, ValueError) as exc:
+        parser.error(str(exc))
+    warmer.run(
+        find_images(args.root, middleware.acceptable_types), log=sys.stderr)
+    print(warmer.get_report())
+    return warmer.failed and 1 or 0
@@ -5,19 +5,94 @@ WSGI Components
 Middleware and other components that can be used with other WSGI
 components.
 """
+import hashlib
+import math
 import re
 import tempfile
-from webob import Request
-from webob.static import FileIter
-from pail.helpers import resize, to_int_list, get_resolution
+from io import BytesIO
+from webob import Request, Response
+from pail.cache import (
+    DiskCache, LRUCache, MemoryCache, TieredCache, make_key)
+from pail.concurrency import (
+    NO_RESULT, AdmissionControl, ResizePool, SingleFlight)
+from pail.helpers import (
+    ENCODER_PROFILES, MIME_TYPES, can_save, resize_all, resize_data, to_bool,
+    to_int_list, to_profiles, get_file_length, get_profile, get_image_format,
+    get_image_size, timer, ResolutionTable, Timings)
 
 #: Default Resolution set used, when no other was given in config.
 DEFAULT_RESOLUTIONS = "1382, 992, 768, 480"
 
-#: Regular expressions from http://detectmobilebrowsers.com/ (public domain)
-reg_b = re.compile(r"(android|bb\\d+|meego).+mobile|avantgo|bada\\/|blackberry|blazer|compal|elaine|fennec|hiptop|iemobile|ip(hone|od)|iris|kindle|lge |maemo|midp|mmp|netfront|opera m(ob|in)i|palm( os)?|phone|p(ixi|re)\\/|plucker|pocket|psp|series(4|6)0|symbian|treo|up\\.(browser|link)|vodafone|wap|windows (ce|phone)|xda|xiino", re.I|re.M)
+#: Default maximum size of the disk cache in bytes (100 MiB).
+DEFAULT_CACHE_MAX_BYTES = "104857600"
 
-reg_v = re.compile(r"1207|6310|6590|3gso|4thp|50[1-6]i|770s|802s|a wa|abac|ac(er|oo|s\\-)|ai(ko|rn)|al(av|ca|co)|amoi|an(ex|ny|yw)|aptu|ar(ch|go)|as(te|us)|attw|au(di|\\-m|r |s )|avan|be(ck|ll|nq)|bi(lb|rd)|bl(ac|az)|br(e|v)w|bumb|bw\\-(n|u)|c55\\/|capi|ccwa|cdm\\-|cell|chtm|cldc|cmd\\-|co(mp|nd)|craw|da(it|ll|ng)|dbte|dc\\-s|devi|dica|dmob|do(c|p)o|ds(12|\\-d)|el(49|ai)|em(l2|ul)|er(ic|k0)|esl8|ez([4-7]0|os|wa|ze)|fetc|fly(\\-|_)|g1 u|g560|gene|gf\\-5|g\\-mo|go(\\.w|od)|gr(ad|un)|haie|hcit|hd\\-(m|p|t)|hei\\-|hi(pt|ta)|hp( i|ip)|hs\\-c|ht(c(\\-| |_|a|g|p|s|t)|tp)|hu(aw|tc)|i\\-(20|go|ma)|i230|iac( |\\-|\\/)|ibro|idea|ig01|ikom|im1k|inno|ipaq|iris|ja(t|v)a|jbro|jemu|jigs|kddi|keji|kgt( |\\/)|klon|kpt |kwc\\-|kyo(c|k)|le(no|xi)|lg( g|\\/(k|l|u)|50|54|\\-[a-w])|libw|lynx|m1\\-w|m3ga|m50\\/|ma(te|ui|xo)|mc(01|21|ca)|m\\-cr|me(rc|ri)|mi(o8|oa|ts)|mmef|mo(01|02|bi|de|do|t(\\-| |o|v)|zz)|mt(50|p1|v )|mwbp|mywa|n10[0-2]|n20[2-3]|n30(0|2)|n50(0|2|5)|n7(0(0|1)|10)|ne((c|m)\\-|on|tf|wf|wg|wt)|nok(6|i)|nzph|o2im|op(ti|wv)|oran|owg1|p800|pan(a|d|t)|pdxg|pg(13|\\-([1-8]|c))|phil|pire|pl(ay|uc)|pn\\-2|po(ck|rt|se)|prox|psio|pt\\-g|qa\\-a|qc(07|12|21|32|60|\\-[2-7]|i\\-)|qtek|r380|r600|raks|rim9|ro(ve|zo)|s55\\/|sa(ge|ma|mm|ms|ny|va)|sc(01|h\\-|oo|p\\-)|sdk\\/|se(c(\\-|0|1)|47|mc|nd|ri)|sgh\\-|shar|sie(\\-|m)|sk\\-0|sl(45|id)|sm(al|ar|b3|it|t5)|so(ft|ny)|sp(01|h\\-|v\\-|v )|sy(01|mb)|t2(18|50)|t6(00|10|18)|ta(gt|lk)|tcl\\-|tdg\\-|tel(i|m)|tim\\-|t\\-mo|to(pl|sh)|ts(70|m\\-|m3|m5)|tx\\-9|up(\\.b|g1|si)|utst|v400|v750|veri|vi(rg|te)|vk(40|5[0-3]|\\-v)|vm40|voda|vulc|vx(52|53|60|61|70|80|81|83|85|98)|w3c(\\-| )|webc|whit|wi(g |nc|nw)|wmlb|wonu|x700|yas\\-|your|zeto|zte\\-", re.I|re.M)
+#: Default number of bytes read to determine the size of an image.
+DEFAULT_PROBE_BYTES = "65536"
+
+#: Default maximum size of image bodies buffered in memory (1 MiB).
+DEFAULT_SPOOL_THRESHOLD = "1048576"
+
+#: Number of bytes read at once from buffered image bodies.
+BLOCK_SIZE = 65536
+
+#: Default number of resize jobs waiting for a free worker.
+DEFAULT_RESIZE_QUEUE_SIZE = "16"
+
+#: Default number of seconds to wait for a resize job to finish.
+DEFAULT_RESIZE_TIMEOUT = "10"
+
+#: Decisions taken by `ImageAdaptingMiddleware.adapt()`.
+PASSED, UNCHANGED, RESIZED, CACHED, NOT_MODIFIED, SHED = (
+    'passed', 'unchanged', 'resized', 'cached', 'not-modified', 'shed')
+
+#: Decision for requests not looked at (no resolution known).
+IGNORED = 'ignored'
+
+#: Response header giving the decision, if `debug_headers` is set.
+DECISION_HEADER = 'X-Pail-Decision'
+
+#: WSGI environment key of the `Timings` of a request.
+TIMINGS_KEY = 'pail.timings'
+
+#: `Cache-Control` of shed responses, which must not be stored.
+SHED_CACHE_CONTROL = 'no-store'
+
+#: Request headers resized images depend on by default.
+DEFAULT_VARY = "Cookie, User-Agent"
+
+#: Client Hints giving the width of requested images in physical pixels.
+WIDTH_HINTS = ('Sec-CH-Width', 'Width')
+
+#: Client Hints giving the viewport width in CSS pixels.
+VIEWPORT_WIDTH_HINTS = ('Sec-CH-Viewport-Width', 'Viewport-Width')
+
+#: Client Hints giving the device pixel ratio.
+DPR_HINTS = ('Sec-CH-DPR', 'DPR')
+
+#: All Client Hints we understand, requested from clients via Accept-CH.
+CLIENT_HINTS = WIDTH_HINTS + VIEWPORT_WIDTH_HINTS + DPR_HINTS
+
+#: Maximum number of originals whose validators are remembered.
+MAX_KNOWN_ORIGINALS = 10000
+
+#: Headers of upstream responses kept in `304 Not Modified` responses.
+NOT_MODIFIED_HEADERS = (
+    'cache-control', 'content-location', 'date', 'expires',
+    'last-modified', 'vary')
+
+#: Maximum number of User-Agent strings whose classification is
+#: remembered.
+MAX_USER_AGENTS = 1000
+
+#: Patterns from http://detectmobilebrowsers.com/ (public domain).
+#: `MOBILE_PATTERN_B` is searched in the whole User-Agent string,
+#: `MOBILE_PATTERN_V` in its first four characters.
+MOBILE_PATTERN_B = r"(android|bb\d+|meego).+mobile|avantgo|bada\/|blackberry|blazer|compal|elaine|fennec|hiptop|iemobile|ip(hone|od)|iris|kindle|lge |maemo|midp|mmp|netfront|opera m(ob|in)i|palm( os)?|phone|p(ixi|re)\/|plucker|pocket|psp|series(4|6)0|symbian|treo|up\.(browser|link)|vodafone|wap|windows (ce|phone)|xda|xiino"
+
+MOBILE_PATTERN_V = r"1207|6310|6590|3gso|4thp|50[1-6]i|770s|802s|a wa|abac|ac(er|oo|s\-)|ai(ko|rn)|al(av|ca|co)|amoi|an(ex|ny|yw)|aptu|ar(ch|go)|as(te|us)|attw|au(di|\-m|r |s )|avan|be(ck|ll|nq)|bi(lb|rd)|bl(ac|az)|br(e|v)w|bumb|bw\-(n|u)|c55\/|capi|ccwa|cdm\-|cell|chtm|cldc|cmd\-|co(mp|nd)|craw|da(it|ll|ng)|dbte|dc\-s|devi|dica|dmob|do(c|p)o|ds(12|\-d)|el(49|ai)|em(l2|ul)|er(ic|k0)|esl8|ez([4-7]0|os|wa|ze)|fetc|fly(\-|_)|g1 u|g560|gene|gf\-5|g\-mo|go(\.w|od)|gr(ad|un)|haie|hcit|hd\-(m|p|t)|hei\-|hi(pt|ta)|hp( i|ip)|hs\-c|ht(c(\-| |_|a|g|p|s|t)|tp)|hu(aw|tc)|i\-(20|go|ma)|i230|iac( |\-|\/)|ibro|idea|ig01|ikom|im1k|inno|ipaq|iris|ja(t|v)a|jbro|jemu|jigs|kddi|keji|kgt( |\/)|klon|kpt |kwc\-|kyo(c|k)|le(no|xi)|lg( g|\/(k|l|u)|50|54|\-[a-w])|libw|lynx|m1\-w|m3ga|m50\/|ma(te|ui|xo)|mc(01|21|ca)|m\-cr|me(rc|ri)|mi(o8|oa|ts)|mmef|mo(01|02|bi|de|do|t(\-| |o|v)|zz)|mt(50|p1|v )|mwbp|mywa|n10[0-2]|n20[2-3]|n30(0|2)|n50(0|2|5)|n7(0(0|1)|10)|ne((c|m)\-|on|tf|wf|wg|wt)|nok(6|i)|nzph|o2im|op(ti|wv)|oran|owg1|p800|pan(a|d|t)|pdxg|pg(13|\-([1-8]|c))|phil|pire|pl(ay|uc)|pn\-2|po(ck|rt|se)|prox|psio|pt\-g|qa\-a|qc(07|12|21|32|60|\-[2-7]|i\-)|qtek|r380|r600|raks|rim9|ro(ve|zo)|s55\/|sa(ge|ma|mm|ms|ny|va)|sc(01|h\-|oo|p\-)|sdk\/|se(c(\-|0|1)|47|mc|nd|ri)|sgh\-|shar|sie(\-|m)|sk\-0|sl(45|id)|sm(al|ar|b3|it|t5)|so(ft|ny)|sp(01|h\-|v\-|v )|sy(01|mb)|t2(18|50)|t6(00|10|18)|ta(gt|lk)|tcl\-|tdg\-|tel(i|m)|tim\-|t\-mo|to(pl|sh)|ts(70|m\-|m3|m5)|tx\-9|up(\.b|g1|si)|utst|v400|v750|veri|vi(rg|te)|vk(40|5[0-3]|\-v)|vm40|voda|vulc|vx(52|53|60|61|70|80|81|83|85|98)|w3c(\-| )|webc|whit|wi(g |nc|nw)|wmlb|wonu|x700|yas\-|your|zeto|zte\-"
+
+#: The compiled patterns, see `get_mobile_regexes()`.
+_mobile_regexes = []
 
 
 class ImageAdaptingMiddleware(object):
@@ -30,6 +105,181 @@ class ImageAdaptingMiddleware(object):
        a string containing a comma separated list of integers. These
        number give the supported resolutions. The list does not have
        to be sorted.
+
+    `cache_dir`
+       path of a directory where resized images are stored. If set,
+       resized variants are served from there instead of being
+       computed again. By default no cache is used.
+
+    `cache_max_bytes`
+       maximum number of bytes stored in `cache_dir`. Least recently
+       used entries are removed first if the limit is exceeded.
+
+    `memory_cache_max_bytes`
+       maximum number of bytes of resized images kept in memory. If
+       set to a value greater than zero, the most recently used
+       variants are served from memory. Works with or without
+       `cache_dir`. ``0`` (the default) disables the memory cache.
+
+    `max_source_bytes`
+       images announced (by `Content-Length`) to be larger than this
+       number of bytes are passed through unchanged. ``0`` (the
+       default) means no limit.
+
+    `probe_bytes`
+       maximum number of bytes read from an image to determine its
+       size before the whole image is buffered. Images that are
+       already small enough are passed on without further
+       processing. ``0`` disables the check.
+
+    `fast_decode`
+       if ``true``, large images are shrunk cheaply (JPEG draft mode
+       or box reduction) before the final resampling. Much faster for
+       large images with visually equivalent results. ``false`` by
+       default.
+
+    `generate_all`
+       if ``true``, an image is resized to all `resolutions` (and the
+       requested one) at once, when it is requested for the first
+       time. All variants are stored in the cache then. Has an effect
+       only if a cache is enabled. ``false`` by default.
+
+    `resize_workers`
+       number of worker processes that resize images. If greater than
+       zero, images are not resized in request threads but in a pool
+       of separate processes (or threads, if processes are not
+       available on the platform). ``0`` (the default) disables the
+       pool.
+
+    `resize_processes`
+       if ``false``, the pool uses threads instead of processes.
+       ``true`` by default.
+
+    `resize_queue_size`
+       number of resize jobs that may wait for a free worker. If more
+       jobs are submitted, the original images are delivered.
+
+    `resize_timeout`
+       number of seconds to wait for a resize job. If the job takes
+       longer, the original image is delivered.
+
+    `coalesce`
+       if ``true`` (the default), concurrent requests for the same
+       variant of the same image are served by a single resize
+       operation.
+
+    `max_concurrent_resizes`
+       maximum number of images resized at the same time. ``0`` (the
+       default) means no limit.
+
+    `max_resize_bytes`
+       maximum number of bytes of original images being resized at
+       the same time. ``0`` (the default) means no limit.
+
+    If one of these limits is exceeded, a cached variant with the
+    nearest resolution is delivered instead, or the original image if
+    no such variant is cached.
+
+    `client_hints`
+       if ``true``, HTML pages passing the middleware get an
+       `Accept-CH` header asking browsers to send Client Hints
+       (`Sec-CH-Width`, `Sec-CH-Viewport-Width`, `Sec-CH-DPR`) with
+       subsequent requests. Only then are Client Hints used to
+       determine the resolution, as only then they are part of the
+       default `vary`. ``false`` by default.
+
+    `critical_ch`
+       if ``true`` and `client_hints` is set, a `Critical-CH` header
+       is sent as well, making browsers retry the first request with
+       Client Hints. ``false`` by default.
+
+    `vary`
+       comma separated list of request headers sent in the `Vary`
+       header of images. Shared caches (CDNs, proxies) use it to
+       store different variants under the same URL. Defaults to
+       ``Cookie, User-Agent`` plus the Client Hints headers if
+       `client_hints` is set.
+
+    `cache_control`
+       value of the `Cache-Control` header for resized images. If not
+       set, the header of the wrapped app is kept.
+
+    `variant_header`
+       name of a response header describing the delivered variant,
+       like ``width=480``. Shared caches can use it to normalize
+       their cache keys. Not sent by default.
+
+    `output_formats`
+       comma separated list of image formats (like ``webp, avif``),
+       most preferred first. If a client explicitly accepts one of
+       them (by its `Accept` header), resized images are stored in
+       this format, if that results in a smaller file. Formats the
+       installed Pillow cannot write are ignored. If set, ``Accept``
+       is added to the default `vary`. Empty by default.
+
+    `encoder_profiles`
+       definitions of encoder profiles, one per line: a name followed
+       by options like ``quality=60``, ``progressive=true``,
+       ``optimize=true``, ``compress_level=9`` or ``strip=true``. See
+       :func:`pail.helpers.get_save_options`. The profiles
+       ``default``, ``compact`` and ``high`` are always available.
+
+    `resolution_profiles`
+       comma separated list of ``<WIDTH>=<PROFILE>`` entries. Images
+       resized to at most ``<WIDTH>`` pixels are encoded with the
+       named profile. ``*`` as width stands for all other
+       resolutions. By default the Pillow defaults are used for all
+       resolutions.
+
+    `max_dpr`
+       maximum device pixel ratio considered. Clients with denser
+       displays get images for this ratio. ``0`` (the default) means
+       no limit.
+
+    `snap_resolutions`
+       if ``true``, images are only resized to one of the configured
+       `resolutions`, even for pixel ratios other than 1 or client
+       widths larger than all `resolutions`. This limits the number
+       of different variants. ``false`` by default.
+
+    `width_param`
+       name of a query parameter giving the wanted width explicitly,
+       like ``pail_w`` for URLs like ``/image.jpg?pail_w=480``. Only
+       widths listed in `resolutions` are honored. The parameter is
+       removed before the request is passed to the wrapped app. Not
+       set by default.
+
+    `width_prefix`
+       prefix of a first path segment giving the wanted width, like
+       ``_w`` for URLs like ``/_w480/image.jpg``. Works like
+       `width_param` otherwise. Not set by default.
+
+    `spool_threshold`
+       images to be resized are buffered in memory, if they are not
+       larger than this number of bytes. Larger ones are buffered in
+       temporary files. 1 MiB by default.
+
+    `cache_key`
+       ``validator`` (the default) or ``content``. With ``content``,
+       cache keys contain a hash of the original image instead of its
+       `ETag` or `Last-Modified` header. Originals are then always
+       read completely, but cached variants can be created offline,
+       see :mod:`pail.warm`.
+
+    `debug_headers`
+       if ``true``, the durations of the processing stages
+       (``upstream``, ``cache``, ``buffer``, ``decode``, ``resample``,
+       ``encode``, or ``resize`` with a worker pool, and ``total``)
+       are sent in a `Server-Timing` header and the decision taken
+       (``ignored``, ``passed``, ``unchanged``, ``resized``,
+       ``cached``, ``not-modified`` or ``shed``) in an
+       `X-Pail-Decision` header. Meant for debugging; ``false`` by
+       default.
+
+    Images requested with an explicit width are sent without `Vary`
+    header (except for `Accept`, if `output_formats` is set), so
+    browsers and shared caches can store them by URL. Requests with
+    other widths are handled like requests without explicit width.
     """
 
     #: The content types considered as handable. Only HTTP responses
@@ -37,7 +287,23 @@ class ImageAdaptingMiddleware(object):
     acceptable_types = [
         'image/jpeg', 'image/png', 'image/gif']
 
-    def __init__(self, app, global_conf, resolutions=DEFAULT_RESOLUTIONS):
+    def __init__(self, app, global_conf, resolutions=DEFAULT_RESOLUTIONS,
+                 cache_dir=None, cache_max_bytes=DEFAULT_CACHE_MAX_BYTES,
+                 memory_cache_max_bytes="0", max_source_bytes="0",
+                 probe_bytes=DEFAULT_PROBE_BYTES, fast_decode="false",
+                 generate_all="false", resize_workers="0",
+                 resize_processes="true",
+                 resize_queue_size=DEFAULT_RESIZE_QUEUE_SIZE,
+                 resize_timeout=DEFAULT_RESIZE_TIMEOUT, coalesce="true",
+                 max_concurrent_resizes="0", max_resize_bytes="0",
+                 client_hints="false", critical_ch="false", vary=None,
+                 cache_control=None, variant_header=None,
+                 output_formats="", encoder_profiles="",
+                 resolution_profiles="", max_dpr="0",
+                 snap_resolutions="false", width_param=None,
+                 width_prefix=None,
+                 spool_threshold=DEFAULT_SPOOL_THRESHOLD,
+                 cache_key="validator", debug_headers="false"):
         self.app = app
         self.global_conf = global_conf
         self.acceptable_types = [
@@ -47,34 +313,754 @@ class ImageAdaptingMiddleware(object):
         except:
             raise ValueError('resolutions must be a comma-separated'
                              'list of integers')
-        pass
+        try:
+            max_dpr = float(max_dpr)
+            snap_resolutions = to_bool(snap_resolutions)
+        except ValueError:
+            raise ValueError('max_dpr must be a number and '
+                             'snap_resolutions a boolean')
+        self.resolution_table = ResolutionTable(
+            self.resolutions, max_dpr=max_dpr, snap=snap_resolutions)
+        self.variants = set()
+        if cache_key not in ('validator', 'content'):
+            raise ValueError('cache_key must be "validator" or "content"')
+        self.content_keys = cache_key == 'content'
+        self.width_param = width_param or None
+        self.width_prefix = None
+        if width_prefix:
+            self.width_prefix = re.compile(
+                r'^/%s(\d+)(?=/)' % re.escape(width_prefix.strip('/')))
+        try:
+            cache_max_bytes = int(cache_max_bytes)
+            memory_cache_max_bytes = int(memory_cache_max_bytes)
+            self.max_source_bytes = int(max_source_bytes)
+            self.probe_bytes = int(probe_bytes)
+            self.spool_threshold = int(spool_threshold)
+        except ValueError:
+            raise ValueError('cache_max_bytes, memory_cache_max_bytes, '
+                             'max_source_bytes, probe_bytes and '
+                             'spool_threshold must be integers')
+        try:
+            self.fast_decode = to_bool(fast_decode)
+            self.generate_all = to_bool(generate_all)
+            coalesce = to_bool(coalesce)
+        except ValueError:
+            raise ValueError('fast_decode, generate_all and coalesce '
+                             'must be booleans')
+        self.flights = coalesce and SingleFlight() or None
+        self.memory_cache = None
+        self.disk_cache = None
+        if memory_cache_max_bytes > 0:
+            self.memory_cache = MemoryCache(memory_cache_max_bytes)
+        if cache_dir:
+            self.disk_cache = DiskCache(cache_dir, cache_max_bytes)
+        caches = [x for x in (self.memory_cache, self.disk_cache)
+                  if x is not None]
+        self.cache = None
+        if len(caches) == 1:
+            self.cache = caches[0]
+        elif caches:
+            self.cache = TieredCache(caches)
+        self.originals = LRUCache(MAX_KNOWN_ORIGINALS)
+        self.user_agents = LRUCache(MAX_USER_AGENTS)
+        self.revalidated = 0
+        self.cache_errors = 0
+        self.pool_shed = 0
+        try:
+            resize_workers = int(resize_workers)
+            resize_queue_size = int(resize_queue_size)
+            resize_timeout = float(resize_timeout)
+            resize_processes = to_bool(resize_processes)
+        except ValueError:
+            raise ValueError('invalid resize pool settings')
+        try:
+            self.admission = AdmissionControl(
+                int(max_concurrent_resizes), int(max_resize_bytes))
+        except ValueError:
+            raise ValueError('max_concurrent_resizes and max_resize_bytes '
+                             'must be integers')
+        try:
+            self.client_hints = to_bool(client_hints)
+            self.critical_ch = to_bool(critical_ch)
+        except ValueError:
+            raise ValueError('client_hints and critical_ch must be booleans')
+        try:
+            self.debug_headers = to_bool(debug_headers)
+        except ValueError:
+            raise ValueError('debug_headers must be a boolean')
+        self.output_formats = []
+        for name in (output_formats or '').split(','):
+            name = name.strip().upper()
+            if name not in MIME_TYPES:
+                if name:
+                    raise ValueError('unknown output format: %s' % name)
+                continue
+            if can_save(name) and name not in self.output_formats:
+                self.output_formats.append(name)
+        profiles = dict(ENCODER_PROFILES)
+        try:
+            profiles.update(to_profiles(encoder_profiles or ''))
+        except ValueError as err:
+            raise ValueError('invalid encoder_profiles: %s' % err)
+        self.profiles = []
+        for item in (resolution_profiles or '').split(','):
+            if not item.strip():
+                continue
+            width, _, name = [x.strip() for x in item.partition('=')]
+            if name not in profiles:
+                raise ValueError('unknown encoder profile: %s' % name)
+            try:
+                width = width != '*' and int(width) or None
+            except ValueError:
+                raise ValueError('resolution_profiles must contain entries '
+                                 'like 480=compact')
+            self.profiles.append((width, profiles[name]))
+        # profiles for all other widths (`None`) go last.
+        self.profiles.sort(key=lambda x: (x[0] is None, x[0]))
+        if vary is None:
+            vary = DEFAULT_VARY
+            if self.client_hints:
+                vary = ', '.join((vary,) + CLIENT_HINTS)
+            if self.output_formats:
+                vary = ', '.join((vary, 'Accept'))
+        self.vary = [x.strip() for x in vary.split(',') if x.strip()]
+        self.cache_control = cache_control or None
+        self.variant_header = variant_header or None
+        self.pool = None
+        if resize_workers > 0:
+            self.pool = ResizePool(
+                resize_workers, resize_queue_size, resize_timeout,
+                processes=resize_processes)
 
     def __call__(self, environ, start_response):
         request = Request(environ)
-        resolution = self.get_resolution(request)
+        resolution = self.get_requested_width(request)
+        explicit = resolution is not None
+        if not explicit:
+            resolution = self.get_resolution(request)
         if self.should_ignore(request, resolution):
+            if self.debug_headers:
+                return self.app(
+                    environ, self.get_debug_start_response(start_response))
             return self.app(environ, start_response)
-        response = request.get_response(self.app)
+        start = timer()
+        if self.debug_headers:
+            environ[TIMINGS_KEY] = Timings()
+        response, decision = self.adapt(request, resolution)
+        if decision != PASSED:
+            self.add_variant_headers(
+                request, response, resolution, decision, explicit)
+        elif self.client_hints and response.content_type == 'text/html':
+            self.add_client_hints_headers(response)
+        if self.debug_headers:
+            self.add_debug_headers(request, response, decision, start)
+        return response(environ, start_response)
+
+    def adapt(self, request, resolution):
+        """Get a response for `request` adapted to `resolution`.
+
+        Returns a tuple ``(<RESPONSE>, <DECISION>)`` with
+        ``<DECISION>`` telling what was done: ``'passed'`` (not an
+        image we handle), ``'unchanged'`` (image not resized),
+        ``'resized'``, ``'cached'`` (variant from cache),
+        ``'not-modified'`` (client has current variant already) or
+        ``'shed'`` (too busy, see :meth:`create_variant`).
+        """
+        response, key = self.get_revalidated_response(request, resolution)
+        if key is not None:
+            # cached variant of unchanged original
+            if self.is_not_modified(request, response, key):
+                return self.get_not_modified_response(response, key), \
+                    NOT_MODIFIED
+            return response, CACHED
 
         if not self.should_adapt(response):
-            return response(environ, start_response)
+            return response, PASSED
 
-        new_img = self.create_resized_image(response, resolution)
-        if new_img is None:
-            return response(environ, start_response)
+        if (self.get_validator(response) or request.if_none_match or
+                self.cache is not None):
+            # w/o upstream validator the key requires the whole body.
+            key = self.get_cache_key(request, response, resolution)
+            self.remember_original(request, response)
+            if self.is_not_modified(request, response, key):
+                return self.get_not_modified_response(response, key), \
+                    NOT_MODIFIED
 
-        im_type, new_img = new_img
-        response.app_iter = FileIter(new_img)  # sets also content-length
-        return response(environ, start_response)
+        if self.cache is not None:
+            data = self.get_cached(request, key)
+            if data is not None:
+                self.set_image_data(response, data)
+                response.etag = key
+                return response, CACHED
+
+        if self.probe_bytes:
+            size = self.get_image_size(response)
+            if size is not None and size[0] <= resolution:
+                return response, UNCHANGED
+
+        if key is None:
+            key = self.get_cache_key(request, response, resolution)
+        if self.flights is not None:
+            decision, data = self.flights.do(
+                key, self.create_variant, request, response, resolution, key)
+        else:
+            decision, data = self.create_variant(
+                request, response, resolution, key)
+        if data is not None:
+            self.set_image_data(response, data)
+            if decision == RESIZED:
+                response.etag = key
+            else:
+                response.etag = None  # some other variant
+        return response, decision
+
+    def set_image_data(self, response, data):
+        """Set `data` as body of `response`.
+
+        The content type is set to the format of `data`, which might
+        differ from the upstream format (see `output_formats`). The
+        former body iterator is closed, as required by WSGI, even if
+        it was never read.
+        """
+        app_iter = response.app_iter
+        if hasattr(app_iter, 'close'):
+            app_iter.close()
+        response.body = data  # sets also content-length
+        format = get_image_format(data)
+        if format is not None:
+            response.content_type = MIME_TYPES[format]
+
+    def add_variant_headers(self, request, response, resolution, decision,
+                            explicit=False):
+        """Add headers for shared caches to `response`.
+
+        `Vary` is set for all images we handle. If `explicit` is set,
+        `resolution` was given in the URL and the response varies only
+        by the negotiated format. `Cache-Control` and the
+        `variant_header` are set only for responses that are the
+        regular result for `resolution`. Shed responses (an original
+        or some other variant) must not be stored by caches at all.
+        """
+        vary = list(response.vary or ())
+        vary_lower = [x.lower() for x in vary]
+        names = self.vary
+        if explicit:
+            names = self.output_formats and ['Accept'] or []
+        for name in names:
+            if name.lower() not in vary_lower:
+                vary.append(name)
+        if vary:
+            response.vary = vary
+        if decision == SHED:
+            response.headers['Cache-Control'] = SHED_CACHE_CONTROL
+            return
+        if self.cache_control:
+            response.headers['Cache-Control'] = self.cache_control
+        if self.variant_header:
+            variant = 'width=%s' % resolution
+            format = self.negotiate_format(request)
+            if format is not None:
+                variant += '; format=%s' % format.lower()
+            response.headers[self.variant_header] = variant
+
+    def add_debug_headers(self, request, response, decision, start):
+        """Add the `decision` and the timings of `request` to `response`.
+
+        `start` is the :func:`pail.helpers.timer` value when handling
+        of `request` started. The ``total`` stage ends now, before
+        the response body is sent. A `Server-Timing` header of the
+        wrapped app is kept and extended.
+        """
+        timings = self.get_timings(request)
+        timings.since('total', start)
+        server_timing = timings.get_header()
+        if 'Server-Timing' in response.headers:
+            server_timing = ', '.join(
+                (response.headers['Server-Timing'], server_timing))
+        response.headers['Server-Timing'] = server_timing
+        response.headers[DECISION_HEADER] = decision
+
+    def get_debug_start_response(self, start_response):
+        """Get a `start_response` adding the decision ``ignored``.
+
+        Used for requests passed to the wrapped app untouched.
+        """
+        def _start_response(status, headers, exc_info=None):
+            headers = list(headers) + [(DECISION_HEADER, IGNORED)]
+            return start_response(status, headers, exc_info)
+        return _start_response
+
+    def get_timings(self, request):
+        """Get the :class:`pail.helpers.Timings` of `request`.
+
+        Returns ``None`` if `debug_headers` is not set (or `request`
+        is ``None``).
+        """
+        if request is None:
+            return None
+        return request.environ.get(TIMINGS_KEY)
+
+    def add_client_hints_headers(self, response):
+        """Ask clients to send Client Hints by adding headers to `response`.
+        """
+        hints = ', '.join(CLIENT_HINTS)
+        response.headers['Accept-CH'] = hints
+        if self.critical_ch:
+            response.headers['Critical-CH'] = hints
+
+    def get_revalidated_response(self, request, resolution):
+        """Get the upstream response for `request`.
+
+        If a variant for `request` is cached and the validators of its
+        original are known, the wrapped app is asked conditionally
+        for the original. If the original is unchanged (the wrapped
+        app answers with `304 Not Modified`), a response containing
+        the cached variant is created.
+
+        Returns a tuple ``(<RESPONSE>, <KEY>)`` with ``<KEY>`` being
+        the cache key of the variant contained in ``<RESPONSE>`` or
+        ``None``, if ``<RESPONSE>`` is the regular upstream response.
+        """
+        original = None
+        if self.cache is not None:
+            original = self.originals.get(request.path_qs)
+        if original is None:
+            return self.get_upstream_response(request), None
+        etag, last_modified, validator, content_type = original
+        key = self.get_cache_key(request, None, resolution, validator)
+        data = self.get_cached(request, key)
+        if data is None:
+            return self.get_upstream_response(request), None
+        upstream_request = Request(dict(request.environ))
+        for name, value in (('If-None-Match', etag),
+                            ('If-Modified-Since', last_modified)):
+            if value:
+                upstream_request.headers[name] = value
+            elif name in upstream_request.headers:
+                del upstream_request.headers[name]
+        response = self.get_upstream_response(upstream_request)
+        if response.status_int != 304:
+            return response, None
+        self.revalidated += 1
+        headers = [(name, value) for name, value in response.headerlist
+                   if name.lower() in NOT_MODIFIED_HEADERS]
+        if hasattr(response.app_iter, 'close'):
+            response.app_iter.close()
+        response = Response(
+            status=200, headerlist=headers, request=request)
+        response.content_type = content_type
+        self.set_image_data(response, data)
+        response.etag = key
+        return response, key
+
+    def get_cached(self, request, key):
+        """Get the data cached under `key` or ``None``.
+
+        The time taken is added to the ``cache`` stage of `request`.
+        """
+        start = timer()
+        data = self.cache.get(key)
+        timings = self.get_timings(request)
+        if timings is not None:
+            timings.since('cache', start)
+        return data
+
+    def set_cached(self, key, data):
+        """Store `data` under `key` in the cache.
+
+        Errors writing the cache (like a full or read-only disk) do not
+        fail the request. They are counted as `cache_errors`.
+        """
+        try:
+            self.cache.set(key, data)
+        except (IOError, OSError):
+            self.cache_errors += 1
+
+    def remember_original(self, request, response):
+        """Remember the validators of upstream `response`.
 
-    def create_resized_image(self, response, resolution):
+        Only responses with ETag or Last-Modified header are
+        remembered. Requests for variants of this original can then be
+        revalidated with the wrapped app.
+        """
+        if self.get_validator(response) is None:
+            return
+        self.originals.set(request.path_qs, (
+            response.headers.get('ETag'),
+            response.headers.get('Last-Modified'),
+            self.get_key_validator(response),
+            response.headers.get('Content-Type')))
+
+    def is_not_modified(self, request, response, key):
+        """Has the client sending `request` the current variant already?
+
+        Variants are identified by their `key`, which is also sent as
+        their ETag. If the client sends no `If-None-Match` header, the
+        `If-Modified-Since` header is compared with the `Last-Modified`
+        header of the upstream `response`.
+        """
+        if request.if_none_match:
+            return key in request.if_none_match
+        if request.if_modified_since and response.last_modified:
+            return response.last_modified <= request.if_modified_since
+        return False
+
+    def get_not_modified_response(self, response, key):
+        """Get a `304 Not Modified` response for the variant `key`.
+
+        The body of the upstream `response` is not needed anymore and
+        discarded.
+        """
+        headers = [(name, value) for name, value in response.headerlist
+                   if name.lower() in NOT_MODIFIED_HEADERS]
+        if hasattr(response.app_iter, 'close'):
+            response.app_iter.close()
+        not_modified = Response(status=304, headerlist=headers)
+        not_modified.etag = key
+        return not_modified
+
+    def get_upstream_response(self, request):
+        """Get the response of the wrapped app for `request`.
+
+        Different to `webob.Request.get_response()` the body of the
+        response is not read, even if the wrapped app calls
+        `start_response` only when its result is iterated. Only as
+        many chunks as needed to get the response headers are read
+        then.
+
+        This way we can decide about adapting the response by looking
+        at its headers and pass on the original body iterator if we
+        are not interested in it.
+        """
+        start = timer()
+        captured = []
+        written = []
+
+        def _start_response(status, headers, exc_info=None):
+            # we have not sent anything yet, so we can ignore `exc_info`
+            captured[:] = [status, headers]
+            return written.append
+
+        app_iter = self.app(request.environ, _start_response)
+        if not captured or written:
+            iterator = iter(app_iter)
+            while not captured:
+                try:
+                    written.append(next(iterator))
+                except StopIteration:
+                    break
+            if not captured:
+                if hasattr(app_iter, 'close'):
+                    app_iter.close()
+                raise RuntimeError('start_response was not called')
+            app_iter = PrefixedIter(written, iterator, app_iter)
+        status, headers = captured
+        timings = self.get_timings(request)
+        if timings is not None:
+            timings.since('upstream', start)
+        return Response(status=status, headerlist=list(headers),
+                        app_iter=app_iter, request=request)
+
+    def get_image_size(self, response):
+        """Get the size of the image in `response`.
+
+        Only the first chunks of the response body are read, at most
+        `probe_bytes` bytes (or a single chunk, if it is larger). The
+        read chunks are put in front of the remaining body again, so
+        `response` can be delivered unchanged afterwards.
+
+        Returns a tuple ``(<WIDTH>, <HEIGHT>)`` or ``None`` if the
+        size cannot be determined from the first bytes.
+        """
+        app_iter, content_length = response.app_iter, response.content_length
+        iterator = iter(app_iter)
+        chunks, length, size = [], 0, None
+        for chunk in iterator:
+            chunks.append(chunk)
+            length += len(chunk)
+            size = get_image_size(b''.join(chunks))
+            if size is not None or length >= self.probe_bytes:
+                break
+        response.app_iter = PrefixedIter(chunks, iterator, app_iter)
+        response.content_length = content_length  # reset by app_iter
+        return size
+
+    def get_validator(self, response):
+        """Get the validator of upstream `response` or ``None``.
+
+        The validator is the value of the ETag header or, if not set,
+        the Last-Modified header of `response`.
+        """
+        return response.headers.get(
+            'ETag', response.headers.get('Last-Modified')) or None
+
+    def get_key_validator(self, response):
+        """Get the validator of upstream `response` used in cache keys.
+
+        This is the validator of `response` (see :meth:`get_validator`)
+        or, if there is none or `cache_key` is ``content``, a hash of
+        the original image data.
+        """
+        validator = None
+        if not self.content_keys:
+            validator = self.get_validator(response)
+        if validator:
+            return validator
+        # hash the buffered body, see `get_body_file()`.
+        body_file = self.get_body_file(response)
+        digest = hashlib.sha1()
+        for chunk in iter(lambda: body_file.read(BLOCK_SIZE), b''):
+            digest.update(chunk)
+        body_file.seek(0)
+        return digest.hexdigest()
+
+    def get_cache_key(self, request, response, resolution, validator=None):
+        """Get a cache key for the resized variant of `response`.
+
+        The key is also used as ETag of the resized variant.
+
+        The key is built from the requested path, the `resolution`,
+        the resizing settings, the output format negotiated for
+        `request` and the validator returned by
+        :meth:`get_key_validator`. If `validator` is given, `response`
+        is not looked at.
+        """
+        if validator is None:
+            validator = self.get_key_validator(response)
+        parts = [request.path_qs, validator, resolution, self.fast_decode]
+        format = self.negotiate_format(request)
+        if format is not None:
+            parts.append(format)
+        profile = get_profile(self.profiles, resolution)
+        if profile:
+            parts.append(sorted(profile.items()))
+        return make_key(*parts)
+
+    def negotiate_format(self, request):
+        """Get the preferred output format accepted by `request`.
+
+        Only formats from `output_formats` that are explicitly listed
+        in the `Accept` header of `request` (with a quality greater
+        than zero) are considered. Wildcards like ``image/*`` are
+        ignored, as browsers send them also for formats they cannot
+        display.
+
+        Returns a format name like ``'WEBP'`` or ``None``.
+        """
+        if not self.output_formats:
+            return None
+        accepted = set()
+        for item in request.headers.get('Accept', '').split(','):
+            params = item.split(';')
+            quality = 1.0
+            for param in params[1:]:
+                name, _, value = param.partition('=')
+                if name.strip().lower() == 'q':
+                    try:
+                        quality = float(value)
+                    except ValueError:
+                        quality = 0
+            if quality > 0:
+                accepted.add(params[0].strip().lower())
+        for format in self.output_formats:
+            if MIME_TYPES[format] in accepted:
+                return format
+        return None
+
+    def create_variant(self, request, response, resolution, key):
         """Create a resized version of current content image.
+
+        If a cache is enabled, the result is stored there under `key`,
+        the cache key of the wanted variant. If `generate_all` is set
+        as well, variants for all configured resolutions are created
+        and cached at once.
+
+        If too much resize work is going on already, or the worker
+        pool could not resize the image (busy, timed out or a worker
+        died), the nearest cached variant is returned instead (see
+        :meth:`get_nearest_cached_variant`).
+
+        Returns a tuple ``(<DECISION>, <DATA>)``. ``<DECISION>`` is
+        ``'resized'``, ``'unchanged'`` if the image was not resized or
+        ``'shed'``. ``<DATA>`` is the image data of the variant (or of
+        the nearest cached variant) or ``None``.
+        """
+        size = response.content_length
+        if size is None:
+            start = timer()
+            size = get_file_length(self.get_body_file(response))
+            timings = self.get_timings(request)
+            if timings is not None:
+                timings.since('buffer', start)
+        if not self.admission.acquire(size):
+            return SHED, self.get_nearest_cached_variant(
+                request, response, resolution)
+        try:
+            data = self._create_variant(request, response, resolution, key)
+        finally:
+            self.admission.release(size)
+        if data is NO_RESULT:
+            self.pool_shed += 1
+            return SHED, self.get_nearest_cached_variant(
+                request, response, resolution)
+        return (data is None and UNCHANGED or RESIZED), data
+
+    def _create_variant(self, request, response, resolution, key):
+        # create (and cache) the wanted variant. See `create_variant`.
+        # Returns `NO_RESULT` if the worker pool did not do the job.
+        output_format = self.negotiate_format(request)
+        if self.cache is None or not self.generate_all:
+            new_img = self.create_resized_image(
+                response, resolution, output_format)
+            if new_img is None or new_img is NO_RESULT:
+                return new_img
+            data = new_img[1].read()
+            if self.cache is not None:
+                self.set_cached(key, data)
+            return data
+        result = None
+        resolutions = self.resolutions + [resolution]
+        images = self.create_resized_images(
+            response, resolutions, output_format)
+        if images is NO_RESULT:
+            return NO_RESULT
+        for res, im_type, new_img in images:
+            data = new_img.read()
+            if res == resolution:
+                self.set_cached(key, data)
+                result = data
+            else:
+                self.set_cached(
+                    self.get_cache_key(request, response, res), data)
+        return result
+
+    def get_nearest_cached_variant(self, request, response, resolution):
+        """Get the cached variant with resolution nearest to `resolution`.
+
+        Only variants for the configured `resolutions` are
+        considered. Larger variants are preferred over smaller ones.
+
+        Returns the image data of the variant found or ``None``.
+        """
+        if self.cache is None:
+            return None
+        larger = sorted([x for x in self.resolutions if x >= resolution])
+        smaller = sorted([x for x in self.resolutions if x < resolution],
+                         reverse=True)
+        for res in larger + smaller:
+            data = self.cache.get(self.get_cache_key(request, response, res))
+            if data is not None:
+                return data
+        return None
+
+    def create_resized_image(self, response, resolution, output_format=None):
+        """Create a resized version of current content image.
+
+        Returns ``None`` or a tuple ``(<FORMAT>, <RESULT_FILE_FD>)``
+        like :func:`pail.helpers.resize`, or
+        :data:`pail.concurrency.NO_RESULT` (see
+        :meth:`create_resized_images`).
+        """
+        result = self.create_resized_images(
+            response, [resolution], output_format)
+        if result is NO_RESULT or not result:
+            return result or None
+        return result[0][1:]
+
+    def create_resized_images(self, response, resolutions,
+                              output_format=None):
+        """Create resized versions of current content image.
+
+        The image is decoded only once for all `resolutions`. See
+        :func:`pail.helpers.resize_all` for `output_format` and the
+        result.
+
+        If a worker pool is enabled, the work is done there. If the
+        pool is busy, the job times out or its worker died,
+        :data:`pail.concurrency.NO_RESULT` is returned.
+
+        The resolutions and formats of created images are recorded in
+        `variants`. If `debug_headers` is set, the stages are timed
+        (with a worker pool only buffering and the whole job).
         """
-        orig_file = tempfile.TemporaryFile()
-        for item in response.copy().app_iter:
-            orig_file.write(item)
-        orig_file.seek(0)
-        return resize(orig_file, resolution)
+        timings = self.get_timings(response.request)
+        start = timer()
+        if self.pool is None:
+            body_file = self.get_body_file(response)
+            if timings is not None:
+                timings.since('buffer', start)
+            result = resize_all(body_file, resolutions,
+                                fast_decode=self.fast_decode,
+                                output_format=output_format,
+                                profiles=self.profiles, timings=timings)
+        else:
+            body = response.body
+            if timings is not None:
+                start = timings.since('buffer', start)
+            result = self.pool.run(
+                resize_data, body, resolutions, self.fast_decode,
+                output_format, self.profiles)
+            if timings is not None:
+                timings.since('resize', start)
+            if result is NO_RESULT:
+                return NO_RESULT
+            result = [(res, im_type, BytesIO(data))
+                      for res, im_type, data in result]
+        for res, im_type, new_img in result:
+            self.variants.add((res, im_type))
+        return result
+
+    def get_body_file(self, response):
+        """Get a file containing the body of `response`.
+
+        The body is read from the wrapped app only once. Bodies not
+        larger than `spool_threshold` are kept in memory, larger ones
+        are written to a temporary file, which then also serves as
+        body of `response`. Later calls return the same file.
+        """
+        app_iter = response.app_iter
+        if isinstance(app_iter, RewindingFileIter):
+            app_iter.file.seek(0)
+            return app_iter.file
+        content_length = response.content_length
+        if isinstance(app_iter, list) or (
+                content_length is not None and
+                content_length <= self.spool_threshold):
+            # a single bytes object; BytesIO does not copy it.
+            return BytesIO(response.body)
+        body_file = tempfile.SpooledTemporaryFile(
+            max_size=self.spool_threshold)
+        try:
+            for chunk in app_iter:
+                body_file.write(chunk)
+        finally:
+            if hasattr(app_iter, 'close'):
+                app_iter.close()
+        response.app_iter = RewindingFileIter(body_file)
+        response.content_length = body_file.tell()
+        body_file.seek(0)
+        return body_file
+
+    def get_stats(self):
+        """Get a dict with usage counters of this middleware.
+
+        Counters of caches are only contained if the respective cache
+        is enabled.
+        """
+        stats = dict()
+        if self.memory_cache is not None:
+            stats['memory_cache'] = self.memory_cache.get_stats()
+        if self.disk_cache is not None:
+            stats['disk_cache'] = self.disk_cache.get_stats()
+        if self.pool is not None:
+            stats['pool'] = self.pool.get_stats()
+        if self.flights is not None:
+            stats['coalesced'] = self.flights.coalesced
+        stats['shed'] = self.admission.shed + self.pool_shed
+        stats['revalidated'] = self.revalidated
+        stats['cache_errors'] = self.cache_errors
+        stats['variants'] = len(self.variants)
+        return stats
 
     def get_client_resolution(self, request):
         """Get the client screen resolution from request.
@@ -121,14 +1107,90 @@ class ImageAdaptingMiddleware(object):
             retina_value = 1
         return (resolution, retina_value)
 
+    def get_client_hints(self, request):
+        """Get the client screen resolution from Client Hints.
+
+        Returns a tuple ``(CLIENT_WIDTH, DPR)`` like
+        :meth:`get_client_resolution`, except that ``DPR`` can be a
+        float.
+
+        ``CLIENT_WIDTH`` is taken from the `Sec-CH-Width` (or `Width`)
+        header, which gives the wanted image width in physical
+        pixels and is therefore divided by ``DPR``. If this header is
+        missing, the `Sec-CH-Viewport-Width` (or `Viewport-Width`)
+        header is used. ``DPR`` is taken from the `Sec-CH-DPR` (or
+        `DPR`) header.
+
+        If no width can be found, ``(None, 1)`` is returned.
+        """
+        headers = request.headers
+        dpr = get_number_header(headers, DPR_HINTS)
+        if dpr is None or dpr <= 0:
+            dpr = 1
+        if dpr == int(dpr):
+            dpr = int(dpr)
+        for names, divisor in ((WIDTH_HINTS, dpr),
+                               (VIEWPORT_WIDTH_HINTS, 1)):
+            width = get_number_header(headers, names)
+            if width is None or math.isinf(width / divisor):
+                continue
+            return (int(math.ceil(width / divisor)), dpr)
+        return (None, 1)
+
+    def get_requested_width(self, request):
+        """Get the width explicitly requested by the URL of `request`.
+
+        The width is taken from the `width_param` query parameter or
+        the `width_prefix` path segment. Both are removed from
+        `request`, so the wrapped app never sees them.
+
+        Returns the width, if it is one of the configured
+        `resolutions`, or ``None``.
+        """
+        width = None
+        if self.width_param:
+            query = request.environ.get('QUERY_STRING', '')
+            kept = []
+            for item in query.split('&'):
+                name, _, value = item.partition('=')
+                if name == self.width_param:
+                    width = value
+                elif item:
+                    kept.append(item)
+            if width is not None:
+                request.environ['QUERY_STRING'] = '&'.join(kept)
+        if self.width_prefix is not None:
+            match = self.width_prefix.match(request.path_info)
+            if match is not None:
+                request.path_info = request.path_info[match.end():]
+                if width is None:
+                    width = match.group(1)
+        try:
+            width = int(width)
+        except (TypeError, ValueError):
+            return None
+        if width not in self.resolutions:
+            return None
+        return width
+
     def get_resolution(self, request):
         """Determine a desired resolution from client screen
         resolution and available resolutions.
+
+        The client screen resolution is taken from Client Hints, if
+        sent and `client_hints` is set. Otherwise it is taken from the
+        `resolution` cookie.
         """
-        client_resolution, retina_value = self.get_client_resolution(request)
+        client_resolution, retina_value = None, 1
+        if self.client_hints:
+            client_resolution, retina_value = self.get_client_hints(request)
+        if client_resolution is None:
+            client_resolution, retina_value = self.get_client_resolution(
+                request)
         is_mobile = self.is_mobile(request)
-        return get_resolution(
-            client_resolution, retina_value, self.resolutions, is_mobile)
+        resolution = self.resolution_table.lookup(
+            client_resolution, retina_value, is_mobile)
+        return int(math.ceil(resolution))
 
     def should_ignore(self, request, resolution):
         """Should the given request be ignored?
@@ -139,20 +1201,119 @@ class ImageAdaptingMiddleware(object):
 
     def should_adapt(self, response):
         """Should we adapt the response from the wrapped app?
+
+        Only complete images (status ``200``) are adapted. Partial
+        content or `304 Not Modified` responses are passed on.
         """
+        if response.status_int != 200:
+            return False
         if response.content_type not in self.acceptable_types:
             return False
+        if self.max_source_bytes and (
+                response.content_length or 0) > self.max_source_bytes:
+            return False
         return True
 
     def is_mobile(self, request):
         """Is the device that sent `request` a mobile?
+
+        The result for a User-Agent string is remembered, as the same
+        strings are sent again and again.
         """
-        user_agent = request.headers.get('HTTP_USER_AGENT', None)
+        user_agent = request.headers.get('User-Agent', None)
         if not user_agent:
             return False
-        if reg_b.search(user_agent) or reg_v.search(user_agent[:4]):
-            return True
-        return False
+        result = self.user_agents.get(user_agent)
+        if result is None:
+            result = is_mobile_user_agent(user_agent)
+            self.user_agents.set(user_agent, result)
+        return result
+
+
+class PrefixedIter(object):
+    """An iterable yielding chunks from `prefix` and then `iterator`.
+
+    `prefix` is a list of chunks already read from `iterator` or
+    `app_iter`, where `iterator` is an iterator over the WSGI app
+    result `app_iter`. Closing an instance also closes `app_iter`, as
+    required by WSGI.
+    """
+
+    def __init__(self, prefix, iterator, app_iter=None):
+        self.prefix = prefix
+        self.iterator = iterator
+        self.app_iter = app_iter
+
+    def __iter__(self):
+        for chunk in self.prefix:
+            yield chunk
+        for chunk in self.iterator:
+            yield chunk
+
+    def close(self):
+        if hasattr(self.app_iter, 'close'):
+            self.app_iter.close()
+
+
+class RewindingFileIter(object):
+    """An iterable yielding the content of `file` in chunks.
+
+    The file is read from its beginning, no matter where its current
+    position is. Closing an instance closes `file`.
+    """
+
+    def __init__(self, file, block_size=BLOCK_SIZE):
+        self.file = file
+        self.block_size = block_size
+
+    def __iter__(self):
+        self.file.seek(0)
+        while True:
+            chunk = self.file.read(self.block_size)
+            if not chunk:
+                break
+            yield chunk
+
+    def close(self):
+        self.file.close()
+
+
+def get_mobile_regexes():
+    """Get the compiled `MOBILE_PATTERN_B` and `MOBILE_PATTERN_V`.
+
+    The patterns are compiled on first use only, so importing this
+    module stays cheap.
+    """
+    if not _mobile_regexes:
+        _mobile_regexes[:] = [
+            re.compile(MOBILE_PATTERN_B, re.I),
+            re.compile(MOBILE_PATTERN_V, re.I)]
+    return _mobile_regexes
+
+
+def is_mobile_user_agent(user_agent):
+    """Does the `user_agent` string belong to a mobile device?
+    """
+    reg_b, reg_v = get_mobile_regexes()
+    if reg_b.search(user_agent) or reg_v.search(user_agent[:4]):
+        return True
+    return False
+
+
+def get_number_header(headers, names):
+    """Get the value of the first header in `names` that is a number.
+
+    Values that are no numbers or not finite (like ``inf`` or
+    ``nan``) are skipped. Returns a float or ``None``.
+    """
+    for name in names:
+        try:
+            value = float(headers[name])
+        except (KeyError, ValueError):
+            continue
+        if not (math.isinf(value) or math.isnan(value)):
+            return value
+    return None
 
 
 def filter_app(app, global_conf, **kw):
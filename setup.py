@@ -32,6 +32,8 @@ tests_require = [
 
 docs_require = ['Sphinx', 'Pygments']
 
+avif_require = ['pillow-avif-plugin']
+
 setup(
     name='pail',
     version='0.3.dev0',
@@ -60,10 +62,14 @@ setup(
     extras_require = dict(
         tests = tests_require,
         docs = docs_require,
+        avif = avif_require,
         ),
     cmdclass = {'test': PyTest},
     zip_safe = False,
     entry_points="""[paste.filter_app_factory]
     main = pail.wsgi:filter_app
+
+    [console_scripts]
+    pail-warm = pail.warm:main
     """,
 )